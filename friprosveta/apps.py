@@ -0,0 +1,8 @@
+from django.apps import AppConfig
+
+
+class FriprosvetaConfig(AppConfig):
+    name = 'friprosveta'
+
+    def ready(self):
+        import friprosveta.signals  # noqa: F401
@@ -0,0 +1,558 @@
+"""
+Preloaded data of a timetable export into FET (see the django2fet command).
+
+ExportContext reads everything the FET generators need (groups, teachers,
+subjects, activities, realizations, tags, classrooms, allocations of the
+timetable and of the timetables it respects, preferences and the shared
+students of realizations) in a fixed number of queries and keeps it in dicts
+indexed by id, so generators never query the database per object.
+The context holds plain data only and can be pickled.
+
+FragmentCache keeps rendered sections of exports on disk, keyed by a digest
+of the parts of the context they were generated from (see
+ExportContext.digest), so re-exports only regenerate sections whose
+inputs changed.
+"""
+import hashlib
+import logging
+import os
+import pickle
+import time
+from collections import namedtuple, defaultdict
+
+import numpy as np
+
+from django.db.models import Q
+
+import friprosveta.models
+import timetable.models
+from friprosveta.management.commands import crossections
+from timetable.models import WEEKDAYS, WORKHOURS
+
+logger = logging.getLogger(__name__)
+
+WEEKDAY_NAMES = dict(WEEKDAYS)
+HOUR_INDEX = {wh[0]: i for i, wh in enumerate(WORKHOURS)}
+
+# The number of workplaces of a classroom is the number of this resource
+WORKPLACE_RESOURCE = 'Delovno mesto'
+
+GroupEntry = namedtuple('GroupEntry', ['id', 'name', 'short_name', 'size', 'parent_id'])
+ActivityEntry = namedtuple('ActivityEntry', [
+    'id', 'name', 'type', 'duration', 'subject_id', 'location_ids', 'requirement_ids',
+    'n_requirements', 'realization_ids'])
+RealizationEntry = namedtuple('RealizationEntry', ['id', 'activity_id', 'intended_size', 'teacher_ids', 'group_ids'])
+ClassroomEntry = namedtuple('ClassroomEntry', ['id', 'short_name', 'location_id', 'workplaces', 'resources'])
+RespectedEntry = namedtuple('RespectedEntry', ['id', 'classroom_ids', 'teacher_ids'])
+ValuePreferenceEntry = namedtuple('ValuePreferenceEntry', [
+    'id', 'owner_id', 'level', 'name', 'value', 'weight', 'adjusted_weight'])
+DescriptivePreferenceEntry = namedtuple('DescriptivePreferenceEntry', ['id', 'owner_id', 'level', 'typename', 'weight'])
+
+
+def hours(start, duration):
+    """
+    Return the work hours covered by something lasting duration hours from start.
+    """
+    index = HOUR_INDEX[start]
+    return [hour[0] for hour in WORKHOURS[index:min(len(WORKHOURS), index + duration)]]
+
+
+class AllocationEntry(namedtuple('AllocationEntry', [
+        'id', 'timetable_id', 'realization_id', 'classroom_id', 'day', 'start', 'duration'])):
+    __slots__ = ()
+
+    @property
+    def hours(self):
+        return hours(self.start, self.duration)
+
+
+class TimePreferenceEntry(namedtuple('TimePreferenceEntry', [
+        'id', 'owner_id', 'preferenceset_id', 'level', 'day', 'start', 'duration', 'weight',
+        'adjusted_weight'])):
+    __slots__ = ()
+
+    def hours(self):
+        return hours(self.start, self.duration)
+
+
+def adjusted_weight(level, weight):
+    """
+    Same as adjustedWeight of group, tag and value preferences.
+    """
+    return 1.0 if level == 'CANT' else weight
+
+
+def canonical(value):
+    """
+    Return the value in a form that pickles the same for equal values.
+    Empty lists in defaultdicts are dropped, as they are added by lookups.
+    """
+    if isinstance(value, defaultdict):
+        return [(k, canonical(v)) for k, v in value.items() if v != []]
+    if isinstance(value, dict):
+        return [(k, canonical(v)) for k, v in value.items()]
+    if isinstance(value, np.ndarray):
+        return value.shape, value.dtype.str, value.tobytes()
+    if type(value) in (list, tuple):
+        return [canonical(v) for v in value]
+    return value
+
+
+def teacher_id_string(first_name, last_name, username):
+    """
+    Same as Teacher.id_string for a teacher with the given user.
+    """
+    if username is None:
+        return "Ambrož Zasekamožević(None)"
+    return "{0}, {1}({2})".format(last_name, first_name, username)
+
+
+class ExportContext(object):
+    """
+    Everything a FET export of a single timetable reads from the database.
+    Lists of ids are ordered the same as the querysets the export used to
+    read them from.
+    """
+
+    def __init__(self, timetable_id, slug, preferenceset_id):
+        self.timetable_id = timetable_id
+        self.slug = slug
+        self.preferenceset_id = preferenceset_id
+        # id -> GroupEntry for groups of the timetable, their parents
+        # and groups of realizations and tags
+        self.groups = dict()
+        # Groups of the timetable groupset
+        self.group_ids = []
+        # id -> id string (see Teacher.id_string) of teachers of the
+        # timetable and of the respected timetables
+        self.teachers = dict()
+        # Teachers of realizations of the timetable
+        self.teacher_ids = []
+        # id -> id string of subjects of the timetable
+        self.subjects = dict()
+        # id -> ActivityEntry for activities of the timetable and activities
+        # they must not overlap or must be before
+        self.activities = dict()
+        # Activities of the timetable with subjects (friprosveta.models.Activity)
+        self.activity_ids = []
+        # activity id -> ids of activities it must not overlap / must be before
+        self.must_not_overlap = defaultdict(list)
+        self.before = defaultdict(list)
+        # id -> RealizationEntry for realizations of activities and respected allocations
+        self.realizations = dict()
+        # Realizations of the timetable
+        self.realization_ids = []
+        # id -> name
+        self.tags = dict()
+        # tag id -> ids of activities and realizations of the timetable and groups
+        self.tag_activities = defaultdict(list)
+        self.tag_realizations = defaultdict(list)
+        self.tag_groups = defaultdict(list)
+        # Reverse relations: id -> tag ids
+        self.activity_tags = defaultdict(list)
+        self.realization_tags = defaultdict(list)
+        self.teacher_tags = defaultdict(list)
+        self.group_tags = defaultdict(list)
+        # id -> name of all locations
+        self.locations = dict()
+        # id -> ClassroomEntry
+        self.classrooms = dict()
+        # Classrooms of the timetable
+        self.classroom_ids = []
+        # RespectedEntry for every respected timetable
+        self.respected = []
+        # id -> AllocationEntry for own allocations of the timetable and of respected timetables
+        self.allocations = dict()
+        # (allocation ids, time weight, space weight) for every allocation filter
+        self.allocation_filters = []
+        # owner id -> list of TimePreferenceEntry / ValuePreferenceEntry of the preference set
+        self.teacher_time_preferences = defaultdict(list)
+        self.group_time_preferences = defaultdict(list)
+        self.teacher_value_preferences = defaultdict(list)
+        self.group_value_preferences = defaultdict(list)
+        # Tag preferences of the preference set ordered by id. Time preferences also
+        # hold HATE and CANT preferences of tags of teachers and groups from all sets.
+        self.tag_time_preferences = []
+        self.tag_value_preferences = []
+        self.tag_descriptive_preferences = []
+        # (realizations, matrix) as returned by crossections.realization_student_matrix
+        self.realization_students = ([], None)
+
+    @classmethod
+    def build(cls, tt, groupset=None, allocation_weights=None):
+        """
+        Build the context of the timetable in a fixed number of queries.
+        groupset is the groupset student enrollments are read from (see
+        crossections.realization_student_matrix) and allocation_weights map
+        allocation filters to (time weight, space weight) as in django2fet.
+        """
+        logger.info("Building export context for {}".format(tt.slug))
+        ctx = cls(tt.id, tt.slug, tt.preferenceset_id)
+        respected = list(tt.respects.order_by('id').values_list('id', 'activityset_id', 'classroomset_id'))
+        respected_ids = [timetable_id for timetable_id, _, _ in respected]
+        own_activities = ctx._load_activities(tt)
+        ctx._load_realizations(own_activities, respected_ids)
+        respected_teachers = ctx._load_teachers([activityset_id for _, activityset_id, _ in respected])
+        group_ids = ctx._load_tags(tt)
+        ctx._load_groups(tt, group_ids)
+        classroomsets = ctx._load_classrooms(tt, [classroomset_id for _, _, classroomset_id in respected],
+                                             respected_ids)
+        ctx.respected = [RespectedEntry(timetable_id, classroomsets[classroomset_id],
+                                        respected_teachers[activityset_id])
+                         for timetable_id, activityset_id, classroomset_id in respected]
+        ctx._load_allocations(tt, respected_ids, allocation_weights or {})
+        ctx._load_preferences()
+        ctx.realization_students = crossections.realization_student_matrix(tt, groupset)
+        return ctx
+
+    def _load_activities(self, tt):
+        """
+        Load activities of the timetable and related activities.
+        Return ids of all activities in the activity set of the timetable.
+        """
+        activities = timetable.models.Activity.objects.filter(activityset_id=tt.activityset_id)
+        locations = defaultdict(list)
+        for activity_id, location_id in timetable.models.Activity.locations.through.objects.filter(
+                activity__in=activities).order_by('location_id').values_list('activity_id', 'location_id'):
+            locations[activity_id].append(location_id)
+        requirements = defaultdict(list)
+        for activity_id, resource_id in timetable.models.Activity.requirements.through.objects.filter(
+                activity__in=activities).order_by('resource_id').values_list('activity_id', 'resource_id'):
+            requirements[activity_id].append(resource_id)
+        n_requirements = defaultdict(list)
+        for activity_id, resource_id, n in timetable.models.NRequirementsPerStudent.objects.filter(
+                activity__in=activities).order_by('id').values_list('activity_id', 'resource_id', 'n'):
+            n_requirements[activity_id].append((resource_id, n))
+        related = set()
+        for relation, through in [(self.must_not_overlap, timetable.models.Activity.mustNotOverlap.through),
+                                  (self.before, timetable.models.Activity.before.through)]:
+            for from_id, to_id in through.objects.filter(from_activity__in=activities).order_by(
+                    'to_activity__name', 'to_activity_id').values_list('from_activity_id', 'to_activity_id'):
+                relation[from_id].append(to_id)
+                related.add(to_id)
+        own_activities = set()
+        for activity_id, activityset_id, name, activity_type, duration, subject_id in \
+                timetable.models.Activity.objects.filter(
+                    Q(activityset_id=tt.activityset_id) | Q(id__in=related)
+                ).order_by('name', 'id').values_list('id', 'activityset_id', 'name', 'type', 'duration',
+                                                     'activity__subject_id'):
+            self.activities[activity_id] = ActivityEntry(
+                activity_id, name, activity_type, duration, subject_id, locations[activity_id],
+                requirements[activity_id], n_requirements[activity_id], [])
+            if activityset_id == tt.activityset_id:
+                own_activities.add(activity_id)
+                if subject_id is not None:
+                    self.activity_ids.append(activity_id)
+        self.subjects = {subject_id: "{0}({1})".format(name, code) for subject_id, name, code in
+                         friprosveta.models.Subject.objects.filter(
+                             activities__activityset_id=tt.activityset_id
+                         ).distinct().order_by('id').values_list('id', 'name', 'code')}
+        return own_activities
+
+    def _load_realizations(self, own_activities, respected_ids):
+        realizations = Q(activity_id__in=self.activities.keys()) | Q(allocations__timetable_id__in=respected_ids)
+        through_filter = Q(activityrealization__activity_id__in=self.activities.keys()) | Q(
+            activityrealization__allocations__timetable_id__in=respected_ids)
+        teachers = defaultdict(list)
+        for realization_id, teacher_id in timetable.models.ActivityRealization.teachers.through.objects.filter(
+                through_filter).distinct().order_by('teacher_id').values_list('activityrealization_id',
+                                                                              'teacher_id'):
+            teachers[realization_id].append(teacher_id)
+        groups = defaultdict(list)
+        for realization_id, group_id in timetable.models.ActivityRealization.groups.through.objects.filter(
+                through_filter).distinct().order_by('group__name', 'group_id').values_list(
+                'activityrealization_id', 'group_id'):
+            groups[realization_id].append(group_id)
+        for realization_id, activity_id, intended_size in timetable.models.ActivityRealization.objects.filter(
+                realizations).distinct().order_by('id').values_list('id', 'activity_id', 'intended_size'):
+            self.realizations[realization_id] = RealizationEntry(
+                realization_id, activity_id, intended_size, teachers[realization_id], groups[realization_id])
+            if activity_id in self.activities:
+                self.activities[activity_id].realization_ids.append(realization_id)
+            if activity_id in own_activities:
+                self.realization_ids.append(realization_id)
+
+    def _load_teachers(self, respected_activitysets):
+        """
+        Load teachers of the timetable and of the respected timetables.
+        Return activity set id -> ids of teachers of its activities.
+        """
+        self.teacher_ids = sorted(set(teacher_id for realization_id in self.realization_ids
+                                      for teacher_id in self.realizations[realization_id].teacher_ids))
+        respected = defaultdict(set)
+        for activityset_id, teacher_id in timetable.models.Activity.teachers.through.objects.filter(
+                activity__activityset_id__in=respected_activitysets
+        ).values_list('activity__activityset_id', 'teacher_id'):
+            respected[activityset_id].add(teacher_id)
+        teacher_ids = set(self.teacher_ids).union(*respected.values())
+        for teacher_id, first_name, last_name, username in timetable.models.Teacher.objects.filter(
+                id__in=teacher_ids).values_list('id', 'user__first_name', 'user__last_name', 'user__username'):
+            self.teachers[teacher_id] = teacher_id_string(first_name, last_name, username)
+        return defaultdict(list, {activityset_id: sorted(ids) for activityset_id, ids in respected.items()})
+
+    def _load_tags(self, tt):
+        """
+        Load tags of activities, realizations, teachers and groups of the
+        timetable and tags with preferences in the timetable preference set.
+        Return ids of groups of tags.
+        """
+        for tag_id, activity_id in timetable.models.Tag.activities.through.objects.filter(
+                activity__activityset_id=tt.activityset_id
+        ).order_by('activity__name', 'activity_id', 'tag_id').values_list('tag_id', 'activity_id'):
+            self.tag_activities[tag_id].append(activity_id)
+            self.activity_tags[activity_id].append(tag_id)
+        for tag_id, realization_id in timetable.models.Tag.activity_realizations.through.objects.filter(
+                activityrealization__activity__activityset_id=tt.activityset_id
+        ).order_by('activityrealization_id', 'tag_id').values_list('tag_id', 'activityrealization_id'):
+            self.tag_realizations[tag_id].append(realization_id)
+            self.realization_tags[realization_id].append(tag_id)
+        for tag_id, teacher_id in timetable.models.Tag.teachers.through.objects.filter(
+                teacher_id__in=self.teacher_ids).order_by('tag_id').values_list('tag_id', 'teacher_id'):
+            self.teacher_tags[teacher_id].append(tag_id)
+        for tag_id, group_id in timetable.models.Tag.groups.through.objects.filter(
+                Q(group__groupset_id=tt.groupset_id) | Q(tag__preferences__preferenceset_id=self.preferenceset_id)
+        ).distinct().order_by('group__name', 'group_id', 'tag_id').values_list('tag_id', 'group_id'):
+            self.tag_groups[tag_id].append(group_id)
+            self.group_tags[group_id].append(tag_id)
+        for tags in self.activity_tags.values():
+            tags.sort()
+        for tags in self.group_tags.values():
+            tags.sort()
+        tag_ids = set(self.tag_activities) | set(self.tag_realizations) | set(self.tag_groups) | set(
+            tag_id for tags in self.teacher_tags.values() for tag_id in tags)
+        self.tags = dict(timetable.models.Tag.objects.filter(
+            Q(id__in=tag_ids) | Q(preferences__preferenceset_id=self.preferenceset_id)
+        ).distinct().values_list('id', 'name'))
+        return set(group_id for groups in self.tag_groups.values() for group_id in groups)
+
+    def _load_groups(self, tt, group_ids):
+        """
+        Load groups of the timetable, the given groups and all their parents.
+        """
+        group_ids = set(group_ids).union(*(r.group_ids for r in self.realizations.values()))
+        groups = timetable.models.Group.objects.filter(groupset_id=tt.groupset_id)
+        while True:
+            for group_id, groupset_id, name, short_name, size, parent_id in groups.order_by(
+                    'name', 'id').values_list('id', 'groupset_id', 'name', 'short_name', 'size', 'parent_id'):
+                self.groups[group_id] = GroupEntry(group_id, name, short_name, size, parent_id)
+                if groupset_id == tt.groupset_id:
+                    self.group_ids.append(group_id)
+            group_ids.update(g.parent_id for g in self.groups.values() if g.parent_id is not None)
+            missing = group_ids - set(self.groups)
+            if not missing:
+                break
+            # Groups outside of the groupset are rare, parents are
+            # read level by level
+            groups = timetable.models.Group.objects.filter(id__in=missing)
+
+    def _load_classrooms(self, tt, respected_classroomsets, respected_ids):
+        """
+        Load locations, classrooms of the timetable, of the respected timetables
+        and of allocations. Return classroom set id -> its classroom ids.
+        """
+        self.locations = dict(timetable.models.Location.objects.order_by('id').values_list('id', 'name'))
+        classroomset_ids = [tt.classroomset_id] + respected_classroomsets
+        classroomsets = defaultdict(list)
+        for classroomset_id, classroom_id in timetable.models.ClassroomSet.classrooms.through.objects.filter(
+                classroomset_id__in=classroomset_ids).order_by('classroom_id').values_list(
+                'classroomset_id', 'classroom_id'):
+            classroomsets[classroomset_id].append(classroom_id)
+        self.classroom_ids = classroomsets[tt.classroomset_id]
+        classrooms = timetable.models.Classroom.objects.filter(
+            Q(classroomset__id__in=classroomset_ids) | Q(allocation__timetable_id__in=[tt.id] + respected_ids))
+        resources = defaultdict(dict)
+        workplaces = dict()
+        for classroom_id, resource_id, resource_name, n in timetable.models.ClassroomNResources.objects.filter(
+                classroom__in=classrooms).order_by('id').values_list('classroom_id', 'resource_id',
+                                                                     'resource__name', 'n'):
+            resources[classroom_id][resource_id] = n
+            if resource_name == WORKPLACE_RESOURCE:
+                workplaces.setdefault(classroom_id, n)
+        for classroom_id, short_name, location_id in classrooms.distinct().order_by('id').values_list(
+                'id', 'short_name', 'location_id'):
+            self.classrooms[classroom_id] = ClassroomEntry(classroom_id, short_name, location_id,
+                                                           workplaces.get(classroom_id, 0), resources[classroom_id])
+        return classroomsets
+
+    def _load_allocations(self, tt, respected_ids, allocation_weights):
+        for row in timetable.models.Allocation.objects.filter(
+                timetable_id__in=[tt.id] + respected_ids
+        ).order_by('id').values_list('id', 'timetable_id', 'activityRealization_id', 'classroom_id', 'day',
+                                     'start', 'activityRealization__activity__duration'):
+            self.allocations[row[0]] = AllocationEntry(*row)
+        # Filters are arbitrary lookups, so they are evaluated by the database
+        for f, (t_weight, s_weight) in allocation_weights.items():
+            allocation_ids = list(tt.own_allocations.filter(**dict(f)).distinct().order_by('id').values_list(
+                'id', flat=True))
+            self.allocation_filters.append((allocation_ids, t_weight, s_weight))
+
+    def _load_preferences(self):
+        preferenceset_id = self.preferenceset_id
+        rows = list(timetable.models.TeacherTimePreference.objects.filter(
+            preferenceset_id=preferenceset_id).order_by('id').values_list(
+            'id', 'teacher_id', 'level', 'day', 'start', 'duration', 'weight'))
+        # Same as TeacherTimePreference.adjustedWeight
+        weight_sums = timetable.models.teacher_weight_sums(preferenceset_id, set((r[1], r[2]) for r in rows))
+        for preference_id, teacher_id, level, day, start, duration, weight in rows:
+            self.teacher_time_preferences[teacher_id].append(TimePreferenceEntry(
+                preference_id, teacher_id, preferenceset_id, level, day, start, duration, weight,
+                timetable.models.normalized_weight(level, weight, weight_sums.get((teacher_id, level), (0, 0))[1],
+                                                   0.4, 0.99)))
+        for preference_id, group_id, level, day, start, duration, weight in \
+                timetable.models.GroupTimePreference.objects.filter(
+                    preferenceset_id=preferenceset_id).order_by('id').values_list(
+                    'id', 'group_id', 'level', 'day', 'start', 'duration', 'weight'):
+            self.group_time_preferences[group_id].append(TimePreferenceEntry(
+                preference_id, group_id, preferenceset_id, level, day, start, duration, weight,
+                adjusted_weight(level, weight)))
+        # Not available times of teachers and groups include
+        # preferences of their tags from all preference sets
+        person_tags = set(tag_id for tags in self.teacher_tags.values() for tag_id in tags) | set(
+            tag_id for tags in self.group_tags.values() for tag_id in tags)
+        for preference_id, tag_id, tag_preferenceset_id, level, day, start, duration, weight in \
+                timetable.models.TagTimePreference.objects.filter(
+                    Q(preferenceset_id=preferenceset_id) | Q(tag_id__in=person_tags, level__in=['HATE', 'CANT'])
+                ).order_by('id').values_list('id', 'tag_id', 'preferenceset_id', 'level', 'day', 'start',
+                                             'duration', 'weight'):
+            self.tag_time_preferences.append(TimePreferenceEntry(
+                preference_id, tag_id, tag_preferenceset_id, level, day, start, duration, weight,
+                adjusted_weight(level, weight)))
+        for preference_id, teacher_id, level, name, value, weight in \
+                timetable.models.TeacherValuePreference.objects.filter(
+                    preferenceset_id=preferenceset_id).order_by('id').values_list(
+                    'id', 'teacher_id', 'level', 'name', 'value', 'weight'):
+            # TeacherValuePreference.adjustedWeight is the weight
+            self.teacher_value_preferences[teacher_id].append(ValuePreferenceEntry(
+                preference_id, teacher_id, level, name, value, weight, weight))
+        for preference_id, group_id, level, name, value, weight in \
+                timetable.models.GroupValuePreference.objects.filter(
+                    preferenceset_id=preferenceset_id).order_by('id').values_list(
+                    'id', 'group_id', 'level', 'name', 'value', 'weight'):
+            self.group_value_preferences[group_id].append(ValuePreferenceEntry(
+                preference_id, group_id, level, name, value, weight, adjusted_weight(level, weight)))
+        self.tag_value_preferences = [
+            ValuePreferenceEntry(preference_id, tag_id, level, name, value, weight, adjusted_weight(level, weight))
+            for preference_id, tag_id, level, name, value, weight in
+            timetable.models.TagValuePreference.objects.filter(
+                preferenceset_id=preferenceset_id).order_by('id').values_list(
+                'id', 'tag_id', 'level', 'name', 'value', 'weight')]
+        self.tag_descriptive_preferences = [
+            DescriptivePreferenceEntry(*row) for row in timetable.models.TagDescriptivePreference.objects.filter(
+                preferenceset_id=preferenceset_id).order_by('id').values_list(
+                'id', 'tag_id', 'level', 'typename', 'weight')]
+
+    def digest(self, names, *values):
+        """
+        Return the hex digest of the given attributes and values.
+        """
+        data = [(name, canonical(getattr(self, name))) for name in names]
+        data.append(canonical(values))
+        return hashlib.sha256(pickle.dumps(data, protocol=4)).hexdigest()
+
+    def realization_size(self, realization_id):
+        """
+        Same as ActivityRealization.size.
+        """
+        realization = self.realizations[realization_id]
+        size = sum(self.groups[group_id].size for group_id in realization.group_ids
+                   if self.groups[group_id].size is not None)
+        return max(size, realization.intended_size)
+
+    def realization_tag_ids(self, realization_id):
+        """
+        Return the set of ids of tags of the realization and of its activity.
+        """
+        realization = self.realizations[realization_id]
+        tag_ids = set(self.activity_tags[realization.activity_id])
+        tag_ids.update(self.realization_tags[realization_id])
+        return tag_ids
+
+    def tagged_realization_ids(self, tag_id):
+        """
+        Return ids of realizations of the timetable with the tag
+        or with activities with the tag, ordered by id.
+        """
+        realization_ids = set(self.tag_realizations[tag_id])
+        for activity_id in self.tag_activities[tag_id]:
+            realization_ids.update(self.activities[activity_id].realization_ids)
+        return sorted(realization_ids)
+
+    def preferred_rooms(self, realization_id, n_students):
+        """
+        Same as ActivityRealization.preferred_rooms in the timetable.
+        """
+        activity = self.activities[self.realizations[realization_id].activity_id]
+        rooms = []
+        for classroom_id in self.classroom_ids:
+            classroom = self.classrooms[classroom_id]
+            if classroom.location_id not in activity.location_ids:
+                continue
+            if not all(resource_id in classroom.resources for resource_id in activity.requirement_ids):
+                continue
+            if not all(resource_id in classroom.resources and classroom.resources[resource_id] >= n * n_students
+                       for resource_id, n in activity.n_requirements):
+                continue
+            rooms.append(classroom)
+        return rooms
+
+
+class FragmentCache(object):
+    """
+    Rendered fragments of FET exports stored in a directory, one file per
+    key. Names of the sections read from the cache and of the regenerated
+    ones are collected in cached and regenerated. Fragments the export did
+    not use are removed by prune.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.cached = []
+        self.regenerated = []
+        self.used = set()
+        self.opened = time.time()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.xml')
+
+    def get(self, key):
+        """
+        Return the fragment with the key or None when it is not cached.
+        """
+        self.used.add(key)
+        try:
+            with open(self.path(key), encoding='utf-8') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def set(self, key, fragment):
+        # Write to a temporary file first, so concurrent exports
+        # never read a partially written fragment
+        path = self.path(key)
+        tmp = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp, 'w', encoding='utf-8') as f:
+            f.write(fragment)
+        os.replace(tmp, path)
+        self.used.add(key)
+
+    def prune(self):
+        """
+        Remove fragments the export neither read nor wrote, so the directory
+        does not grow with every change of the inputs. Fragments written
+        after the cache was opened (by concurrent exports) are kept.
+        Return the number of removed fragments.
+        """
+        removed = 0
+        for name in os.listdir(self.directory):
+            key, extension = os.path.splitext(name)
+            path = os.path.join(self.directory, name)
+            if extension != '.xml' or key in self.used:
+                continue
+            try:
+                if os.path.getmtime(path) < self.opened:
+                    os.remove(path)
+                    removed += 1
+            except FileNotFoundError:
+                pass
+        return removed
@@ -1,5 +1,7 @@
 import sys
-from collections import namedtuple
+from collections import namedtuple, defaultdict, Counter
+
+import numpy as np
 
 import friprosveta
 import friprosveta.models
@@ -422,49 +424,116 @@ def realizations_must_not_overlap_new(currentTimetable, groupname_group, realiza
                 not_overlap_pairs.append((len(problematic), realization1, realization2))
 
 
+def group_study(short_name):
+    """
+    Same as Group.study for a group with the given short name.
+    """
+    split = short_name.split('_')
+    return split[1] if len(split) >= 2 else "UNKNOWN"
+
+
+def realization_student_matrix(current_timetable, groupset=None):
+    """
+    Return the list of (id, activity type) of realizations of the timetable
+    ordered by id and the realization x student incidence matrix in a fixed
+    number of queries. Students of a realization are the same as returned by
+    get_enroled_students_database.
+    """
+    realizations = current_timetable.realizations.order_by('id')
+    rows = list(realizations.values_list('id', 'activity__type', 'activity__activity__subject_id'))
+    index = {realization_id: i for i, (realization_id, _, _) in enumerate(rows)}
+    subjects = {realization_id: subject_id for realization_id, _, subject_id in rows}
+    realization_groups = list(timetable.models.ActivityRealization.groups.through.objects.filter(
+        activityrealization__in=realizations
+    ).order_by('activityrealization_id', 'group_id').values_list('activityrealization_id', 'group_id',
+                                                                 'group__short_name'))
+
+    if groupset is not None:
+        # A group is a match if it has a same short name and is on the same subject
+        matches = Counter()
+        matched_group = dict()
+        for group_id, short_name, subject_id in timetable.models.Activity.groups.through.objects.filter(
+                group__groupset=groupset, activity__activity__isnull=False
+        ).values_list('group_id', 'group__short_name', 'activity__activity__subject_id'):
+            matches[(short_name, subject_id)] += 1
+            matched_group[(short_name, subject_id)] = group_id
+        realization_groups = [(realization_id, matched_group[(short_name, subjects[realization_id])], short_name)
+                              for realization_id, _, short_name in realization_groups
+                              if matches[(short_name, subjects[realization_id])] == 1]
+        group_students = friprosveta.models.Student.groups.through.objects.filter(group__groupset=groupset)
+    else:
+        group_students = friprosveta.models.Student.groups.through.objects.filter(
+            group__realizations__in=realizations).distinct()
+
+    # TODO: če generacija ne gre skozi
+    realization_groups = [(realization_id, group_id)
+                          for realization_id, group_id, short_name in realization_groups
+                          if group_study(short_name) not in ["IZ", "EV"]]
+    students = defaultdict(list)
+    # Ordered, so the matrix of the same enrollments is always the same
+    for group_id, student_id in group_students.order_by('group_id', 'student_id').values_list(
+            'group_id', 'student_id'):
+        students[group_id].append(student_id)
+    student_index = dict()
+    matrix_rows, matrix_columns = [], []
+    for realization_id, group_id in realization_groups:
+        for student_id in students[group_id]:
+            matrix_rows.append(index[realization_id])
+            matrix_columns.append(student_index.setdefault(student_id, len(student_index)))
+    # float32 products use BLAS and are exact for counts below 2 ** 24
+    matrix = np.zeros((len(rows), len(student_index)), dtype=np.float32)
+    matrix[matrix_rows, matrix_columns] = 1
+    return [(realization_id, activity_type) for realization_id, activity_type, _ in rows], matrix
+
+
 def realizations_must_not_overlap_database(current_timetable, razor, razor_dict={},
                                            groupset=None, skip_pairs=[]):
     """
+    Return constraints for pairs of realizations sharing more students than
+    the razor (or the razor for their activity types in razor_dict).
+    Shared students of all pairs are counted with one matrix product.
     skip_pairs: a list of tuples of lecture types, which should be ignored.
     If lecture <-> lecture overlaps are to be ignored, then it should be 
     set to [('P', 'P')].
     """
-    not_overlap_pairs = []
-    student_cache = dict()
-    for realization1 in current_timetable.realizations.filter():
-        rs = current_timetable.realizations.filter(id__gt=realization1.id)
-        for realization2 in rs:
-            type1 = realization1.activity.type
-            type2 = realization2.activity.type
-            skip = False
-            for pair in skip_pairs:
-                if sorted((type1, type2)) == sorted(pair):
-                    skip = True
-                    break
-            if skip:
-                continue
-            r = razor_dict.get((realization1.activity.type,
-                                realization2.activity.type), None)
-            if r is None:
-                r = razor_dict.get((realization2.activity.type,
-                                    realization1.activity.type),
-                                   razor)
-            sr1 = get_enroled_students_database(realization1, student_cache,
-                                                groupset)
-            sr2 = get_enroled_students_database(realization2, student_cache,
-                                                groupset)
-            problematic = sr1.intersection(sr2)
-            if len(problematic) > r:
-                not_overlap_pairs.append((len(problematic), realization1,
-                                          realization2))
+    realizations, matrix = realization_student_matrix(current_timetable, groupset)
+    return not_overlapping_constraints(realizations, matrix, razor, razor_dict, skip_pairs)
 
-    l = []
-    for i in not_overlap_pairs:
-        l.append(['ConstraintActivitiesNotOverlapping', None, [
+
+def not_overlapping_constraints(realizations, matrix, razor, razor_dict={}, skip_pairs=[]):
+    """
+    Generate constraints for pairs of realizations sharing more students than
+    the razor, see realizations_must_not_overlap_database. realizations and
+    matrix are as returned by realization_student_matrix.
+    """
+    if not realizations:
+        return
+    shared = matrix.dot(matrix.T)
+
+    types = sorted(set(activity_type for _, activity_type in realizations))
+    type_index = {activity_type: i for i, activity_type in enumerate(types)}
+    # Razors and skipped pairs by the types of the first and the second realization
+    razors = np.empty((len(types), len(types)))
+    skip = np.zeros((len(types), len(types)), dtype=bool)
+    for i, type1 in enumerate(types):
+        for j, type2 in enumerate(types):
+            r = razor_dict.get((type1, type2), None)
+            if r is None:
+                r = razor_dict.get((type2, type1), razor)
+            razors[i, j] = r
+            skip[i, j] = any(sorted((type1, type2)) == sorted(pair) for pair in skip_pairs)
+    realization_types = np.array([type_index[activity_type] for _, activity_type in realizations])
+    pair_razors = razors[realization_types[:, None], realization_types[None, :]]
+    pair_skip = skip[realization_types[:, None], realization_types[None, :]]
+
+    # Realizations are ordered by id, so the upper triangle holds pairs
+    # in the same order as the nested loop over realizations would
+    not_overlap = np.triu((shared > pair_razors) & ~pair_skip, k=1)
+    for i, j in zip(*np.nonzero(not_overlap)):
+        yield ['ConstraintActivitiesNotOverlapping', None, [
             ['Weight_Percentage', '100'], ['Number_of_Activities', '2'],
-            ['Activity_Id', str(i[1].id)],
-            ['Activity_Id', str(i[2].id)]]])
-    return l
+            ['Activity_Id', str(realizations[i][0])],
+            ['Activity_Id', str(realizations[j][0])]]]
 
 
 def realizations_must_not_overlap(assignments, classes, razor=2):
@@ -814,7 +883,7 @@ if __name__ == '__main__':
         fix_regular_subjects_enrollments(currentTimetable, regular_subjects_map, padstudy)
 
     elif action == 'calculate':
-        x = realizations_must_not_overlap_database(currentTimetable, razor=7)
+        x = list(realizations_must_not_overlap_database(currentTimetable, razor=7))
 
         # print len(x), len(x[0])
         # xmlout = django2fet.l2El(['Insanity', None, x])
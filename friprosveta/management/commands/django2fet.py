@@ -1,97 +1,172 @@
+import hashlib
 import logging
-from xml.etree import ElementTree as ET
+import multiprocessing
+import sys
+import time
+from collections import defaultdict
+from functools import partial
+from itertools import chain
+from xml.sax.saxutils import escape
 
 from django.core.management.base import BaseCommand
-from django.db.models import Q
 
 import friprosveta.management.commands.crossections as crossections
+import friprosveta.export
 import friprosveta.models
 import timetable.models
+from friprosveta.export import ExportContext, FragmentCache, WEEKDAY_NAMES
 from timetable.models import GroupSet
 
 logger = logging.getLogger(__name__)
 
 
-def l2El(l):
-    try:
-        e = ET.Element(l[0])
-        if l[1] is not None:
-            e.text = l[1]
+class FetWriter(object):
+    """
+    Write a FET document incrementally.
+
+    Elements are given as nested lists [tag, text, children], where children
+    can be any iterable, also a generator. Elements are written as they are
+    generated, so the document is never held in memory as a whole.
+    Pretty printed output is indented by two spaces per level.
+    """
+
+    def __init__(self, write, pretty=True, buffer_size=64 * 1024):
+        self._write = write
+        self.pretty = pretty
+        self.buffer_size = buffer_size
+        self._buffer = []
+        self._buffered = 0
+        # Open elements as [tag, start tag, text, has children]
+        self._open = []
+
+    def write(self, s):
+        self._buffer.append(s)
+        self._buffered += len(s)
+        if self._buffered >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if self._buffer:
+            self._write(''.join(self._buffer))
+            self._buffer = []
+            self._buffered = 0
+
+    def _next_child(self):
+        if not self._open:
+            return
+        parent = self._open[-1]
+        if not parent[3]:
+            # The start tag is written with the first child,
+            # elements without children are written as empty elements
+            parent[3] = True
+            self.write(parent[1] + '>')
+            if parent[2] and (parent[2].strip() or not self.pretty):
+                self.write(escape(parent[2]))
+                return
+        if self.pretty:
+            self.write('\n' + '  ' * len(self._open))
+
+    def start(self, tag, text=None, **attributes):
+        self._next_child()
+        start = '<' + tag + ''.join(' {}="{}"'.format(name, escape(value, {'"': '&quot;'}))
+                                    for name, value in attributes.items())
+        self._open.append([tag, start, text, False])
+
+    def end(self):
+        tag, start, text, has_children = self._open.pop()
+        if has_children:
+            if self.pretty:
+                self.write('\n' + '  ' * len(self._open))
+            self.write('</' + tag + '>')
+        elif text:
+            self.write('{}>{}</{}>'.format(start, escape(text), tag))
+        else:
+            self.write(start + ' />')
+        if not self._open:
+            if self.pretty:
+                self.write('\n')
+            self.flush()
+
+    def element(self, l):
         if len(l) > 2 and l[2] is not None:
-            for i in l[2]:
-                if i is not None and len(i) > 0:
-                    e.append(l2El(i))
-    except Exception as ex:
-        print(l)
-        print(ex)
-        raise ex
-    return e
-
-
-def indent(elem, level=0):
-    i = "\n" + level * "  "
-    if len(elem):
-        if not elem.text or not elem.text.strip():
-            elem.text = i + "  "
-        if not elem.tail or not elem.tail.strip():
-            elem.tail = i
-        for elem in elem:
-            indent(elem, level + 1)
-        if not elem.tail or not elem.tail.strip():
-            elem.tail = i
-    else:
-        if level and (not elem.tail or not elem.tail.strip()):
-            elem.tail = i
+            self.start(l[0], l[1])
+            self.elements(l[2])
+            self.end()
+        else:
+            self._next_child()
+            if l[1]:
+                self.write('<{0}>{1}</{0}>'.format(l[0], escape(l[1])))
+            else:
+                self.write('<' + l[0] + ' />')
+
+    def elements(self, children):
+        for child in children:
+            if child is not None and len(child) > 0:
+                self.element(child)
+
+    @property
+    def depth(self):
+        return len(self._open)
+
+    def fragment(self, children, depth=None):
+        """
+        Return children rendered as they would be written into an element
+        open at the given depth (the currently open element by default).
+        """
+        out = []
+        writer = FetWriter(out.append, self.pretty, self.buffer_size)
+        writer._open = [[None, None, None, True]] * (self.depth if depth is None else depth)
+        writer.elements(children)
+        writer.flush()
+        return ''.join(out)
+
+    def raw(self, fragment):
+        """
+        Write a fragment rendered by fragment() into the currently open element.
+        """
+        if fragment:
+            parent = self._open[-1]
+            if not parent[3]:
+                parent[3] = True
+                self.write(parent[1] + '>')
+            self.write(fragment)
 
 
 def add_number_of(l, s):
     return [[s, str(len(l))]] + l
 
 
-def buildings_fet():
+def buildings_fet(ctx):
     logger.info("Entering buildingsFet")
-    e = ET.Element('Buildings_List')
-    for i in timetable.models.Location.objects.all():
-        logger.debug("Adding building {}".format(i))
-        e.append(l2El(['Building', None, [['Name', i.name]]]))
+    for name in ctx.locations.values():
+        logger.debug("Adding building {}".format(name))
+        yield ['Building', None, [['Name', name]]]
     logger.info("Exiting buildingsFet")
-    return e
 
 
-def room_fet(tt):
+def room_fet(ctx):
     logger.info("Entering roomFet")
-    rooms_list = ET.Element('Rooms_List')
-    for classroom in tt.classrooms.all():
-        logger.debug("Processing classroom {}".format(classroom))
-        location = classroom.location.name
-        resource_workplace = timetable.models.Resource.objects.get(name='Delovno mesto')
-        workplaces_n = timetable.models.ClassroomNResources.objects.filter(resource=resource_workplace,
-                                                                           classroom=classroom)
-        if len(workplaces_n) == 0:
-            workplaces = 0
-        else:
-            workplaces = workplaces_n[0].n
-        logger.debug("Workplaces: {}".format(workplaces))
-        rooms_list.append(l2El(['Room', None, [
+    for classroom_id in ctx.classroom_ids:
+        classroom = ctx.classrooms[classroom_id]
+        logger.debug("Processing classroom {}".format(classroom.short_name))
+        logger.debug("Workplaces: {}".format(classroom.workplaces))
+        yield ['Room', None, [
             ['Name', classroom.short_name],
-            ['Building', location],
-            ['Capacity', str(workplaces)]]]))
+            ['Building', ctx.locations[classroom.location_id]],
+            ['Capacity', str(classroom.workplaces)]]]
     logger.info("Exiting roomFet")
-    return rooms_list
 
 
-def student_year_fet(timetable):
+def student_year_fet(ctx):
     logger.info("Entering studentYearFet")
-    lsl = ['Students_List', None]
     years = {}
-    for i in timetable.groups.all():
-        logger.debug("Processing group {}".format(i))
-        # print "Processing", i
+    for group_id in ctx.group_ids:
+        logger.debug("Processing group {}".format(ctx.groups[group_id].short_name))
         l = []
-        j = i
+        j = ctx.groups[group_id]
         while j is not None:
-            l.append(j)
-            j = j.parent
+            l.append(j.id)
+            j = ctx.groups.get(j.parent_id)
         year = l[-1]
         logger.debug("{} {}".format(l, year))
 
@@ -110,113 +185,96 @@ def student_year_fet(timetable):
                 groups[group] = subgroups
         if len(l) > 2:
             subgroups.add(l[0])
-    ly = []
     for year, groups in years.items():
         logger.debug("{}; {}".format(year, groups))
         lg = []
-        # print year.name + ":" + str(year.id)
+        year = ctx.groups[year]
         for group, subgroups in groups.items():
-
+            group = ctx.groups[group]
             logger.debug("{}; {}".format(group.name, group.id))
             logger.debug("{}".format(subgroups))
             lsg = []
             for subgroup in subgroups:
                 logger.debug("Adding {}".format(subgroup))
+                subgroup = ctx.groups[subgroup]
                 lsg.append(['Subgroup', None, [
-                    ['Name', subgroup.id_string()], ['Number_of_Students', str(subgroup.size)]]])
-            lg.append(['Group', None, [['Name', group.id_string()], ['Number_of_Students', str(group.size)]] + lsg])
-        ly.append(['Year', None, [['Name', year.id_string()], ['Number_of_Students', str(year.size)]] + lg])
-    lsl.append(ly)
+                    ['Name', subgroup.short_name], ['Number_of_Students', str(subgroup.size)]]])
+            lg.append(['Group', None, [['Name', group.short_name], ['Number_of_Students', str(group.size)]] + lsg])
+        yield ['Year', None, [['Name', year.short_name], ['Number_of_Students', str(year.size)]] + lg]
     logger.info("Exiting studentYearFet")
-    return l2El(lsl)
 
 
-def teachers_fet(timetable):
+def teachers_fet(ctx):
     logger.info("Entering teachersFet")
-    te = ET.Element('Teachers_List')
-    for t in timetable.teachers.all():
-        logger.debug("Processing teacher {}; {}".format(t, t.id_string()))
-        te.append(l2El(['Teacher', None,
-                        [['Name', t.id_string()]]]))
+    for teacher_id in ctx.teacher_ids:
+        logger.debug("Processing teacher {}".format(ctx.teachers[teacher_id]))
+        yield ['Teacher', None,
+               [['Name', ctx.teachers[teacher_id]]]]
     logger.info("Exiting teachersFet")
-    return te
 
 
-def subjects_fet(timetable):
+def subjects_fet(ctx):
     logger.info("Entering subjectsFet")
-    se = ET.Element('Subjects_List')
-    for i in timetable.subjects.all():
-        logger.debug("Adding subject {}".format(i))
-        se.append(l2El(['Subject', None,
-                        [['Name', i.id_string()]]]))
+    for subject in ctx.subjects.values():
+        logger.debug("Adding subject {}".format(subject))
+        yield ['Subject', None,
+               [['Name', subject]]]
     logger.info("Exiting subjectsFet")
-    return se
 
 
-def _shrunken_students(timetable, realization):
-    tagset = set()
+def _shrunken_students(ctx, realization_id, shrink_ammounts):
+    """
+    Return the size of the realization reduced by the largest SHRINKGROUPS
+    value of its tags. shrink_ammounts maps tag ids to these values
+    (see _shrink_ammounts).
+    """
     shrink_ammount = 0
-    for tag in realization.activity.tags.all():
-        tagset.add(tag)
-    for tag in realization.tags.all():
-        tagset.add(tag)
-    for tag in tagset:
-        for p in tag.value_preferences.filter(preferenceset__timetable=timetable, name='SHRINKGROUPS'):
-            shrink_ammount = max(shrink_ammount, p.value)
-    return realization.size - shrink_ammount
-
-
-def activities_fet(timetable, disabled_types=[]):
-    l = []
+    for tag_id in ctx.realization_tag_ids(realization_id):
+        shrink_ammount = max(shrink_ammount, shrink_ammounts.get(tag_id, 0))
+    return ctx.realization_size(realization_id) - shrink_ammount
+
+
+def _shrink_ammounts(ctx):
+    shrink_ammounts = dict()
+    for p in ctx.tag_value_preferences:
+        if p.name == 'SHRINKGROUPS':
+            shrink_ammounts[p.owner_id] = max(shrink_ammounts.get(p.owner_id, 0), p.value)
+    return shrink_ammounts
+
+
+def activities_fet(ctx, disabled_types=[]):
     # <Number_of_Students
-    # for i in Activity.objects.filter(timetable__exact = timetable):
-    al = []
-    for i in timetable.activities.distinct().all():
-        for ar in i.realizations.all():
-
-            tl = []
-            sl = []
-            al = []
-
-            for t in ar.teachers.all():
-                tl.append(['Teacher', t.id_string()])
-            for g in ar.groups.all():
-                # sl.append(['Students', g.name+"-"+str(g.id)])
-                sl.append(['Students', g.id_string()])
-            if len(tl) > 0:
-                al += tl
-            al.append(['Subject', ar.activity.activity.subject.id_string()])
-            tagset = set()
-            for tag in ar.activity.tags.all():
-                tagset.add(tag)
-            for tag in ar.tags.all():
-                tagset.add(tag)
-            for tag in tagset:
-                al.append(['Activity_Tag', tag.name])
-            if ar.duration is not None:
-                al.append(['Duration', str(ar.duration)])
-                al.append(['Total_Duration', str(ar.duration)])
-            al.append(['Id', str(ar.id)])
+    shrink_ammounts = _shrink_ammounts(ctx)
+    for i in ctx.activity_ids:
+        activity = ctx.activities[i]
+        for ar in activity.realization_ids:
+            realization = ctx.realizations[ar]
+            al = [['Teacher', ctx.teachers[t]] for t in realization.teacher_ids]
+            al.append(['Subject', ctx.subjects[activity.subject_id]])
+            for tag in ctx.realization_tag_ids(ar):
+                al.append(['Activity_Tag', ctx.tags[tag]])
+            if activity.duration is not None:
+                al.append(['Duration', str(activity.duration)])
+                al.append(['Total_Duration', str(activity.duration)])
+            al.append(['Id', str(ar)])
             al.append(['Activity_Group_Id', str(0)])
-            if i.type in disabled_types:
+            if activity.type in disabled_types:
                 al.append(['Active', 'false'])
             else:
                 al.append(['Active', 'true'])
-            if len(sl) > 0:
-                al += sl
-            al.append(['Number_Of_Students', str(int(_shrunken_students(timetable, ar)))])
-            l.append(['Activity', None, al])
-    return l2El(['Activities_List', None, l])
+            al += [['Students', ctx.groups[g].short_name] for g in realization.group_ids]
+            al.append(['Number_Of_Students', str(int(_shrunken_students(ctx, ar, shrink_ammounts)))])
+            yield ['Activity', None, al]
 
 
-def activity_tags(tt):
+def activity_tags(ctx):
     tagset = set()
-    for tag in timetable.models.Tag.objects.filter(activities__activityset__timetable=tt).distinct():
-        tagset.add(tag.name)
-    for tag in timetable.models.Tag.objects.filter(
-            activity_realizations__activity__activityset__timetable=tt).distinct():
-        tagset.add(tag.name)
-    return l2El(['Activity_Tags_List', None, [['Activity_Tag', None, [['Name', i]]] for i in tagset]])
+    for tag_id in sorted(t for t, activity_ids in ctx.tag_activities.items() if activity_ids):
+        tagset.add(ctx.tags[tag_id])
+    for tag_id in sorted(t for t, realization_ids in ctx.tag_realizations.items() if realization_ids):
+        tagset.add(ctx.tags[tag_id])
+    for i in tagset:
+        yield ['Activity_Tag', None, [['Name', i]]]
 
 
 # def activitiesNotOverlapping(timetable):
@@ -248,39 +306,39 @@ def activity_tags(tt):
 #    return l
 
 
-def activities_not_overlapping(tt):
+def activities_not_overlapping(ctx):
     """<ConstraintActivitiesNotOverlapping>
         <Weight_Percentage>100</Weight_Percentage>
         <Number_of_Activities>2</Number_of_Activities>
         <Activity_Id>730</Activity_Id>
         <Activity_Id>733</Activity_Id>
     </ConstraintActivitiesNotOverlapping>"""
-    l = []
-    for i in tt.activities.distinct().all():
-        for j in i.mustNotOverlap.all().filter(id__gt=i.id):
-            for iar in i.realizations.all():
-                for jar in j.realizations.all():
-                    nl = [['Activity_Id', str(iar.id)], ['Activity_Id', str(jar.id)]]
-                    l.append(['ConstraintActivitiesNotOverlapping', None, [
-                        ['Weight_Percentage', '100']] + add_number_of(nl, 'Number_of_Activities')])
-    for pref in timetable.models.TagDescriptivePreference.objects.filter(typename='NOOVERLAP',
-                                                                         preferenceset__timetable=tt).distinct():
+    for i in ctx.activity_ids:
+        for j in ctx.must_not_overlap[i]:
+            if j <= i:
+                continue
+            for iar in ctx.activities[i].realization_ids:
+                for jar in ctx.activities[j].realization_ids:
+                    nl = [['Activity_Id', str(iar)], ['Activity_Id', str(jar)]]
+                    yield ['ConstraintActivitiesNotOverlapping', None, [
+                        ['Weight_Percentage', '100']] + add_number_of(nl, 'Number_of_Activities')]
+    for pref in ctx.tag_descriptive_preferences:
+        if pref.typename != 'NOOVERLAP':
+            continue
         nl = []
-        for i in pref.tag.activities.filter(
-                activityset__timetable=tt):  # tole je narobe, saj vse realizacije vseh aktivnosti vrze v eno vreco
-            for iar in i.realizations.all():
-                nl.append(['Activity_Id', str(iar.id)])  # PAZI NA VELIKI I pri Id, sicer se FET sesuje!!!
+        for i in ctx.tag_activities[pref.owner_id]:  # tole je narobe, saj vse realizacije vseh aktivnosti vrze v eno vreco
+            for iar in ctx.activities[i].realization_ids:
+                nl.append(['Activity_Id', str(iar)])  # PAZI NA VELIKI I pri Id, sicer se FET sesuje!!!
         if len(nl) > 1:
-            l.append(['ConstraintActivitiesNotOverlapping', None, [
-                ['Weight_Percentage', str(int(100 * pref.weight))]] + add_number_of(nl, 'Number_of_Activities')])
+            yield ['ConstraintActivitiesNotOverlapping', None, [
+                ['Weight_Percentage', str(int(100 * pref.weight))]] + add_number_of(nl, 'Number_of_Activities')]
         nl = []
-        for iar in pref.tag.activity_realizations.filter(activity__activityset__timetable=tt):
-            nl.append(['Activity_Id', str(iar.id)])  # PAZI NA VELIKI I pri Id, sicer se FET sesuje!!!
+        for iar in ctx.tag_realizations[pref.owner_id]:
+            nl.append(['Activity_Id', str(iar)])  # PAZI NA VELIKI I pri Id, sicer se FET sesuje!!!
         if len(nl) > 1:
-            l.append(['ConstraintActivitiesNotOverlapping', None, [
-                ['Weight_Percentage', str(int(100 * pref.weight))]] + add_number_of(nl, 'Number_of_Activities')])
+            yield ['ConstraintActivitiesNotOverlapping', None, [
+                ['Weight_Percentage', str(int(100 * pref.weight))]] + add_number_of(nl, 'Number_of_Activities')]
     # Non-overlapping zaradi izbirnosti
-    return l
 
 
 def activities_crossections_not_overlapping_file_hack(tt, razor, enrollment_files):
@@ -292,7 +350,7 @@ def activities_crossections_not_overlapping_file_hack(tt, razor, enrollment_file
     return crossections.realizations_must_not_overlap_new(tt, groupname_group, realizations, razor)
 
 
-def activities_ordered(timetable):
+def activities_ordered(ctx):
     """
     <ConstraintTwoActivitiesOrdered>
         <Weight_Percentage>100</Weight_Percentage>
@@ -300,58 +358,55 @@ def activities_ordered(timetable):
         <Second_Activity_Id>1144</Second_Activity_Id>
     </ConstraintTwoActivitiesOrdered>
     """
-    l = []
-    for i in timetable.activities.distinct().all():
-        for j in i.before.all():
-            for iar in i.realizations.all():
-                for jar in j.realizations.all():
-                    l.append(['ConstraintTwoActivitiesOrdered', None, [
+    for i in ctx.activity_ids:
+        for j in ctx.before[i]:
+            for iar in ctx.activities[i].realization_ids:
+                for jar in ctx.activities[j].realization_ids:
+                    yield ['ConstraintTwoActivitiesOrdered', None, [
                         ['Weight_Percentage', '100'],
-                        ['First_Activity_Id', str(iar.id)],
-                        ['Second_Activity_Id', str(jar.id)],
-                    ]])
-    return l
+                        ['First_Activity_Id', str(iar)],
+                        ['Second_Activity_Id', str(jar)],
+                    ]]
 
 
-def activities_grouped(tt):
+def activities_grouped(ctx):
     """<ConstraintTwoActivitiesGrouped>
         <Weight_Percentage>100</Weight_Percentage>
         <First_Activity_Id>797</First_Activity_Id>
         <Second_Activity_Id>796</Second_Activity_Id>
        </ConstraintTwoActivitiesGrouped>"""
 
-    l = []
     groups = set()
-    for pref in timetable.models.TagDescriptivePreference.objects.filter(typename='GROUPED',
-                                                                         preferenceset__timetable=tt).distinct():
+    for pref in ctx.tag_descriptive_preferences:
+        if pref.typename != 'GROUPED':
+            continue
         al = set()
-        for i in pref.tag.activities.filter(activityset__timetable=tt):
-            for iar in i.realizations.all():
-                al.add(str(iar.id))
+        for i in ctx.tag_activities[pref.owner_id]:
+            for iar in ctx.activities[i].realization_ids:
+                al.add(str(iar))
         groups.add((pref.weight, tuple(al)))
         al = set()
-        for i in pref.tag.activity_realizations.filter(activity__activityset__timetable=tt):
-            al.add(str(i.id))
+        for i in ctx.tag_realizations[pref.owner_id]:
+            al.add(str(i))
         groups.add((pref.weight, tuple(al)))
     for (w, g) in groups:
         if len(g) == 2:
-            l.append(['ConstraintTwoActivitiesGrouped', None, [
+            yield ['ConstraintTwoActivitiesGrouped', None, [
                 ['Weight_Percentage', str(int(100 * w))],
                 ['First_Activity_Id', g[0]],
-                ['Second_Activity_Id', g[1]]]])
+                ['Second_Activity_Id', g[1]]]]
         elif len(g) == 3:
-            l.append(['ConstraintThreeActivitiesGrouped', None, [
+            yield ['ConstraintThreeActivitiesGrouped', None, [
                 ['Weight_Percentage', str(int(100 * w))],
                 ['First_Activity_Id', g[0]],
                 ['Second_Activity_Id', g[1]],
-                ['Third_Activity_Id', g[2]]]])
+                ['Third_Activity_Id', g[2]]]]
         else:
             # FET is braindead, cannot group more than 3 activities.
             pass
-    return l
 
 
-def activities_consecutive(tt):
+def activities_consecutive(ctx):
     """<ConstraintTwoActivitiesConsecutive>
         <Weight_Percentage>100</Weight_Percentage>
         <First_Activity_Id>2464</First_Activity_Id>
@@ -359,32 +414,31 @@ def activities_consecutive(tt):
         <Active>true</Active>
         <Comments></Comments>
        </ConstraintTwoActivitiesConsecutive>"""
-    l = []
     groups = set()
-    for pref in timetable.models.TagDescriptivePreference.objects.filter(typename='CONSECUTIVE',
-                                                                         preferenceset__timetable=tt).distinct():
+    for pref in ctx.tag_descriptive_preferences:
+        if pref.typename != 'CONSECUTIVE':
+            continue
         al = set()
-        for i in pref.tag.activities.filter(activityset__timetable=tt).order_by('id'):
-            for iar in i.realizations.all():
-                al.add(str(iar.id))
+        for i in sorted(ctx.tag_activities[pref.owner_id]):
+            for iar in ctx.activities[i].realization_ids:
+                al.add(str(iar))
         groups.add((pref.weight, tuple(al)))
         al = set()
-        for i in pref.tag.activity_realizations.filter(activity__activityset__timetable=tt).order_by('id'):
-            al.add(str(i.id))
+        for i in ctx.tag_realizations[pref.owner_id]:
+            al.add(str(i))
         groups.add((pref.weight, tuple(al)))
     for (w, g) in groups:
         if len(g) == 2:
-            l.append(['ConstraintTwoActivitiesConsecutive', None, [
+            yield ['ConstraintTwoActivitiesConsecutive', None, [
                 ['Weight_Percentage', str(int(100 * w))],
                 ['First_Activity_Id', g[0]],
-                ['Second_Activity_Id', g[1]]]])
+                ['Second_Activity_Id', g[1]]]]
         else:
             # FET is braindead, cannot "consecutive" more than 2 activities.
             pass
-    return l
 
 
-def activities_same_day(tt):
+def activities_same_day(ctx):
     """<ConstraintActivitiesSameStartingDay>
         <Weight_Percentage>100</Weight_Percentage>
         <Number_of_Activities>2</Number_of_Activities>
@@ -394,19 +448,18 @@ def activities_same_day(tt):
         <Comments></Comments>
        </ConstraintActivitiesSameStartingDay>"""
 
-    l = []
-    for p in timetable.models.TagDescriptivePreference.objects.filter(typename='SAMEDAY', level="WANT",
-                                                                      preferenceset__timetable=tt).distinct():
-        realizations = tt.realizations.filter(Q(activity__tags__exact=p.tag) | Q(tags__exact=p.tag)).distinct()
+    for p in ctx.tag_descriptive_preferences:
+        if p.typename != 'SAMEDAY' or p.level != "WANT":
+            continue
+        realizations = ctx.tagged_realization_ids(p.owner_id)
         if len(realizations) > 0:
-            actList = [['Activity_Id', str(r.id)] for r in realizations]
-            l.append(['ConstraintActivitiesSameStartingDay', None, [
+            actList = [['Activity_Id', str(r)] for r in realizations]
+            yield ['ConstraintActivitiesSameStartingDay', None, [
                 ['Weight_Percentage', str(100 * p.weight)]] +
-                      add_number_of(actList, 'Number_of_Activities')])
-    return l
+                add_number_of(actList, 'Number_of_Activities')]
 
 
-def activities_same_time(tt):
+def activities_same_time(ctx):
     """<ConstraintActivitiesSameStartingTime>
     <Weight_Percentage>100</Weight_Percentage>
     <Number_of_Activities>2</Number_of_Activities>
@@ -415,19 +468,18 @@ def activities_same_time(tt):
     <Active>true</Active>
     <Comments></Comments>
     </ConstraintActivitiesSameStartingTime>"""
-    l = []
-    for p in timetable.models.TagDescriptivePreference.objects.filter(typename='SAMESTARTINGTIME', level="WANT",
-                                                                      preferenceset__timetable=tt).distinct():
-        realizations = tt.realizations.filter(Q(activity__tags__exact=p.tag) | Q(tags__exact=p.tag)).distinct()
+    for p in ctx.tag_descriptive_preferences:
+        if p.typename != 'SAMESTARTINGTIME' or p.level != "WANT":
+            continue
+        realizations = ctx.tagged_realization_ids(p.owner_id)
         if len(realizations) > 0:
-            actList = [['Activity_Id', str(r.id)] for r in realizations]
-            l.append(['ConstraintActivitiesSameStartingTime', None, [
+            actList = [['Activity_Id', str(r)] for r in realizations]
+            yield ['ConstraintActivitiesSameStartingTime', None, [
                 ['Weight_Percentage', str(100 * p.weight)]] +
-                      add_number_of(actList, 'Number_of_Activities')])
-    return l
+                add_number_of(actList, 'Number_of_Activities')]
 
 
-def activities_tag_max_hour_daily(tt):
+def activities_tag_max_hour_daily(ctx):
     """<ConstraintStudentsSetActivityTagMaxHoursDaily>
     <Weight_Percentage>100</Weight_Percentage>
     <Maximum_Hours_Daily>6</Maximum_Hours_Daily>
@@ -436,21 +488,19 @@ def activities_tag_max_hour_daily(tt):
     <Active>true</Active>
     <Comments></Comments>
     </ConstraintStudentsSetActivityTagMaxHoursDaily>"""
-    ret = []
-    for p in timetable.models.TagValuePreference.objects.filter(name='TAGMAXHOURSDAILY', level="WANT",
-                                                                preferenceset__timetable=tt).distinct():
-        tag = p.tag
-        for group in tag.groups.all():
-            ret.append(['ConstraintStudentsSetActivityTagMaxHoursDaily', None, [
+    for p in ctx.tag_value_preferences:
+        if p.name != 'TAGMAXHOURSDAILY' or p.level != "WANT":
+            continue
+        for group in ctx.tag_groups[p.owner_id]:
+            yield ['ConstraintStudentsSetActivityTagMaxHoursDaily', None, [
                 ['Weight_Percentage', str(100 * p.weight)],
                 ['Maximum_Hours_Daily', str(p.value)],
-                ['Students', group.short_name],
-                ['Activity_Tag', tag.name],
-            ]])
-    return ret
+                ['Students', ctx.groups[group].short_name],
+                ['Activity_Tag', ctx.tags[p.owner_id]],
+            ]]
 
 
-def activitiesMaxNumberOfRooms(tt):
+def activitiesMaxNumberOfRooms(ctx):
     """<ConstraintActivitiesOccupyMaxDifferentRooms>
         <Weight_Percentage>100</Weight_Percentage>
         <Number_of_Activities>2</Number_of_Activities>
@@ -460,56 +510,61 @@ def activitiesMaxNumberOfRooms(tt):
         <Active>true</Active>
         <Comments></Comments>
        </ConstraintActivitiesOccupyMaxDifferentRooms>"""
-    l = []
-    for p in timetable.models.TagValuePreference.objects.filter(name='MAXROOMSREALIZATIONS', level="WANT",
-                                                                preferenceset__timetable=tt).distinct():
-        realizations = tt.realizations.filter(Q(activity__tags__exact=p.tag) | Q(tags__exact=p.tag)).distinct()
+    for p in ctx.tag_value_preferences:
+        if p.name != 'MAXROOMSREALIZATIONS' or p.level != "WANT":
+            continue
+        realizations = ctx.tagged_realization_ids(p.owner_id)
         if len(realizations) > 1:
-            act_list = [['Activity_Id', str(r.id)] for r in realizations]
-            l.append(['ConstraintActivitiesOccupyMaxDifferentRooms', None, [
-                ['Weight_Percentage', str(100 * p.adjustedWeight())]] +
-                      add_number_of(act_list, 'Number_of_Activities') +
-                      [['Max_Number_of_Different_Rooms', str(p.value)]]])
-    return l
+            act_list = [['Activity_Id', str(r)] for r in realizations]
+            yield ['ConstraintActivitiesOccupyMaxDifferentRooms', None, [
+                ['Weight_Percentage', str(100 * p.adjusted_weight)]] +
+                add_number_of(act_list, 'Number_of_Activities') +
+                [['Max_Number_of_Different_Rooms', str(p.value)]]]
 
 
-def allocations_to_preferred_times(timetable, allocation_weights):
+def allocations_to_preferred_times(ctx):
     logger.info("Entering allocationsToPreferredTimes")
-    logger.debug("tt: {}".format(timetable))
-    logger.debug("Allocation weights: {}".format(allocation_weights))
-    l = []
-    # done = set()
     aw = {}
-    for f, (t_weight, s_weight) in allocation_weights.items():  # @UnusedVariable
-        logger.debug("Processing {}; {}".format(f, (t_weight, s_weight)))
-        logger.debug("Matching allocations")
-        logger.debug("{}".format(timetable.own_allocations.filter(**dict(f)).distinct()))
-        for a in timetable.own_allocations.filter(**dict(f)).distinct():
-            w = max(t_weight, aw.get(a, t_weight))
+    for allocation_ids, t_weight, s_weight in ctx.allocation_filters:  # @UnusedVariable
+        for a in allocation_ids:
             aw[a] = t_weight
     for (a, w) in aw.items():
         if w > 0:
+            a = ctx.allocations[a]
             logger.debug("Adding w {}; a_id {}; pd {}; ph {}; pl {}".format(
-                str(100 * w), a.activityRealization.id,
-                a.get_day_display(), a.start, 'false'
+                str(100 * w), a.realization_id,
+                WEEKDAY_NAMES[a.day], a.start, 'false'
             ))
-            l.append(['ConstraintActivityPreferredStartingTime', None, [
+            yield ['ConstraintActivityPreferredStartingTime', None, [
                 ['Weight_Percentage', str(100 * w)],
-                ['Activity_Id', str(a.activityRealization.id)],
-                ['Preferred_Day', a.get_day_display()],
+                ['Activity_Id', str(a.realization_id)],
+                ['Preferred_Day', WEEKDAY_NAMES[a.day]],
                 ['Preferred_Hour', a.start],
                 ['Permanently_Locked', 'false']
-            ]])
+            ]]
     logger.info("Exiting allocationsToPreferredTimes")
-    return l
 
 
-def generic_not_available_preferences(tt, objs, constraint_string, entity_string):
-    l = []
-    for i in objs:
+def _tag_time_preferences(ctx, levels, preferenceset_id=None):
+    """
+    Return tag id -> tag time preferences with the given levels
+    (and of the given preference set), ordered by id.
+    """
+    preferences = defaultdict(list)
+    for p in ctx.tag_time_preferences:
+        if p.level in levels and preferenceset_id in [None, p.preferenceset_id]:
+            preferences[p.owner_id].append(p)
+    return preferences
+
+
+def generic_not_available_preferences(ctx, object_ids, id_strings, time_preferences, object_tags,
+                                      constraint_string, entity_string):
+    tag_preferences = _tag_time_preferences(ctx, ['HATE', 'CANT'])
+    for i in object_ids:
         ad = {}
-        for a in i.time_preferences.filter(preferenceset=tt.preferenceset, level__in=['HATE', 'CANT']):
-            weight = a.adjustedWeight() * 100
+        for a in time_preferences[i]:
+            if a.level not in ['HATE', 'CANT']:
+                continue
             # Ignore yellow fields
             # if weight < 100:
             #    continue
@@ -520,64 +575,61 @@ def generic_not_available_preferences(tt, objs, constraint_string, entity_string
             for h in a.hours():
                 ad[p].append(['Not_Available_Time', None, [
                     # ['Day', a.get_day_display()],
-                    ['Day', a.get_day_display()],
+                    ['Day', WEEKDAY_NAMES[a.day]],
                     ['Hour', h]]])
-        for tag in i.tags.all():
-            for tp in timetable.models.TagTimePreference.objects.filter(tag=tag, level__in=['HATE', 'CANT']):
-                weight = tp.adjustedWeight() * 100
-                # Ignore yellow fields
-                # if weight < 100:
-                #    continue
-                # p = str(int(a.adjustedWeight()*100))
+        for tag in object_tags[i]:
+            for tp in tag_preferences[tag]:
                 p = "100"  # Gregor: only 100 supported by fet, stupid
                 if p not in ad:
                     ad[p] = []
                 for h in tp.hours():
                     ad[p].append(['Not_Available_Time', None, [
-                        ['Day', tp.get_day_display()],
+                        ['Day', WEEKDAY_NAMES[tp.day]],
                         ['Hour', h]]])
         for (p, al) in ad.items():
-            l.append([constraint_string, None, [
+            yield [constraint_string, None, [
                 ['Weight_Percentage', p],
-                [entity_string, i.id_string()]] + add_number_of(al, 'Number_of_Not_Available_Times')])
-    return l
+                [entity_string, id_strings[i]]] + add_number_of(al, 'Number_of_Not_Available_Times')]
 
 
-def teacher_not_available_preferences(tt):
+def teacher_not_available_preferences(ctx):
     logger.info("Entering teacherNotAvailablePreferences")
-    logger.debug("TT: {}".format(tt))
-    r = generic_not_available_preferences(tt, tt.teachers.all(), 'ConstraintTeacherNotAvailableTimes', 'Teacher')
+    yield from generic_not_available_preferences(ctx, ctx.teacher_ids, ctx.teachers, ctx.teacher_time_preferences,
+                                                 ctx.teacher_tags, 'ConstraintTeacherNotAvailableTimes', 'Teacher')
     logger.info("Exiting teacherNotAvailablePreferences")
-    return r
 
 
-def students_not_available_preferences(tt):
+def students_not_available_preferences(ctx):
     logger.info("Entering studentsNotAvailablePreferences")
-    r = generic_not_available_preferences(tt, tt.groups.all(), 'ConstraintStudentsSetNotAvailableTimes', 'Students')
+    yield from generic_not_available_preferences(ctx, ctx.group_ids, _group_id_strings(ctx),
+                                                 ctx.group_time_preferences, ctx.group_tags,
+                                                 'ConstraintStudentsSetNotAvailableTimes', 'Students')
     logger.info("Exiting studentsNotAvailablePreferences")
-    return r
-
-
-def generic_value_preferences(preferenceset, objects, fet_constraint_names, fet_object):
-    l = []
-    for o in objects:
-        all_prefs = []
-        for p in o.value_preferences.filter(preferenceset=preferenceset):
-            all_prefs.append(p)
-        for tag in o.tags.all():
-            for p in timetable.models.TagValuePreference.objects.filter(tag=tag, preferenceset=preferenceset).all():
-                all_prefs.append(p)
+
+
+def _group_id_strings(ctx):
+    return {group_id: ctx.groups[group_id].short_name for group_id in ctx.group_ids}
+
+
+def generic_value_preferences(ctx, object_ids, id_strings, value_preferences, object_tags,
+                              fet_constraint_names, fet_object):
+    tag_preferences = defaultdict(list)
+    for p in ctx.tag_value_preferences:
+        tag_preferences[p.owner_id].append(p)
+    for o in object_ids:
+        all_prefs = list(value_preferences[o])
+        for tag in object_tags[o]:
+            all_prefs += tag_preferences[tag]
         for p in all_prefs:
             fet_name, fet_val = fet_constraint_names.get(p.name, (None, None))
             if fet_name is not None:
-                l.append([fet_name, None, [
-                    ['Weight_Percentage', str(int(p.adjustedWeight() * 100))],
-                    [fet_object, o.id_string()],
-                    [fet_val, str(p.value)]]])
-    return l
+                yield [fet_name, None, [
+                    ['Weight_Percentage', str(int(p.adjusted_weight * 100))],
+                    [fet_object, id_strings[o]],
+                    [fet_val, str(p.value)]]]
 
 
-def teacher_value_time_preferences(timetable):
+def teacher_value_time_preferences(ctx):
     logger.info("Entering teacherValueTimePreferences")
     fet_constraint_names = {
         'MAXDAYSWEEK': ('ConstraintTeacherMaxDaysPerWeek', 'Max_Days_Per_Week'),
@@ -592,13 +644,12 @@ def teacher_value_time_preferences(timetable):
         # 'MAXCHANGESWEEK': 'Max building changes per week'),
         # 'MAXCHANGESDAY': 'Max building changes per day'),
     }
-    r = generic_value_preferences(timetable.preferenceset, timetable.teachers.all(), fet_constraint_names,
-                                  'Teacher_Name')
+    yield from generic_value_preferences(ctx, ctx.teacher_ids, ctx.teachers, ctx.teacher_value_preferences,
+                                         ctx.teacher_tags, fet_constraint_names, 'Teacher_Name')
     logger.info("Exiting teacherValueTimePreferences")
-    return r
 
 
-def students_value_time_preferences(timetable):
+def students_value_time_preferences(ctx):
     fet_constraint_names = {
         'MAXDAYSWEEK': ('ConstraintStudentsSetMaxDaysPerWeek', 'Max_Days_Per_Week'),
         'MINDAYSWEEK': ('ConstraintStudentsSetMinDaysPerWeek', 'Min_Days_Per_Week'),
@@ -610,41 +661,38 @@ def students_value_time_preferences(timetable):
         # 'MAXCHANGESWEEK': 'Max building changes per week'),
         # 'MAXCHANGESDAY': 'Max building changes per day'),
     }
-    return generic_value_preferences(timetable.preferenceset, timetable.groups.all(), fet_constraint_names, 'Students')
+    return generic_value_preferences(ctx, ctx.group_ids, _group_id_strings(ctx), ctx.group_value_preferences,
+                                     ctx.group_tags, fet_constraint_names, 'Students')
+
 
+def _add_preferred_times(prefs, name, p):
+    if name not in prefs:
+        prefs[name] = dict()
+    w = p.adjusted_weight
+    if w not in prefs[name]:
+        prefs[name][w] = dict()
+    day = WEEKDAY_NAMES[p.day]
+    if day not in prefs[name][w]:
+        prefs[name][w][day] = set()
+    for h in p.hours():
+        prefs[name][w][day].add(h)
 
-def teacher_time_preferences_to_preferred_times(tt):
+
+def teacher_time_preferences_to_preferred_times(ctx):
     logger.info("Entering teacherTimePreferencesToPreferredTimes")
-    logger.debug("TT: {}".format(tt))
     prefs = dict()
-    for t in tt.teachers.all():
-        logger.debug("Processing {}".format(t))
-        id_string = t.id_string()
-        for p in t.time_preferences.filter(preferenceset=tt.preferenceset, level='WANT'):
+    tag_preferences = _tag_time_preferences(ctx, ['WANT'], ctx.preferenceset_id)
+    for t in ctx.teacher_ids:
+        logger.debug("Processing {}".format(ctx.teachers[t]))
+        id_string = ctx.teachers[t]
+        for p in ctx.teacher_time_preferences[t]:
+            if p.level != 'WANT':
+                continue
             logger.debug("Processing preference: {}".format(p))
-            if id_string not in prefs:
-                prefs[id_string] = dict()
-            w = p.adjustedWeight()
-            if w not in prefs[id_string]:
-                prefs[id_string][w] = dict()
-            day = p.get_day_display()
-            if day not in prefs[id_string][w]:
-                prefs[id_string][w][day] = set()
-            for h in p.hours():
-                prefs[id_string][w][day].add(h)
-        for p in timetable.models.TagTimePreference.objects.filter(preferenceset__timetable=tt, level='WANT',
-                                                                   tag__teachers=t).distinct():
-            if id_string not in prefs:
-                prefs[id_string] = dict()
-            w = p.adjustedWeight()
-            if w not in prefs[id_string]:
-                prefs[id_string][w] = dict()
-            day = p.get_day_display()
-            if day not in prefs[id_string][w]:
-                prefs[id_string][w][day] = set()
-            for h in p.hours():
-                prefs[id_string][w][day].add(h)
-    l = []
+            _add_preferred_times(prefs, id_string, p)
+        for p in sorted((p for tag in ctx.teacher_tags[t] for p in tag_preferences[tag]),
+                        key=lambda p: p.id):
+            _add_preferred_times(prefs, id_string, p)
     for (teacher, i) in prefs.items():
         for (w, j) in i.items():
             time_slots = []
@@ -653,34 +701,23 @@ def teacher_time_preferences_to_preferred_times(tt):
                     time_slots.append(['Preferred_Time_Slot', None, [
                         ['Preferred_Day', day],
                         ['Preferred_Hour', h]]])
-            l.append(['ConstraintActivitiesPreferredTimeSlots', None, [
+            yield ['ConstraintActivitiesPreferredTimeSlots', None, [
                 ['Weight_Percentage', str(100 * w)],
                 ['Teacher_Name', teacher],
                 ['Students_Name', None],
                 ['Activity_Tag_Name', None],
-            ] + add_number_of(time_slots, 'Number_of_Preferred_Time_Slots')])
+            ] + add_number_of(time_slots, 'Number_of_Preferred_Time_Slots')]
     logger.info("Exiting teacherTimePreferencesToPreferredTimes")
-    return l
 
 
-def tag_time_preferences_to_preferred_times(tt):
+def tag_time_preferences_to_preferred_times(ctx):
     prefs = dict()
-    for p in timetable.models.TagTimePreference.objects.filter(Q(preferenceset__timetable=tt) &
-                                                               Q(level='WANT') & (
-                                                                       Q(tag__activities__activityset__timetable=tt) |
-                                                                       Q(
-                                                                           tag__activity_realizations__activity__activityset__timetable=tt))).distinct():
-        if p.tag.name not in prefs:
-            prefs[p.tag.name] = dict()
-        w = p.adjustedWeight()
-        if w not in prefs[p.tag.name]:
-            prefs[p.tag.name][w] = dict()
-        day = p.get_day_display()
-        if day not in prefs[p.tag.name][w]:
-            prefs[p.tag.name][w][day] = set()
-        for h in p.hours():
-            prefs[p.tag.name][w][day].add(h)
-    l = []
+    for p in ctx.tag_time_preferences:
+        if p.level != 'WANT' or p.preferenceset_id != ctx.preferenceset_id:
+            continue
+        if not (ctx.tag_activities.get(p.owner_id) or ctx.tag_realizations.get(p.owner_id)):
+            continue
+        _add_preferred_times(prefs, ctx.tags[p.owner_id], p)
     for (tag, i) in prefs.items():
         for (w, j) in i.items():
             time_slots = []
@@ -689,312 +726,513 @@ def tag_time_preferences_to_preferred_times(tt):
                     time_slots.append(['Preferred_Time_Slot', None, [
                         ['Preferred_Day', day],
                         ['Preferred_Hour', h]]])
-            l.append(['ConstraintActivitiesPreferredTimeSlots', None, [
+            yield ['ConstraintActivitiesPreferredTimeSlots', None, [
                 ['Weight_Percentage', str(100 * w)],
                 ['Teacher_Name', None],
                 ['Students_Name', None],
                 ['Activity_Tag_Name', tag],
-            ] + add_number_of(time_slots, 'Number_of_Preferred_Time_Slots')])
-    return l
-
-
-def min_gaps_between_activities(tt):
-    l = []
-    for p in timetable.models.TagValuePreference.objects.filter(Q(preferenceset__timetable=tt) &
-                                                                # Q(level='WANT', name='MINACTIVITYGAP') & (Q(tag__activities__activityset__timetable = tt) |
-                                                                # Q(tag__activity_realizations__activity__activityset__timetable = tt))).distinct():
-                                                                Q(level='WANT', name='MINACTIVITYGAP')).distinct():
-        realizations = tt.realizations.filter(Q(activity__tags__exact=p.tag) |
-                                              Q(tags__exact=p.tag)).distinct()
-        if len(realizations) > 0:
-            act_list = [['Activity_Id', str(r.id)] for r in realizations]
-            l.append(['ConstraintMinGapsBetweenActivities', None, [
-                ['Weight_Percentage', str(100 * p.adjustedWeight())]] +
-                      add_number_of(act_list, 'Number_of_Activities') +
-                      [['MinGaps', str(p.value)]]])
-    return l
-
-
-def activity_ends_students_day(tt):
-    l = []
-    for p in timetable.models.TagDescriptivePreference.objects.filter(Q(preferenceset__timetable=tt) &
-                                                                      # Q(level='WANT', name='MINACTIVITYGAP') & (Q(tag__activities__activityset__timetable = tt) |
-                                                                      # Q(tag__activity_realizations__activity__activityset__timetable = tt))).distinct():
-                                                                      Q(level='WANT',
-                                                                        typename='ENDSSTUDENTSDAY')).distinct():
-        realizations = tt.realizations.filter(Q(activity__tags__exact=p.tag) |
-                                              Q(tags__exact=p.tag)).distinct()
+            ] + add_number_of(time_slots, 'Number_of_Preferred_Time_Slots')]
+
+
+def min_gaps_between_activities(ctx):
+    for p in ctx.tag_value_preferences:
+        if p.level != 'WANT' or p.name != 'MINACTIVITYGAP':
+            continue
+        realizations = ctx.tagged_realization_ids(p.owner_id)
         if len(realizations) > 0:
-            for r in realizations:
-                l.append(['ConstraintActivityEndsStudentsDay', None, [
-                    ['Weight_Percentage', str(100 * p.weight)],
-                    ['Activity_Id', str(r.id)],
-                    ['Active', 'true'],
-                    ['Comments', ''], ]
-                          ])
-    return l
-
-
-def time_constraints_fet(timetable, groupset, razor, razor_dict, allocation_weights, skip_pairs):
-    l = [
-        'Time_Constraints_List', None,
-        [['ConstraintBasicCompulsoryTime', None,
-          [['Weight_Percentage', '100']]]] +
-        teacher_not_available_preferences(timetable) +
-        respected_to_teachers_not_available(timetable) +
-        allocations_to_preferred_times(timetable, allocation_weights) +
-        tag_time_preferences_to_preferred_times(timetable) +
-        teacher_time_preferences_to_preferred_times(timetable) +
-        activities_ordered(timetable) +
-        activities_not_overlapping(timetable) +
-        crossections.realizations_must_not_overlap_database(
-            timetable, razor=razor, razor_dict=razor_dict,
-            groupset=groupset, skip_pairs=skip_pairs) +
-        students_not_available_preferences(timetable) +
-        respected_to_students_not_available(timetable) +
-        teacher_value_time_preferences(timetable) +
-        students_value_time_preferences(timetable) +
-        min_gaps_between_activities(timetable) +
-        activity_ends_students_day(timetable) +
-        activities_consecutive(timetable) +
-        activities_grouped(timetable) +
-        activities_same_day(timetable) +
-        activities_same_time(timetable) +
-        activities_tag_max_hour_daily(timetable)
+            act_list = [['Activity_Id', str(r)] for r in realizations]
+            yield ['ConstraintMinGapsBetweenActivities', None, [
+                ['Weight_Percentage', str(100 * p.adjusted_weight)]] +
+                add_number_of(act_list, 'Number_of_Activities') +
+                [['MinGaps', str(p.value)]]]
+
+
+def activity_ends_students_day(ctx):
+    for p in ctx.tag_descriptive_preferences:
+        if p.level != 'WANT' or p.typename != 'ENDSSTUDENTSDAY':
+            continue
+        for r in ctx.tagged_realization_ids(p.owner_id):
+            yield ['ConstraintActivityEndsStudentsDay', None, [
+                ['Weight_Percentage', str(100 * p.weight)],
+                ['Activity_Id', str(r)],
+                ['Active', 'true'],
+                ['Comments', ''], ]
+            ]
+
+
+def realizations_not_overlapping(ctx, razor, razor_dict, skip_pairs):
+    realizations, matrix = ctx.realization_students
+    return crossections.not_overlapping_constraints(
+        realizations, matrix, razor=razor, razor_dict=razor_dict,
+        skip_pairs=skip_pairs)
+
+
+def basic_compulsory_time(ctx):
+    yield ['ConstraintBasicCompulsoryTime', None,
+           [['Weight_Percentage', '100']]]
+
+
+def time_constraint_generators(razor, razor_dict, skip_pairs):
+    """
+    Return (name, generator) pairs of time constraints in the order they
+    are written. Generators are called with the ExportContext.
+    """
+    return [
+        ('basic_compulsory_time', basic_compulsory_time),
+        ('teacher_not_available_preferences', teacher_not_available_preferences),
+        ('respected_to_teachers_not_available', respected_to_teachers_not_available),
+        ('allocations_to_preferred_times', allocations_to_preferred_times),
+        ('tag_time_preferences_to_preferred_times', tag_time_preferences_to_preferred_times),
+        ('teacher_time_preferences_to_preferred_times', teacher_time_preferences_to_preferred_times),
+        ('activities_ordered', activities_ordered),
+        ('activities_not_overlapping', activities_not_overlapping),
+        ('realizations_not_overlapping', partial(realizations_not_overlapping, razor=razor,
+                                                 razor_dict=razor_dict, skip_pairs=skip_pairs)),
+        ('students_not_available_preferences', students_not_available_preferences),
+        ('respected_to_students_not_available', respected_to_students_not_available),
+        ('teacher_value_time_preferences', teacher_value_time_preferences),
+        ('students_value_time_preferences', students_value_time_preferences),
+        ('min_gaps_between_activities', min_gaps_between_activities),
+        ('activity_ends_students_day', activity_ends_students_day),
+        ('activities_consecutive', activities_consecutive),
+        ('activities_grouped', activities_grouped),
+        ('activities_same_day', activities_same_day),
+        ('activities_same_time', activities_same_time),
+        ('activities_tag_max_hour_daily', activities_tag_max_hour_daily),
     ]
-    return l2El(l)
 
 
-def timetable_to_rooms_not_available(timetable, activity=None):
+def time_constraints_fet(ctx, razor, razor_dict, skip_pairs, jobs=1, timings=None):
+    generators = time_constraint_generators(razor, razor_dict, skip_pairs)
+    return chain.from_iterable(run_generators(ctx, generators, jobs, timings))
+
+
+def _timetable_allocations(ctx, timetable_id):
+    return [a for a in ctx.allocations.values() if a.timetable_id == timetable_id]
+
+
+def timetable_to_rooms_not_available(ctx, timetable_id, classroom_ids):
     logger.info("Entering timetableToRoomsNotAvailable")
-    logger.debug("Processing timetable {}".format(timetable))
-    if activity is None:
-        logger.debug("Activity is none")
-        allocations = timetable.own_allocations.all()
-    else:
-        allocations = timetable.own_allocations.filter(activityRealization__activity=activity)
-    logger.debug("Allocations: {}".format(allocations))
-    r = []
-    for room in timetable.classrooms.all():
-        logger.debug("Processing room {}".format(room))
+    logger.debug("Processing timetable {}".format(timetable_id))
+    allocations = _timetable_allocations(ctx, timetable_id)
+    for room in classroom_ids:
+        logger.debug("Processing room {}".format(ctx.classrooms[room].short_name))
         l = []
-        for i in allocations.filter(classroom=room):
-            logger.debug("Processing allocation {}".format(i))
+        for i in allocations:
+            if i.classroom_id != room:
+                continue
+            logger.debug("Processing allocation {}".format(i.id))
             for hour in i.hours:
                 logger.debug("Not available hour: {}".format(hour))
                 l.append(['Not_Available_Time', None, [
-                    ['Day', i.get_day_display()],
+                    ['Day', WEEKDAY_NAMES[i.day]],
                     ['Hour', hour],
                 ]])
         if len(l) > 0:
             logger.debug("Number of not available times: {}".format(len(l)))
             l = add_number_of(l, 'Number_of_Not_Available_Times')
-            r.append(['ConstraintRoomNotAvailableTimes', None,
-                      [['Weight_Percentage', '100'], ['Room', room.short_name]] + l])
-    logger.debug("Returning {}".format(r))
+            yield ['ConstraintRoomNotAvailableTimes', None,
+                [['Weight_Percentage', '100'], ['Room', ctx.classrooms[room].short_name]] + l]
     logger.info("Exiting timetableToRoomsNotAvailable")
-    return r
-
-
-def timetable_to_students_not_available(timetable, groupset=None):
-    # print "DEBUG: rooms not available"
-    allocations = timetable.own_allocations.all()
-    if groupset is None:
-        groupset = timetable.groupset
-    r = []
-    # print "Timetable: {0}".format(timetable)
-    for group in groupset.groups.all():
-        # print "DEBUG: {0}".format(room)
+
+
+def timetable_to_students_not_available(ctx, timetable_id, group_ids):
+    allocations = _timetable_allocations(ctx, timetable_id)
+    for group in group_ids:
         l = []
-        for i in allocations.filter(activityRealization__groups=group):
+        for i in allocations:
+            if group not in ctx.realizations[i.realization_id].group_ids:
+                continue
             for hour in i.hours:
                 l.append(['Not_Available_Time', None, [
-                    ['Day', i.get_day_display()],
+                    ['Day', WEEKDAY_NAMES[i.day]],
                     ['Hour', hour],
                 ]])
         if len(l) > 0:
             l = add_number_of(l, 'Number_of_Not_Available_Times')
-            r.append(['ConstraintStudentsSetNotAvailableTimes', None,
-                      [['Weight_Percentage', '100'], ['Students', group.id_string()]] + l])
-    return r
+            yield ['ConstraintStudentsSetNotAvailableTimes', None,
+                [['Weight_Percentage', '100'], ['Students', ctx.groups[group].short_name]] + l]
 
 
-def timetable_to_teachers_not_available(timetable, teachers=None):
+def timetable_to_teachers_not_available(ctx, timetable_id, teacher_ids):
     logger.info("Entering timetableToTeachersNotAvailable")
-    logger.debug("TT: {}".format(timetable))
-    logger.debug("Teachers: {}".format(teachers))
-    allocations = timetable.own_allocations.all()
-    if teachers is None:
-        teachers = timetable.teachers
-    r = []
-    for teacher in teachers.all():
-        logger.debug("Processing {}".format(teacher))
+    logger.debug("TT: {}".format(timetable_id))
+    logger.debug("Teachers: {}".format(teacher_ids))
+    allocations = _timetable_allocations(ctx, timetable_id)
+    for teacher in teacher_ids:
+        logger.debug("Processing {}".format(ctx.teachers[teacher]))
         l = []
-        for i in allocations.filter(activityRealization__teachers=teacher).distinct():
+        for i in allocations:
+            if teacher not in ctx.realizations[i.realization_id].teacher_ids:
+                continue
             for hour in i.hours:
                 l.append(['Not_Available_Time', None, [
-                    ['Day', i.get_day_display()],
+                    ['Day', WEEKDAY_NAMES[i.day]],
                     ['Hour', hour],
                 ]])
         if len(l) > 0:
             l = add_number_of(l, 'Number_of_Not_Available_Times')
-            r.append(['ConstraintTeacherNotAvailableTimes', None,
-                      [['Weight_Percentage', '100'], ['Teacher', teacher.id_string()]] + l])
+            yield ['ConstraintTeacherNotAvailableTimes', None,
+                [['Weight_Percentage', '100'], ['Teacher', ctx.teachers[teacher]]] + l]
     logger.info("Exiting timetableToTeachersNotAvailable")
-    return r
-
-
-def activity_requirements_to_preferred_rooms(timetable):
-    l = []
-    # for a in Activity.objects.filter(timetable__exact = timetable):
-    for ia in timetable.activities.distinct().all():
-        # print ia.id, ia
-        # print ia.activity
-        a = ia.activity
-        for ar in a.realizations.all():
-            # for tmp in bmri.children(): bolonjaPodiplomci = bolonjaPodiplomci or tmp in ar.groups.all()
+
+
+def activity_requirements_to_preferred_rooms(ctx):
+    shrink_ammounts = _shrink_ammounts(ctx)
+    for ia in ctx.activity_ids:
+        a = ctx.activities[ia]
+        for ar in a.realization_ids:
             lr = []
-            n_students = _shrunken_students(timetable, ar)
-            for r in ar.preferred_rooms(timetable, n_students).distinct():
+            n_students = _shrunken_students(ctx, ar, shrink_ammounts)
+            for r in ctx.preferred_rooms(ar, n_students):
                 #    if r.short_name != "Eles" or bolonjaPodiplomci:  # Ugly hack
                 lr.append(['Preferred_Room', r.short_name])
 
-            #            if ar.id == 2407:
-            #            print "GREGOR:", a.id , a.subject.code, a.preferred_rooms(timetable).distinct()
-            #            print len(lr), lr
-
-            # print "" + a.name + ", "  + str(lr)
             if len(lr) > 1:
-                l.append(['ConstraintActivityPreferredRooms', None, [
+                yield ['ConstraintActivityPreferredRooms', None, [
                     ['Weight_Percentage', '100'],
-                    ['Activity_Id', str(ar.id)]] + add_number_of(lr, 'Number_of_Preferred_Rooms')])
+                    ['Activity_Id', str(ar)]] + add_number_of(lr, 'Number_of_Preferred_Rooms')]
             elif len(lr) == 1:
-                l.append(['ConstraintActivityPreferredRoom', None, [
+                yield ['ConstraintActivityPreferredRoom', None, [
                     ['Weight_Percentage', '100'],
-                    ['Activity_Id', str(ar.id)],
+                    ['Activity_Id', str(ar)],
                     ['Room', lr[0][1]],
-                    ['Permanently_Locked', 'true']]])
+                    ['Permanently_Locked', 'true']]]
             elif len(lr) == 0:
                 raise Exception(
                     "No prefered room for ActivityRealization id {0} - {1} \n    size:{2}\n     requirements:{3}\n    NRequirements:{4})".format(
-                        ar.id, ar, ar.size, a.requirements.all(), a.requirements_per_student.all()))
-    return l
+                        ar, a.name, ctx.realization_size(ar), a.requirement_ids, a.n_requirements))
 
 
-def allocations_to_preferred_room(timetable, allocationWeights):
-    l = []
+def allocations_to_preferred_room(ctx):
     aw = dict()
-    for f, (t_weight, s_weight) in allocationWeights.items():
-        for a in timetable.own_allocations.filter(**dict(f)).distinct():
-            w = max(s_weight, aw.get(a, s_weight))
+    for allocation_ids, t_weight, s_weight in ctx.allocation_filters:
+        for a in allocation_ids:
             aw[a] = s_weight
     for (a, w) in aw.items():
         if w > 0:
-            l.append(['ConstraintActivityPreferredRoom', None, [
+            a = ctx.allocations[a]
+            yield ['ConstraintActivityPreferredRoom', None, [
                 ['Weight_Percentage', str(100 * w)],
-                ['Activity_Id', str(a.activityRealization.id)],
-                ['Room', a.classroom.short_name],
-                ['Permanently_Locked', 'false']]])
-    return l
+                ['Activity_Id', str(a.realization_id)],
+                ['Room', ctx.classrooms[a.classroom_id].short_name],
+                ['Permanently_Locked', 'false']]]
 
 
-def teacher_value_space_preferences(tt):
+def teacher_value_space_preferences(ctx):
     fet_constraint_names = {
         'MAXCHANGESWEEK': ('ConstraintTeacherMaxBuildingChangesPerWeek', 'Max_Building_Changes_Per_Week'),
         'MAXCHANGESDAY': ('ConstraintTeacherMaxBuildingChangesPerDay', 'Max_Building_Changes_Per_Day'),
         'MINCHANGEGAP': ('ConstraintTeacherMinGapsBetweenBuildingChanges', 'Min_Gaps_Between_Building_Changes'),
     }
-    return generic_value_preferences(tt.preferenceset, tt.teachers.all(), fet_constraint_names, 'Teacher')
+    return generic_value_preferences(ctx, ctx.teacher_ids, ctx.teachers, ctx.teacher_value_preferences,
+                                     ctx.teacher_tags, fet_constraint_names, 'Teacher')
 
 
-def students_value_space_preferences(tt):
+def students_value_space_preferences(ctx):
     fet_constraint_names = {
         'MAXCHANGESWEEK': ('ConstraintStudentsSetMaxBuildingChangesPerWeek', 'Max_Building_Changes_Per_Week'),
         'MAXCHANGESDAY': ('ConstraintStudentsSetMaxBuildingChangesPerDay', 'Max_Building_Changes_Per_Day'),
         'MINCHANGEGAP': ('ConstraintStudentsSetMinGapsBetweenBuildingChanges', 'Min_Gaps_Between_Building_Changes'),
     }
-    return generic_value_preferences(tt.preferenceset, tt.groups.all(), fet_constraint_names, 'Students')
+    return generic_value_preferences(ctx, ctx.group_ids, _group_id_strings(ctx), ctx.group_value_preferences,
+                                     ctx.group_tags, fet_constraint_names, 'Students')
 
 
-def respected_to_rooms_not_available(timetable):
-    # print "DEBUG: resp ectedToRoomsNotAvailable {0}".format(timetable)
+def respected_to_rooms_not_available(ctx):
     logger.info("Processing respectedRoomsNotAvailable")
-    logger.debug("{}".format(timetable.respects.all()))
-    l = []
-    for j in timetable.respects.all():
-        logger.debug("Processing timetable {}".format(j))
-        for i in timetable_to_rooms_not_available(j):
+    for j in ctx.respected:
+        logger.debug("Processing timetable {}".format(j.id))
+        for i in timetable_to_rooms_not_available(ctx, j.id, j.classroom_ids):
             logger.debug("Got {0}".format(i))
-            l.append(i)
-    logger.debug("Returning {}".format(l))
-    return l
+            yield i
 
 
-def respected_to_students_not_available(timetable):
-    l = []
-    for j in timetable.respects.all():
-        for i in timetable_to_students_not_available(j, groupset=timetable.groupset):
-            l.append(i)
-    return l
+def respected_to_students_not_available(ctx):
+    for j in ctx.respected:
+        for i in timetable_to_students_not_available(ctx, j.id, ctx.group_ids):
+            yield i
 
 
-def respected_to_teachers_not_available(timetable):
+def respected_to_teachers_not_available(ctx):
     logger.info("Entering respectedToTeachersNotAvailable")
-    l = []
-    for j in timetable.respects.all():
-        logger.debug("Processing timetable {}".format(j))
-        for i in timetable_to_teachers_not_available(j):
+    for j in ctx.respected:
+        logger.debug("Processing timetable {}".format(j.id))
+        for i in timetable_to_teachers_not_available(ctx, j.id, j.teacher_ids):
             logger.debug("Appending {}".format(i))
-            l.append(i)
+            yield i
     logger.info("Exiting respectedToTeachersNotAvailable")
-    return l
 
 
-def space_constraints_fet(tt, allocationWeights):
+def basic_compulsory_space(ctx):
+    yield ['ConstraintBasicCompulsorySpace', None, [['Weight_Percentage', '100']]]
+
+
+def space_constraint_generators():
+    """
+    Return (name, generator) pairs of space constraints in the order they
+    are written. Generators are called with the ExportContext.
+    """
+    return [
+        ('basic_compulsory_space', basic_compulsory_space),
+        ('teacher_value_space_preferences', teacher_value_space_preferences),
+        ('respected_to_rooms_not_available', respected_to_rooms_not_available),
+        ('activity_requirements_to_preferred_rooms', activity_requirements_to_preferred_rooms),
+        ('allocations_to_preferred_room', allocations_to_preferred_room),
+        ('students_value_space_preferences', students_value_space_preferences),
+        ('activitiesMaxNumberOfRooms', activitiesMaxNumberOfRooms),
+    ]
+
+
+def space_constraints_fet(ctx, jobs=1, timings=None):
     logger.info("Entering spaceConstraintsFet")
-    l = ['Space_Constraints_List', None,
-         [['ConstraintBasicCompulsorySpace', None, [['Weight_Percentage', '100']]]] +
-         teacher_value_space_preferences(tt) +
-         respected_to_rooms_not_available(tt) +
-         activity_requirements_to_preferred_rooms(tt) +
-         allocations_to_preferred_room(tt, allocationWeights) +
-         students_value_space_preferences(tt) +
-         activitiesMaxNumberOfRooms(tt)
-         ]
-    logger.info("Exiting spaceConstraintsFet")
-    return l2El(l)
-
-
-def generate_fet(tt, groupset, razor, razor_dict=None,
-                 allocation_weights={".*": (1.0, 1.0)},
+    return chain.from_iterable(run_generators(ctx, space_constraint_generators(), jobs, timings))
+
+
+def fet_sections(razor, razor_dict, skip_pairs, disabled_types):
+    """
+    Return (tag, [(name, generator), ...]) pairs of the sections of the FET
+    document generated from the ExportContext, in the order they are written.
+    """
+    return [
+        ('Students_List', [('students', student_year_fet)]),
+        ('Teachers_List', [('teachers', teachers_fet)]),
+        ('Subjects_List', [('subjects', subjects_fet)]),
+        ('Activity_Tags_List', [('activity_tags', activity_tags)]),
+        ('Activities_List', [('activities', partial(activities_fet, disabled_types=disabled_types))]),
+        ('Buildings_List', [('buildings', buildings_fet)]),
+        ('Rooms_List', [('rooms', room_fet)]),
+        ('Time_Constraints_List', time_constraint_generators(razor, razor_dict, skip_pairs)),
+        ('Space_Constraints_List', space_constraint_generators()),
+    ]
+
+
+_TEACHER_PREFERENCES = ('teacher_ids', 'teachers', 'teacher_tags')
+_GROUP_PREFERENCES = ('group_ids', 'groups', 'group_tags')
+_TAGGED_REALIZATIONS = ('tag_activities', 'tag_realizations', 'activities')
+
+# Attributes of the ExportContext each generator reads. Rendered fragments
+# are cached by them (see FragmentCache), so they have to be kept in sync
+# with the generators.
+GENERATOR_INPUTS = {
+    'students': ('groups', 'group_ids'),
+    'teachers': ('teacher_ids', 'teachers'),
+    'subjects': ('subjects',),
+    'activity_tags': ('tag_activities', 'tag_realizations', 'tags'),
+    'activities': ('activity_ids', 'activities', 'realizations', 'teachers', 'subjects', 'groups', 'tags',
+                   'activity_tags', 'realization_tags', 'tag_value_preferences'),
+    'buildings': ('locations',),
+    'rooms': ('classroom_ids', 'classrooms', 'locations'),
+    'basic_compulsory_time': (),
+    'teacher_not_available_preferences': _TEACHER_PREFERENCES + ('teacher_time_preferences',
+                                                                 'tag_time_preferences'),
+    'respected_to_teachers_not_available': ('respected', 'allocations', 'realizations', 'teachers'),
+    'allocations_to_preferred_times': ('allocation_filters', 'allocations'),
+    'tag_time_preferences_to_preferred_times': ('preferenceset_id', 'tag_time_preferences', 'tag_activities',
+                                                'tag_realizations', 'tags'),
+    'teacher_time_preferences_to_preferred_times': _TEACHER_PREFERENCES + (
+        'preferenceset_id', 'teacher_time_preferences', 'tag_time_preferences'),
+    'activities_ordered': ('activity_ids', 'before', 'activities'),
+    'activities_not_overlapping': ('activity_ids', 'must_not_overlap', 'tag_descriptive_preferences') +
+                                  _TAGGED_REALIZATIONS,
+    'realizations_not_overlapping': ('realization_students',),
+    'students_not_available_preferences': _GROUP_PREFERENCES + ('group_time_preferences', 'tag_time_preferences'),
+    'respected_to_students_not_available': ('respected', 'group_ids', 'groups', 'allocations', 'realizations'),
+    'teacher_value_time_preferences': _TEACHER_PREFERENCES + ('teacher_value_preferences', 'tag_value_preferences'),
+    'students_value_time_preferences': _GROUP_PREFERENCES + ('group_value_preferences', 'tag_value_preferences'),
+    'min_gaps_between_activities': ('tag_value_preferences',) + _TAGGED_REALIZATIONS,
+    'activity_ends_students_day': ('tag_descriptive_preferences',) + _TAGGED_REALIZATIONS,
+    'activities_consecutive': ('tag_descriptive_preferences',) + _TAGGED_REALIZATIONS,
+    'activities_grouped': ('tag_descriptive_preferences',) + _TAGGED_REALIZATIONS,
+    'activities_same_day': ('tag_descriptive_preferences',) + _TAGGED_REALIZATIONS,
+    'activities_same_time': ('tag_descriptive_preferences',) + _TAGGED_REALIZATIONS,
+    'activities_tag_max_hour_daily': ('tag_value_preferences', 'tag_groups', 'groups', 'tags'),
+    'basic_compulsory_space': (),
+    'teacher_value_space_preferences': _TEACHER_PREFERENCES + ('teacher_value_preferences', 'tag_value_preferences'),
+    'respected_to_rooms_not_available': ('respected', 'allocations', 'classrooms'),
+    'activity_requirements_to_preferred_rooms': ('activity_ids', 'activities', 'realizations', 'groups',
+                                                 'activity_tags', 'realization_tags', 'tag_value_preferences',
+                                                 'classroom_ids', 'classrooms'),
+    'allocations_to_preferred_room': ('allocation_filters', 'allocations', 'classrooms'),
+    'students_value_space_preferences': _GROUP_PREFERENCES + ('group_value_preferences', 'tag_value_preferences'),
+    'activitiesMaxNumberOfRooms': ('tag_value_preferences',) + _TAGGED_REALIZATIONS,
+}
+
+_code_digest = None
+
+
+def code_digest():
+    """
+    Return the digest of the source of the export, so cached fragments are
+    regenerated when the generators change.
+    """
+    global _code_digest
+    if _code_digest is None:
+        h = hashlib.sha256()
+        for module in [sys.modules[__name__], friprosveta.export, crossections]:
+            with open(module.__file__, 'rb') as f:
+                h.update(f.read())
+        _code_digest = h.hexdigest()
+    return _code_digest
+
+
+def fragment_key(ctx, name, generator, writer):
+    """
+    Return the key of the fragment rendered by the generator into the
+    currently open element of the writer.
+    """
+    parameters = sorted(getattr(generator, 'keywords', {}).items())
+    return ctx.digest(GENERATOR_INPUTS[name], code_digest(), name, parameters, writer.pretty, writer.depth)
+
+
+def write_cached(writer, ctx, generators, cache, jobs=1, timings=None):
+    """
+    Write the fragments of the (name, generator) pairs into the currently
+    open element of the writer. Fragments are read from the FragmentCache
+    cache, only the missing ones are generated (see run_generators).
+    """
+    keys = [fragment_key(ctx, name, generator, writer) for name, generator in generators]
+    fragments = [cache.get(key) for key in keys]
+    missing = [generators[i] for i, fragment in enumerate(fragments) if fragment is None]
+    regenerated = run_generators(ctx, missing, jobs, timings, partial(writer.fragment, depth=writer.depth))
+    for (name, _), key, fragment in zip(generators, keys, fragments):
+        if fragment is None:
+            fragment = next(regenerated)
+            cache.set(key, fragment)
+            cache.regenerated.append(name)
+        else:
+            cache.cached.append(name)
+        writer.raw(fragment)
+
+
+# Context, generators and render function of the worker process, see _init_worker
+_ctx = None
+_generators = None
+_render = None
+
+
+def _init_worker(ctx, generators, render):
+    global _ctx, _generators, _render
+    _ctx = ctx
+    _generators = generators
+    _render = render
+
+
+def _generate(index):
+    start = time.perf_counter()
+    elements = _render(_generators[index][1](_ctx))
+    return elements, time.perf_counter() - start
+
+
+def _timed(elements, name, timings):
+    """
+    Yield elements and add the time spent generating them to timings[name].
+    """
+    elements = iter(elements)
+    timings[name] = 0.0
+    while True:
+        start = time.perf_counter()
+        element = next(elements, None)
+        timings[name] += time.perf_counter() - start
+        if element is None:
+            return
+        yield element
+
+
+def run_generators(ctx, generators, jobs=1, timings=None, render=list):
+    """
+    Return the iterator over the elements of each of the (name, generator)
+    pairs in turn, rendered by the render function (for instance
+    FetWriter.fragment). With more than one job the generators start running
+    in a pool of worker processes right away and their elements are yielded
+    in the same order as in a serial run. Seconds spent in each generator
+    are stored into the timings dict.
+    """
+    if timings is None:
+        timings = dict()
+    if jobs <= 1 or len(generators) <= 1:
+        return _run_serial(ctx, generators, timings, render)
+    # Workers are forked, so they get the context without pickling it
+    # and never touch the database
+    pool = multiprocessing.get_context('fork').Pool(min(jobs, len(generators)), _init_worker,
+                                                    (ctx, generators, render))
+    return _collect(pool, generators, pool.imap(_generate, range(len(generators))), timings)
+
+
+def _run_serial(ctx, generators, timings, render):
+    for name, generator in generators:
+        elements = _timed(generator(ctx), name, timings)
+        yield elements if render is list else render(elements)
+
+
+def _collect(pool, generators, results, timings):
+    with pool:
+        for (name, _), (elements, seconds) in zip(generators, results):
+            timings[name] = seconds
+            yield elements
+
+
+# Generators too large to be rendered in a worker process and sent back
+# as a whole, their elements are written as they are generated
+STREAMED_GENERATORS = {'realizations_not_overlapping'}
+
+
+def write_generated(writer, ctx, generators, jobs=1, timings=None):
+    """
+    Write the elements of the (name, generator) pairs into the currently
+    open element of the writer. With more than one job the workers return
+    rendered fragments (see run_generators), while STREAMED_GENERATORS run
+    in this process.
+    """
+    if timings is None:
+        timings = dict()
+    if jobs <= 1:
+        writer.elements(chain.from_iterable(run_generators(ctx, generators, 1, timings)))
+        return
+    pooled = [(name, generator) for name, generator in generators if name not in STREAMED_GENERATORS]
+    fragments = run_generators(ctx, pooled, jobs, timings, partial(writer.fragment, depth=writer.depth))
+    for name, generator in generators:
+        if name in STREAMED_GENERATORS:
+            writer.elements(_timed(generator(ctx), name, timings))
+        else:
+            writer.raw(next(fragments))
+
+
+def generate_fet(writer, ctx, razor, razor_dict=None,
                  skip_pairs=[],
-                 disabled_types=[]):
+                 disabled_types=[],
+                 jobs=1,
+                 timings=None,
+                 cache=None):
+    """
+    Write the FET document for the timetable of the ExportContext ctx
+    with the FetWriter writer. Constraints are generated in jobs processes
+    (see run_generators) and seconds spent in the generators are stored
+    into the timings dict. Sections are read from the FragmentCache cache
+    when it is given and their inputs did not change (see write_cached).
+    """
     logger.info("Entering generateFet")
-    logger.debug("TT: {0}".format(tt))
-    logger.debug("Groupset: {0}".format(groupset))
+    logger.debug("TT: {0}".format(ctx.slug))
     logger.debug("razor_dict: {0}".format(razor_dict))
-    logger.debug("allocationWeights: {0}".format(allocation_weights))
     logger.debug("Skip pairs: {0}".format(skip_pairs))
     logger.debug("Disabled types: {}".format(disabled_types))
-    fet = ET.Element('fet', version="5.11.0")
-    fet.append(l2El(['Institution_Name', 'FRI']))
-    fet.append(l2El(['Comments', "Fakulteta za računalništvo in informatiko"
-                                 " Univerze v Ljubljani"]))
+    writer.start('fet', version="5.11.0")
+    writer.element(['Institution_Name', 'FRI'])
+    writer.element(['Comments', "Fakulteta za računalništvo in informatiko"
+                                " Univerze v Ljubljani"])
     l = [['Name', i[0]] for i in timetable.models.WORKHOURS]
-    fet.append(l2El(['Hours_List', None, add_number_of(l, 'Number')]))
+    writer.element(['Hours_List', None, add_number_of(l, 'Number')])
     l = [['Name', i[1]] for i in timetable.models.WEEKDAYS]
-    fet.append(l2El(['Days_List', None, add_number_of(l, 'Number')]))
-    fet.append(student_year_fet(tt))
-    fet.append(teachers_fet(tt))
-    fet.append(subjects_fet(tt))
-    fet.append(activity_tags(tt))
-    fet.append(activities_fet(tt, disabled_types))
-    fet.append(buildings_fet())
-    fet.append(room_fet(tt))
-    fet.append(time_constraints_fet(tt, groupset, razor, razor_dict,
-                                    allocation_weights, skip_pairs))
-    fet.append(space_constraints_fet(tt, allocation_weights))
-    return fet
+    writer.element(['Days_List', None, add_number_of(l, 'Number')])
+    for tag, generators in fet_sections(razor, razor_dict, skip_pairs, disabled_types):
+        writer.start(tag)
+        if cache is None:
+            write_generated(writer, ctx, generators, jobs, timings)
+        else:
+            write_cached(writer, ctx, generators, cache, jobs, timings)
+        writer.end()
+    writer.end()
+    logger.info("Exiting generateFet")
 
 
 class Command(BaseCommand):
@@ -1011,7 +1249,14 @@ The filter is a regexp in the format used by your database.
 Example: 
 
 ./manage.py django2fet "2014_2015_zimski_letni" 3 .*_P 0.8 0.5 .*_LV 0.8 0.5 .*_AV 0.6 0.4
-./manage.py django2fet "2014_2015_zimski_letni" 2 '{"activityRealization__activity__name__regex":".*_P", "activityRealization__groups__name__contains":"1"}' 0.8 0.5 .*_LV 0.8 0.5 .*_AV 0.6 0.4"""
+./manage.py django2fet "2014_2015_zimski_letni" 2 '{"activityRealization__activity__name__regex":".*_P", "activityRealization__groups__name__contains":"1"}' 0.8 0.5 .*_LV 0.8 0.5 .*_AV 0.6 0.4
+
+With --jobs N constraints are generated in N worker processes. With -v 2
+the seconds spent in each generator are written to the standard error.
+
+With --cache DIR rendered sections are stored in DIR and later exports only
+regenerate sections whose inputs changed. Sections of earlier exports that
+this export did not use are removed from DIR."""
 
     def add_arguments(self, parser):
         parser.add_argument(
@@ -1031,6 +1276,23 @@ Example:
             'filters', nargs='*',
             type=str,
         )
+        parser.add_argument(
+            '--output', '-o',
+            type=str,
+            default=None,
+            help='Write the FET file here instead of to the standard output.')
+        parser.add_argument(
+            '--compact',
+            action='store_true',
+            help='Do not indent the FET file.')
+        parser.add_argument(
+            '--jobs', type=int, default=1,
+            help='Number of worker processes generating constraints.')
+        parser.add_argument(
+            '--cache',
+            type=str,
+            default=None,
+            help='Directory of cached sections of exports.')
 
     def handle(self, *args, **options):
         # print(options)
@@ -1065,14 +1327,39 @@ Example:
             for t in friprosveta.models.Timetable.objects.all():
                 print("    ", t.slug)
             exit(1)
-        # Skip pairs: which activity pairs to skip when checking for overlaps
-        fet = generate_fet(
-            timetable, groupset, razor=razor,
-            razor_dict=razor_dict,
-            allocation_weights=allocation_weights,
-            # skip_pairs=[('P', 'P')],
-            # disabled_types=['LV', 'AV'],
-        )
-        indent(fet)
-        # this is a workaround for Django's stdout.write being buggy.
-        self.stdout.write(ET.tostring(fet, encoding='UTF-8').decode('UTF-8'), ending=None)
+        if options['output'] is None:
+            output = None
+            write = partial(self.stdout.write, ending='')
+        else:
+            output = open(options['output'], 'w', encoding='utf-8')
+            write = output.write
+        timings = dict()
+        cache = None if options['cache'] is None else FragmentCache(options['cache'])
+        try:
+            start = time.perf_counter()
+            ctx = ExportContext.build(timetable, groupset, allocation_weights)
+            timings['context'] = time.perf_counter() - start
+            # Skip pairs: which activity pairs to skip when checking for overlaps
+            generate_fet(
+                FetWriter(write, pretty=not options['compact']),
+                ctx, razor=razor,
+                razor_dict=razor_dict,
+                jobs=max(1, options['jobs']),
+                timings=timings,
+                cache=cache,
+                # skip_pairs=[('P', 'P')],
+                # disabled_types=['LV', 'AV'],
+            )
+        finally:
+            if output is not None:
+                output.close()
+        if options['verbosity'] > 1:
+            for name, seconds in timings.items():
+                self.stderr.write("{}: {:.3f} s".format(name, seconds))
+        if cache is not None:
+            removed = cache.prune()
+        if cache is not None and options['verbosity'] > 0:
+            self.stderr.write("Sections: {} cached, {} regenerated, {} removed".format(
+                len(cache.cached), len(cache.regenerated), removed))
+            if cache.regenerated and options['verbosity'] > 1:
+                self.stderr.write("Regenerated: {}".format(", ".join(cache.regenerated)))
@@ -55,7 +55,8 @@ class Command(BaseCommand):
             ucitelji_mozne_alokacije[t1].count
 
         tt = allocations[0].timetable
-        proste_ure = {ucitelj: ucitelj.free_hours(tt, 0.5) for ucitelj in teachers}
+        zasedenost = Teacher.bulk_busy(tt, teachers)
+        proste_ure = {ucitelj: zasedenost.free_hours(ucitelj.id, 0.5) for ucitelj in teachers}
 
         alokacije_mozni_ucitelji = {alokacija: [ucitelj for ucitelj in teachers
                                                 if je_prost(ucitelj, alokacija, proste_ure)]
@@ -0,0 +1,54 @@
+import csv
+import json
+import os
+
+from django.core.management.base import BaseCommand
+
+from friprosveta.models import Timetable
+from friprosveta.quality import QualitySnapshot, report
+
+
+class Command(BaseCommand):
+    """
+    Measure the quality of timetables: student overlaps by study and
+    classyear, teacher gaps and days, classroom utilization and violated
+    time preferences of teachers and groups.
+    """
+    help = ('Usage:\n'
+            'timetable_quality [--jobs N] [--format json|csv] [--min-fill F] timetable_slug [timetable_slug ...]\n'
+            '\n'
+            'Several timetables (for instance imported FET outputs) can be\n'
+            'given to compare them. CSV output has one row per measured value.\n')
+
+    def add_arguments(self, parser):
+        parser.add_argument('timetable_slugs', nargs='+', type=str)
+        parser.add_argument('--jobs', type=int, default=os.cpu_count() or 1,
+                            help='Number of worker processes.')
+        parser.add_argument('--format', choices=['json', 'csv'], default='json')
+        parser.add_argument('--min-fill', type=float, default=0.5,
+                            help='Classrooms filled less than this are too big.')
+
+    def handle(self, *args, **options):
+        reports = dict()
+        for slug in options['timetable_slugs']:
+            tt = Timetable.objects.get(slug=slug)
+            snapshot = QualitySnapshot.build(tt, options['min_fill'])
+            reports[slug] = report(snapshot, max(1, options['jobs']))
+        if options['format'] == 'json':
+            self.stdout.write(json.dumps(reports, indent=2))
+        else:
+            self.write_csv(reports)
+
+    def write_csv(self, reports):
+        writer = csv.writer(self.stdout)
+        writer.writerow(['timetable', 'measure', 'name', 'value_name', 'value'])
+        for slug, r in reports.items():
+            for name, value in r['summary'].items():
+                writer.writerow([slug, 'summary', '', name, value])
+            for measure, rows in r.items():
+                if measure == 'summary':
+                    continue
+                for row in rows:
+                    for value_name, value in row.items():
+                        if value_name != 'name':
+                            writer.writerow([slug, measure, row['name'], value_name, value])
@@ -0,0 +1,71 @@
+# Generated by Django 2.1.1
+from collections import defaultdict
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def student_realization_links(student_groups, follows, realization_groups, group_groupsets):
+    """
+    Copy of friprosveta.models.student_realization_links at the time of the migration.
+    """
+    realization_groupsets = dict()
+    group_realizations = defaultdict(set)
+    for realization_id, group_id in realization_groups:
+        realization_groupsets[realization_id] = group_groupsets[group_id]
+        group_realizations[group_id].add(realization_id)
+    links = dict()
+    following = set()
+    for student_id, realization_id in follows:
+        groupset_id = realization_groupsets.get(realization_id)
+        following.add((student_id, groupset_id))
+        links[(student_id, realization_id)] = (student_id, realization_id, groupset_id, True)
+    for student_id, group_id in student_groups:
+        groupset_id = group_groupsets[group_id]
+        if (student_id, groupset_id) in following:
+            continue
+        for realization_id in group_realizations[group_id]:
+            links.setdefault((student_id, realization_id),
+                             (student_id, realization_id, groupset_id, False))
+    return list(links.values())
+
+
+def fill_student_realizations(apps, schema_editor):
+    Student = apps.get_model('friprosveta', 'Student')
+    ActivityRealization = apps.get_model('timetable', 'ActivityRealization')
+    Group = apps.get_model('timetable', 'Group')
+    StudentRealization = apps.get_model('friprosveta', 'StudentRealization')
+    links = student_realization_links(
+        Student.groups.through.objects.values_list('student_id', 'group_id'),
+        Student.follows.through.objects.values_list('student_id', 'activityrealization_id'),
+        ActivityRealization.groups.through.objects.values_list('activityrealization_id', 'group_id'),
+        dict(Group.objects.values_list('id', 'groupset_id')))
+    StudentRealization.objects.bulk_create([
+        StudentRealization(student_id=student_id, realization_id=realization_id,
+                           groupset_id=groupset_id, followed=followed)
+        for student_id, realization_id, groupset_id, followed in links], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('timetable', '0002_auto_20180228_1129'),
+        ('friprosveta', '0003_auto_20180930_2347'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StudentRealization',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('followed', models.BooleanField(default=False)),
+                ('groupset', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='student_realizations', to='timetable.GroupSet')),
+                ('realization', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='student_links', to='timetable.ActivityRealization')),
+                ('student', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='realization_links', to='friprosveta.Student')),
+            ],
+            options={
+                'unique_together': {('student', 'realization')},
+            },
+        ),
+        migrations.RunPython(fill_student_realizations, migrations.RunPython.noop),
+    ]
@@ -5,7 +5,7 @@ from operator import attrgetter, itemgetter
 
 from django.conf import settings
 from django.core.cache import cache
-from django.db import models
+from django.db import models, transaction
 from django.db.models import Q
 
 import frinajave
@@ -572,6 +572,17 @@ class Teacher(timetable.models.Teacher):
                                        Q(subject__subjectheadteachers__end__isnull=True) | Q(
                                            subject__subjectheadteachers__end__lt=datetime.datetime.now()))
 
+    @classmethod
+    def bulk_busy(cls, tt, teachers=None, levels=['CANT', 'HATE']):
+        """
+        Busy weights of the given teachers (all teachers of the timetable
+        by default) in the timetable, computed in a constant number of
+        queries. Returns a friprosveta.occupancy.TeacherBusy.
+        """
+        from friprosveta.occupancy import TeacherBusy
+        teacher_ids = None if teachers is None else [t.id for t in teachers]
+        return TeacherBusy.build(tt, teacher_ids, levels)
+
     def busy_hours(self, tt, levels=['CANT', 'HATE']):
         """
         When teacher is busy in a given timetable.
@@ -580,39 +591,16 @@ class Teacher(timetable.models.Teacher):
         2) he has a time preference stating that he would rather not teach
         with weight more than the given weight.
         Weights have to be normalized first.
-        Returns a set of tuples (hour,weight), weight ranges from 0 to 1.
+        Returns a set of tuples (hour,weight), weight ranges from 0 to 1,
+        the highest weight of an hour counts.
         Weight 1: busy busy.
         Weight 0.5: relatively busy...
+        Use bulk_busy when computing busy hours of many teachers.
         """
-
-        def add_busy_hours(busy_hours, start, duration, day, weight=1):
-            start_index = timetable.models.WORKHOURS.index((start, start))
-            for hour in timetable.models.WORKHOURS[start_index: start_index + duration]:
-                busy_hours[day].add((hour[0], weight))
-
-        preferences = timetable.models.TeacherTimePreference.objects.filter(
-            preferenceset=tt.preferenceset, level__in=levels, teacher=self)
-        allocations = timetable.models.Allocation.objects.filter(
-            timetable=tt, activityRealization__teachers=self)
-
-        busy_hours = {day[0]: set() for day in timetable.models.WEEKDAYS}
-        for allocation in allocations:
-            add_busy_hours(busy_hours, allocation.start, allocation.duration, allocation.day)
-        for preference in preferences:
-            add_busy_hours(busy_hours, preference.start, preference.duration,
-                           preference.day, preference.adjustedWeight())
-        return busy_hours
+        return Teacher.bulk_busy(tt, [self], levels).busy_hours(self.id)
 
     def free_hours(self, tt, weight=0):
-        busy = self.busy_hours(tt)
-        free = {day[0]: set(list(zip(*timetable.models.WORKHOURS))[0]) for day in timetable.models.WEEKDAYS}
-
-        for day in busy:
-            for (hour, busy_weight) in busy[day]:
-                if busy_weight >= weight and hour in free[day]:
-                    free[day].remove(hour)
-
-        return free
+        return Teacher.bulk_busy(tt, [self]).free_hours(self.id, weight)
 
 
 class Student(models.Model):
@@ -656,7 +644,7 @@ class Student(models.Model):
         Return a list of the realizations the given student is attending.
         """
         return tt.realizations.filter(
-            groups__students=self
+            student_links__student=self
         )
 
     def allocations(self, tt):
@@ -664,15 +652,36 @@ class Student(models.Model):
         Return a list of the allocations the given student is attending.
         """
         return tt.allocations.filter(
-            activityRealization__groups__students=self
+            activityRealization__student_links__student=self
         )
 
+    @classmethod
+    def bulk_busy(cls, tt, students=None):
+        """
+        Allocations of the given students (all students attending the
+        timetable by default) computed in a constant number of queries.
+        Returns a friprosveta.occupancy.StudentBusy answering busy_hours,
+        is_available and overlaps for every student.
+        """
+        from friprosveta.occupancy import StudentBusy
+        student_ids = None if students is None else [s.id for s in students]
+        return StudentBusy.build(tt, student_ids)
+
+    @classmethod
+    def with_overlaps(cls, tt):
+        """
+        Return a QuerySet of students attending overlapping allocations.
+        """
+        from friprosveta.occupancy import get_student_busy
+        return cls.objects.filter(id__in=get_student_busy(tt).overlapping_student_ids())
+
     def busy_hours(self, tt):
         """
         Returns a dict of form (day, hours) : [allocation list].
+        Use bulk_busy when computing busy hours of many students.
         """
         busy = defaultdict(list)
-        for a in self.allocations(tt):
+        for a in self.allocations(tt).select_related('activityRealization__activity'):
             for hour in a.hours:
                 busy[(a.day, hour)].append(a)
         return busy
@@ -701,14 +710,11 @@ class Student(models.Model):
         groups which shortname contains the string group_type and are
         free at the time of the allocation allocation_to.
         """
-        substitutions = set()
         realization = allocation_from.activityRealization
         groups = realization.groups.filter(short_name__contains=group_type)
-        for group in groups:
-            for student in group.students.all():
-                if cls.is_available(student, tt, allocation_to):
-                    substitutions.add(student)
-        return substitutions
+        students = set(cls.objects.filter(groups__in=groups))
+        busy = cls.bulk_busy(tt, students)
+        return set(student for student in students if busy.is_available(student.id, allocation_to))
 
     def my_groups(self, allocation):
         """
@@ -752,6 +758,103 @@ class Student(models.Model):
             return Student.objects.get(name__iexact=user.first_name, surname__iexact=user.last_name)
 
 
+def student_realization_links(student_groups, follows, realization_groups, group_groupsets):
+    """
+    Return the list of (student id, realization id, groupset id, followed) tuples
+    for the given (student id, group id), (student id, followed realization id),
+    (realization id, group id) pairs and the group id -> groupset id dictionary.
+    See StudentRealization.
+    """
+    realization_groupsets = dict()
+    group_realizations = defaultdict(set)
+    for realization_id, group_id in realization_groups:
+        realization_groupsets[realization_id] = group_groupsets[group_id]
+        group_realizations[group_id].add(realization_id)
+    links = dict()
+    following = set()
+    for student_id, realization_id in follows:
+        groupset_id = realization_groupsets.get(realization_id)
+        following.add((student_id, groupset_id))
+        links[(student_id, realization_id)] = (student_id, realization_id, groupset_id, True)
+    for student_id, group_id in student_groups:
+        groupset_id = group_groupsets[group_id]
+        if (student_id, groupset_id) in following:
+            continue
+        for realization_id in group_realizations[group_id]:
+            links.setdefault((student_id, realization_id),
+                             (student_id, realization_id, groupset_id, False))
+    return list(links.values())
+
+
+class StudentRealization(models.Model):
+    """
+    Index of realizations attended by students.
+    Within a groupset a student following some realizations attends
+    only those, otherwise he attends all realizations of his groups.
+    Kept up to date by friprosveta.signals.
+    """
+
+    def __str__(self):
+        return "{0}: {1}".format(self.student, self.realization)
+
+    student = models.ForeignKey(Student, related_name='realization_links', on_delete=models.CASCADE)
+    realization = models.ForeignKey(timetable.models.ActivityRealization, related_name='student_links',
+                                    on_delete=models.CASCADE)
+    groupset = models.ForeignKey(timetable.models.GroupSet, related_name='student_realizations',
+                                 null=True, blank=True, on_delete=models.CASCADE)
+    followed = models.BooleanField(default=False)
+
+    @classmethod
+    def realization_ids(cls, student_ids):
+        """
+        Return the set of realization ids attended by the students
+        with the given student ids (Student.studentId).
+        """
+        return set(cls.objects.filter(student__studentId__in=student_ids).values_list(
+            'realization_id', flat=True))
+
+    @classmethod
+    def refresh(cls, student_ids):
+        """
+        Recompute the index for the students with the given ids (primary keys).
+        """
+        student_ids = set(student_ids)
+        if not student_ids:
+            return
+        student_groups = list(Student.groups.through.objects.filter(
+            student_id__in=student_ids).values_list('student_id', 'group_id'))
+        follows = list(Student.follows.through.objects.filter(
+            student_id__in=student_ids).values_list('student_id', 'activityrealization_id'))
+        group_ids = set(group_id for _, group_id in student_groups)
+        realization_groups = list(timetable.models.ActivityRealization.groups.through.objects.filter(
+            Q(group_id__in=group_ids) |
+            Q(activityrealization_id__in=set(realization_id for _, realization_id in follows))
+        ).values_list('activityrealization_id', 'group_id'))
+        group_groupsets = dict(Group.objects.filter(
+            id__in=group_ids | set(group_id for _, group_id in realization_groups)
+        ).values_list('id', 'groupset_id'))
+
+        links = [cls(student_id=student_id, realization_id=realization_id,
+                     groupset_id=groupset_id, followed=followed)
+                 for student_id, realization_id, groupset_id, followed in student_realization_links(
+                     student_groups, follows, realization_groups, group_groupsets)]
+        with transaction.atomic():
+            cls.objects.filter(student_id__in=student_ids).delete()
+            cls.objects.bulk_create(links, batch_size=1000)
+
+    @classmethod
+    def rebuild(cls, chunk_size=500):
+        """
+        Recompute the index for all students.
+        """
+        student_ids = list(Student.objects.values_list('id', flat=True))
+        for i in range(0, len(student_ids), chunk_size):
+            cls.refresh(student_ids[i:i + chunk_size])
+
+    class Meta:
+        unique_together = (("student", "realization"),)
+
+
 class StudentEnrollment(models.Model):
     """
     Relate student with his subjects.
@@ -0,0 +1,59 @@
+"""
+Navigation data of the timetable landing page.
+
+The bundle of teachers, classrooms, visible groups and subjects of a
+timetable is built in four queries and cached by Timetable.version (see
+timetable.signals), so it is rebuilt only after relevant changes.
+"""
+import logging
+
+from django.core.cache import cache
+
+import friprosveta.models
+import timetable.models
+from friprosveta.viewmodels import TeacherEntry
+
+logger = logging.getLogger(__name__)
+
+NAVIGATION_CACHE_TIMEOUT = 24 * 60 * 60
+
+
+def build_navigation(tt):
+    """
+    Return the navigation bundle for the given timetable: a dictionary
+    of lists of teachers, classrooms, groups and subjects, all of them
+    dictionaries that can be serialized into JSON.
+    """
+    teachers = [TeacherEntry(*t) for t in friprosveta.models.Teacher.objects.filter(
+        activities__activityset=tt.activityset_id
+    ).distinct().order_by('user__last_name', 'user__first_name').values_list(
+        'id', 'code', 'user__first_name', 'user__last_name')]
+    classrooms = []
+    if tt.classroomset_id is not None:
+        classrooms = list(timetable.models.Classroom.objects.filter(
+            classroomset=tt.classroomset_id).order_by('name').values('id', 'name', 'short_name'))
+    groups = []
+    if tt.groupset_id is not None:
+        groups = list(timetable.models.Group.objects.filter(
+            groupset=tt.groupset_id, visible_in_navigation=True).values('id', 'name', 'short_name'))
+    subjects = list(friprosveta.models.Subject.objects.filter(
+        activities__activityset=tt.activityset_id
+    ).distinct().order_by('name').values('id', 'code', 'name'))
+    return {
+        'teachers': [{'id': t.id, 'code': t.code, 'name': str(t)} for t in teachers],
+        'classrooms': classrooms,
+        'groups': groups,
+        'subjects': subjects,
+    }
+
+
+def get_navigation(tt):
+    """
+    Return the (cached) navigation bundle for the given timetable.
+    """
+    key = "navigation_{}_{}".format(tt.id, tt.version)
+    navigation = cache.get(key)
+    if navigation is None:
+        navigation = build_navigation(tt)
+        cache.set(key, navigation, NAVIGATION_CACHE_TIMEOUT)
+    return navigation
@@ -0,0 +1,699 @@
+"""
+Occupancy of timeslots by students, teachers and classrooms.
+
+The week is split into timeslots, one for every work hour of every day
+(see SLOTS). The occupancy of a set of allocations holds student x timeslot,
+teacher x timeslot and classroom x timeslot matrices counting the
+allocations each student attends (students attend realizations of their
+groups), each teacher teaches and each classroom hosts in each timeslot.
+It is built in a fixed number of queries, so questions like "how many
+students of this allocation are busy elsewhere" are answered by NumPy
+slicing instead of queries per student and allocation. A count above one
+is a conflict (an overlap or a double booking).
+
+OccupancyIndex keeps the occupancy of a whole timetable in process memory
+and follows changes of allocations, so conflicts of moves and free
+classrooms can be evaluated without rebuilding it.
+
+TeacherBusy and StudentBusy answer busy hours of many teachers (teaching
+and time preferences) and students (attended realizations, see
+friprosveta.models.StudentRealization) at once.
+"""
+import logging
+from collections import namedtuple, defaultdict
+
+import numpy as np
+
+import friprosveta.models
+import timetable.models
+from friprosveta.viewmodels import WEEKDAY_INDEX, HOUR_INDEX
+from timetable.models import WEEKDAYS, WORKHOURS
+
+logger = logging.getLogger(__name__)
+
+N_HOURS = len(WORKHOURS)
+SLOTS = len(WEEKDAYS) * N_HOURS
+
+NO_ROWS = np.zeros(0, dtype=np.intp)
+
+
+def slots(day, start, duration):
+    """
+    Return the array of timeslots covered by something (an allocation,
+    a time preference) lasting duration hours from start on day.
+    """
+    first = HOUR_INDEX[start]
+    offset = WEEKDAY_INDEX[day] * N_HOURS
+    return np.arange(offset + first, offset + min(N_HOURS, first + duration))
+
+
+def slot(day, hour):
+    """
+    Return the timeslot of the hour on day.
+    """
+    return WEEKDAY_INDEX[day] * N_HOURS + HOUR_INDEX[hour]
+
+
+def mask_slots(mask):
+    """
+    Return the boolean timeslot array of the bitmask of hours
+    (see timetable.models.timeslot_mask, bits are numbered like timeslots).
+    """
+    return np.array([(mask >> i) & 1 for i in range(SLOTS)], dtype=bool)
+
+
+def slot_time(slot):
+    """
+    Return the (day, hour) pair of the timeslot.
+    """
+    return WEEKDAYS[slot // N_HOURS][0], WORKHOURS[slot % N_HOURS][0]
+
+
+OccupancyAllocation = namedtuple('OccupancyAllocation', [
+    'id', 'realization_id', 'classroom_id', 'day', 'start', 'duration', 'slots'])
+AllocationOverlaps = namedtuple('AllocationOverlaps', [
+    'size', 'group_overlaps', 'individual_overlaps'])
+Conflicts = namedtuple('Conflicts', ['students', 'teachers', 'classrooms'])
+
+
+def excess(counts):
+    """
+    Return the number of conflicts in the counts: allocations above one
+    in the same timeslot.
+    """
+    return int(np.maximum(counts - 1, 0).sum())
+
+
+class Occupancy(object):
+    """
+    Student, teacher and classroom x timeslot occupancy of an allocation queryset.
+    Students, teachers and classrooms are referred to by their row index,
+    student_ids, teacher_ids and classroom_ids map indices to ids.
+    """
+
+    def __init__(self):
+        self.student_ids = NO_ROWS
+        # student id -> index
+        self.student_index = dict()
+        self.teacher_ids = NO_ROWS
+        self.teacher_index = dict()
+        self.classroom_ids = []
+        self.classroom_index = dict()
+        # id -> OccupancyAllocation
+        self.allocations = dict()
+        self.realization_allocations = defaultdict(set)
+        self.realization_groups = defaultdict(list)
+        # realization id -> array of teacher indices
+        self.realization_teachers = dict()
+        self.realization_durations = dict()
+        self.realization_intended_sizes = dict()
+        # group id -> array of student indices
+        self.group_students = dict()
+        self.group_sizes = dict()
+        # group id -> boolean timeslot mask of CANT time preferences (with ancestors)
+        self.group_cant = dict()
+        self.student_counts = np.zeros((0, SLOTS), dtype=np.int32)
+        self.teacher_counts = np.zeros((0, SLOTS), dtype=np.int32)
+        self.classroom_counts = np.zeros((0, SLOTS), dtype=np.int32)
+
+    @classmethod
+    def build(cls, allocations, group_ids=(), classroom_ids=(), preferenceset_id=None):
+        """
+        Build the occupancy of the allocations in the queryset in a fixed number of queries.
+        Students and time preferences of the given groups are loaded together
+        with those of groups on allocations, the given classrooms get rows
+        together with classrooms of allocations. CANT time preferences are
+        read from the preference set (from all preference sets if it is None,
+        see timetable.models.unavailable_masks), pass the preference set of
+        the timetable so the occupancy agrees with Allocation.groups_not_available.
+        """
+        occupancy = cls()
+        rows = list(allocations.values_list(
+            'id', 'activityRealization_id', 'classroom_id', 'day', 'start',
+            'activityRealization__activity__duration', 'activityRealization__intended_size'))
+        for allocation_id, realization_id, classroom_id, day, start, duration, intended_size in rows:
+            occupancy.allocations[allocation_id] = OccupancyAllocation(
+                allocation_id, realization_id, classroom_id, day, start, duration,
+                slots(day, start, duration))
+            occupancy.realization_allocations[realization_id].add(allocation_id)
+            occupancy.realization_durations[realization_id] = duration
+            occupancy.realization_intended_sizes[realization_id] = intended_size
+
+        for realization_id, group_id in timetable.models.ActivityRealization.groups.through.objects.filter(
+                activityrealization_id__in=occupancy.realization_intended_sizes.keys()
+        ).values_list('activityrealization_id', 'group_id'):
+            occupancy.realization_groups[realization_id].append(group_id)
+        realization_teachers = defaultdict(list)
+        for realization_id, teacher_id in timetable.models.ActivityRealization.teachers.through.objects.filter(
+                activityrealization_id__in=occupancy.realization_intended_sizes.keys()
+        ).values_list('activityrealization_id', 'teacher_id'):
+            index = occupancy.teacher_index.setdefault(teacher_id, len(occupancy.teacher_index))
+            realization_teachers[realization_id].append(index)
+        occupancy.realization_teachers = {r: np.array(t, dtype=np.intp)
+                                          for r, t in realization_teachers.items()}
+        occupancy.teacher_ids = np.array(sorted(occupancy.teacher_index, key=occupancy.teacher_index.get),
+                                         dtype=np.intp)
+        for classroom_id in list(classroom_ids) + [a.classroom_id for a in occupancy.allocations.values()]:
+            if classroom_id is not None:
+                occupancy._classroom_row(classroom_id)
+        group_ids = set(group_ids) | set(g for l in occupancy.realization_groups.values() for g in l)
+        occupancy.group_sizes = dict(timetable.models.Group.objects.filter(
+            id__in=group_ids).values_list('id', 'size'))
+
+        group_students = defaultdict(list)
+        for group_id, student_id in friprosveta.models.Student.groups.through.objects.filter(
+                group_id__in=group_ids).values_list('group_id', 'student_id'):
+            index = occupancy.student_index.setdefault(student_id, len(occupancy.student_index))
+            group_students[group_id].append(index)
+        occupancy.group_students = {g: np.array(s, dtype=np.intp) for g, s in group_students.items()}
+        occupancy.student_ids = np.array(sorted(occupancy.student_index, key=occupancy.student_index.get),
+                                         dtype=np.intp)
+
+        for group_id, mask in timetable.models.unavailable_masks(preferenceset_id).items():
+            if group_id in group_ids:
+                occupancy.group_cant[group_id] = mask_slots(mask)
+
+        occupancy.student_counts = np.zeros((len(occupancy.student_ids), SLOTS), dtype=np.int32)
+        occupancy.teacher_counts = np.zeros((len(occupancy.teacher_ids), SLOTS), dtype=np.int32)
+        for counts, rows_fn in [(occupancy.student_counts, occupancy.students),
+                                (occupancy.teacher_counts, occupancy.teachers)]:
+            row_parts, slot_parts = [], []
+            for a in occupancy.allocations.values():
+                rows = rows_fn(a.realization_id)
+                row_parts.append(np.repeat(rows, len(a.slots)))
+                slot_parts.append(np.tile(a.slots, len(rows)))
+            if row_parts:
+                np.add.at(counts, (np.concatenate(row_parts), np.concatenate(slot_parts)), 1)
+        for a in occupancy.allocations.values():
+            if a.classroom_id is not None:
+                occupancy.classroom_counts[occupancy.classroom_index[a.classroom_id], a.slots] += 1
+        return occupancy
+
+    def students(self, realization_id, group_ids=None):
+        """
+        Return the sorted array of indices of students attending the realization.
+        Only students of the given groups are returned if group_ids is given.
+        """
+        if group_ids is None:
+            group_ids = self.realization_groups[realization_id]
+        parts = [self.group_students[g] for g in group_ids if g in self.group_students]
+        return np.unique(np.concatenate(parts)) if parts else NO_ROWS
+
+    def teachers(self, realization_id):
+        """
+        Return the array of indices of teachers of the realization.
+        """
+        return self.realization_teachers.get(realization_id, NO_ROWS)
+
+    def _classroom_row(self, classroom_id):
+        """
+        Return the row of the classroom, add it if it is not there yet.
+        """
+        if classroom_id not in self.classroom_index:
+            self.classroom_index[classroom_id] = len(self.classroom_ids)
+            self.classroom_ids.append(classroom_id)
+            self.classroom_counts = np.vstack([self.classroom_counts, np.zeros((1, SLOTS), dtype=np.int32)])
+        return self.classroom_index[classroom_id]
+
+    def _classroom_rows(self, classroom_id):
+        if classroom_id is None:
+            return NO_ROWS
+        return np.array([self._classroom_row(classroom_id)], dtype=np.intp)
+
+    def classroom_slot_counts(self, classroom_ids):
+        """
+        Return the classroom x timeslot array counting allocations in the
+        given classrooms (a copy, classrooms without a row count nothing).
+        The occupancy is not changed, so it is safe for shared indices.
+        """
+        counts = np.zeros((len(classroom_ids), SLOTS), dtype=np.int32)
+        for i, classroom_id in enumerate(classroom_ids):
+            if classroom_id in self.classroom_index:
+                counts[i] = self.classroom_counts[self.classroom_index[classroom_id]]
+        return counts
+
+    def _count(self, allocation, delta):
+        if not len(allocation.slots):
+            return
+        for counts, rows in [(self.student_counts, self.students(allocation.realization_id)),
+                             (self.teacher_counts, self.teachers(allocation.realization_id)),
+                             (self.classroom_counts, self._classroom_rows(allocation.classroom_id))]:
+            if len(rows):
+                counts[np.ix_(rows, allocation.slots)] += delta
+
+    def add_allocation(self, allocation_id, realization_id, classroom_id, day, start):
+        """
+        Count a new (or moved) allocation of a realization already in the occupancy.
+        Return False if the realization is not known (the occupancy has to be rebuilt).
+        """
+        if realization_id not in self.realization_durations:
+            return False
+        duration = self.realization_durations[realization_id]
+        allocation = OccupancyAllocation(allocation_id, realization_id, classroom_id,
+                                         day, start, duration, slots(day, start, duration))
+        self.allocations[allocation_id] = allocation
+        self.realization_allocations[realization_id].add(allocation_id)
+        self._count(allocation, 1)
+        return True
+
+    def remove_allocation(self, allocation_id):
+        """
+        Stop counting the allocation, if it is counted.
+        """
+        allocation = self.allocations.pop(allocation_id, None)
+        if allocation is not None:
+            self.realization_allocations[allocation.realization_id].discard(allocation_id)
+            self._count(allocation, -1)
+
+    def realization_slot_counts(self, realization_id):
+        """
+        Return the array with the number of allocations of the realization in each timeslot.
+        """
+        counts = np.zeros(SLOTS, dtype=np.int32)
+        for allocation_id in self.realization_allocations.get(realization_id, ()):
+            counts[self.allocations[allocation_id].slots] += 1
+        return counts
+
+    def realization_size(self, realization_id):
+        """
+        Same as ActivityRealization.size, without queries.
+        """
+        size = sum(self.group_sizes.get(g) or 0 for g in self.realization_groups[realization_id])
+        return max(size, self.realization_intended_sizes[realization_id])
+
+    def unavailable_groups(self, allocation_id):
+        """
+        Return ids of groups on the allocation with a CANT time preference
+        in one of its timeslots.
+        """
+        a = self.allocations[allocation_id]
+        return [g for g in self.realization_groups[a.realization_id]
+                if g in self.group_cant and self.group_cant[g][a.slots].any()]
+
+    def busy_elsewhere(self, allocation_id, students=None):
+        """
+        Return the boolean array telling which students (by default all
+        students of the allocation) attend another allocation in one of
+        the timeslots of the allocation.
+        """
+        a = self.allocations[allocation_id]
+        if students is None:
+            students = self.students(a.realization_id)
+        # The allocation itself is counted once for each of its students
+        return (self.student_counts[np.ix_(students, a.slots)] > 1).any(axis=1)
+
+    def overlaps(self, allocation_id):
+        """
+        Return AllocationOverlaps of the allocation: the number of students
+        in groups that can not attend it (CANT time preferences) and the
+        number of the remaining students busy elsewhere at the same time.
+        """
+        a = self.allocations[allocation_id]
+        unavailable = self.unavailable_groups(allocation_id)
+        available = [g for g in self.realization_groups[a.realization_id] if g not in unavailable]
+        students = np.setdiff1d(self.students(a.realization_id, available),
+                                self.students(a.realization_id, unavailable),
+                                assume_unique=True)
+        return AllocationOverlaps(
+            size=self.realization_size(a.realization_id),
+            group_overlaps=sum(self.group_sizes.get(g) or 0 for g in unavailable),
+            individual_overlaps=int(self.busy_elsewhere(allocation_id, students).sum()),
+        )
+
+    def classroom_busy(self, classroom_ids, exclude_realization_id=None):
+        """
+        Return the classroom x timeslot array counting allocations in the
+        given classrooms, without allocations of the excluded realization.
+        """
+        rows = {c: i for i, c in enumerate(classroom_ids)}
+        counts = self.classroom_slot_counts(classroom_ids)
+        for allocation_id in self.realization_allocations.get(exclude_realization_id, ()):
+            a = self.allocations[allocation_id]
+            if a.classroom_id in rows:
+                counts[rows[a.classroom_id], a.slots] -= 1
+        return counts
+
+    def free_classrooms_grid(self, classroom_ids, duration, exclude_realization_id=None):
+        """
+        Return the boolean classroom x timeslot array telling whether the
+        classroom is free for duration hours (or until the end of the day)
+        from the timeslot on, not counting allocations of the excluded realization.
+        """
+        free = (self.classroom_busy(classroom_ids, exclude_realization_id) == 0).reshape(
+            len(classroom_ids), len(WEEKDAYS), N_HOURS)
+        grid = free.copy()
+        for hour in range(1, min(duration, N_HOURS)):
+            grid[:, :, :-hour] &= free[:, :, hour:]
+        return grid.reshape(len(classroom_ids), SLOTS)
+
+    def free_classrooms(self, classroom_ids, day, start, duration, exclude_realization_id=None):
+        """
+        Return ids of given classrooms free for duration hours from start on day.
+        """
+        free = self.free_classrooms_grid(classroom_ids, duration, exclude_realization_id)[:, slot(day, start)]
+        return [c for c, is_free in zip(classroom_ids, free) if is_free]
+
+    def conflicts(self):
+        """
+        Return Conflicts with the numbers of student overlaps, teacher
+        and classroom double bookings.
+        """
+        return Conflicts(excess(self.student_counts), excess(self.teacher_counts),
+                         excess(self.classroom_counts))
+
+    def move_conflicts(self, allocation_id, day, start, classroom_id):
+        """
+        Return Conflicts with the change of the numbers of conflicts if the
+        allocation was moved to start at start on day in the classroom.
+        The occupancy itself is not changed.
+        """
+        a = self.allocations[allocation_id]
+        new_slots = slots(day, start, a.duration)
+        columns = np.union1d(a.slots, new_slots)
+        old_columns = np.searchsorted(columns, a.slots)
+        new_columns = np.searchsorted(columns, new_slots)
+
+        def change(counts, old_rows, new_rows):
+            rows = np.union1d(old_rows, new_rows)
+            before = counts[np.ix_(rows, columns)]
+            after = before.copy()
+            after[np.ix_(np.searchsorted(rows, old_rows), old_columns)] -= 1
+            after[np.ix_(np.searchsorted(rows, new_rows), new_columns)] += 1
+            return excess(after) - excess(before)
+
+        # Counts of the old and the new classroom, without adding rows to the occupancy
+        classroom_ids = sorted(set(c for c in (a.classroom_id, classroom_id) if c is not None))
+
+        def classroom_rows(c):
+            return NO_ROWS if c is None else np.array([classroom_ids.index(c)], dtype=np.intp)
+
+        students = self.students(a.realization_id)
+        teachers = self.teachers(a.realization_id)
+        return Conflicts(change(self.student_counts, students, students),
+                         change(self.teacher_counts, teachers, teachers),
+                         change(self.classroom_slot_counts(classroom_ids), classroom_rows(a.classroom_id),
+                                classroom_rows(classroom_id)))
+
+
+class OccupancyIndex(object):
+    """
+    Occupancy of a timetable: allocations of the timetable (and timetables
+    it respects) and CANT time preferences of groups in its groupset from
+    its preference set.
+
+    The busy mask of a student is a row of 75 (SLOTS) flags, the number of
+    busy students in a timeslot is the sum of a column over the students.
+    Indices are kept in process memory and updated in place when
+    allocations are saved or deleted (see update_indices), so they hold
+    the current conflicts of the timetable.
+    """
+
+    def __init__(self, timetable_id, version, timetable_ids, occupancy):
+        self.timetable_id = timetable_id
+        self.version = version
+        self.timetable_ids = timetable_ids
+        self.occupancy = occupancy
+        self.cant = np.zeros((len(occupancy.student_ids), SLOTS), dtype=bool)
+
+    @classmethod
+    def build(cls, tt):
+        logger.info("Building occupancy index for {}".format(tt.slug))
+        timetable_ids = set([tt.id]) | set(tt.respects.values_list('id', flat=True))
+        group_ids = list(timetable.models.Group.objects.filter(
+            groupset_id=tt.groupset_id).values_list('id', flat=True))
+        occupancy = Occupancy.build(
+            timetable.models.Allocation.objects.filter(timetable_id__in=timetable_ids), group_ids,
+            preferenceset_id=tt.preferenceset_id)
+        index = cls(tt.id, tt.version, timetable_ids, occupancy)
+        for group_id in group_ids:
+            if group_id in occupancy.group_cant and group_id in occupancy.group_students:
+                index.cant[occupancy.group_students[group_id]] |= occupancy.group_cant[group_id]
+        return index
+
+    def busy_counts(self, realization_id, group_ids):
+        """
+        Return the array with the number of students of the given groups
+        busy in each timeslot. Allocations of the realization (given groups
+        should be its groups) do not make students busy.
+        """
+        students = self.occupancy.students(realization_id, group_ids)
+        own = self.occupancy.realization_slot_counts(realization_id)
+        busy = (self.occupancy.student_counts[students] > own) | self.cant[students]
+        return busy.sum(axis=0)
+
+
+_indices = dict()
+
+
+def get_occupancy_index(tt):
+    """
+    Return the up to date occupancy index of the timetable.
+    """
+    index = _indices.get(tt.id)
+    if index is None or index.version != tt.version:
+        index = OccupancyIndex.build(tt)
+        _indices[tt.id] = index
+    return index
+
+
+def fresh_index_ids():
+    """
+    Return ids of timetables with up to date occupancy indices in process memory.
+    """
+    if not _indices:
+        return set()
+    return set(tt_id for tt_id, version in timetable.models.Timetable.objects.filter(
+        id__in=list(_indices.keys())).values_list('id', 'version')
+        if _indices[tt_id].version == version)
+
+
+def update_indices(allocation, fresh_ids, deleted=False):
+    """
+    Apply the change of the allocation to occupancy indices that were up to
+    date before the change (fresh_ids) and give them the timetable version
+    the change produced, so they do not have to be rebuilt. Timetable
+    versions have to be bumped already (see timetable.signals). Indices of
+    timetables changed by someone else in the meantime are dropped.
+    """
+    updated = []
+    for tt_id in fresh_ids:
+        index = _indices.get(tt_id)
+        if index is None:
+            continue
+        covered = allocation.id in index.occupancy.allocations
+        index.occupancy.remove_allocation(allocation.id)
+        if not deleted and allocation.timetable_id in index.timetable_ids:
+            covered = True
+            if not index.occupancy.add_allocation(allocation.id, allocation.activityRealization_id,
+                                                  allocation.classroom_id, allocation.day,
+                                                  allocation.start):
+                del _indices[tt_id]
+                continue
+        if covered:
+            updated.append(index)
+    if updated:
+        versions = dict(timetable.models.Timetable.objects.filter(
+            id__in=[index.timetable_id for index in updated]).values_list('id', 'version'))
+        version = getattr(allocation, '_timetable_version', None)
+        for index in updated:
+            if version is not None and versions.get(index.timetable_id) == version:
+                index.version = version
+            else:
+                _indices.pop(index.timetable_id, None)
+
+
+class TeacherBusy(object):
+    """
+    Busy weights of teachers in a timetable as a teacher x timeslot array.
+    Teaching weighs 1, time preferences weigh their adjusted weight
+    (see timetable.models.TeacherTimePreference.adjustedWeight), the highest
+    weight in a timeslot counts. Weight 0 means the teacher is free.
+    """
+
+    def __init__(self, teacher_ids):
+        self.teacher_ids = list(teacher_ids)
+        self.teacher_index = {t: i for i, t in enumerate(self.teacher_ids)}
+        self.weights = np.zeros((len(self.teacher_ids), SLOTS))
+
+    @classmethod
+    def build(cls, tt, teacher_ids=None, levels=('CANT', 'HATE'), min_weight=0.4, max_weight=0.99):
+        """
+        Compute busy weights of the given teachers (all teachers teaching in
+        the timetable or with preferences in its preference set by default)
+        in two queries (and timetable.models.teacher_weight_sums).
+        """
+        allocations = timetable.models.Allocation.objects.filter(
+            timetable=tt, activityRealization__teachers__isnull=False)
+        preferences = timetable.models.TeacherTimePreference.objects.filter(
+            preferenceset_id=tt.preferenceset_id, level__in=levels)
+        if teacher_ids is not None:
+            allocations = allocations.filter(activityRealization__teachers__in=teacher_ids)
+            preferences = preferences.filter(teacher_id__in=teacher_ids)
+        allocation_rows = list(allocations.values_list(
+            'activityRealization__teachers', 'day', 'start', 'activityRealization__activity__duration'))
+        preference_rows = list(preferences.values_list(
+            'teacher_id', 'level', 'day', 'start', 'duration', 'weight'))
+        if teacher_ids is None:
+            teacher_ids = sorted(set(r[0] for r in allocation_rows) | set(r[0] for r in preference_rows))
+        busy = cls(teacher_ids)
+
+        # Same as TeacherTimePreference.adjustedWeight
+        weight_sums = timetable.models.teacher_weight_sums(
+            tt.preferenceset_id, set((r[0], r[1]) for r in preference_rows))
+        for teacher_id, level, day, start, duration, weight in preference_rows:
+            adjusted = timetable.models.normalized_weight(
+                level, weight, weight_sums.get((teacher_id, level), (0, 0))[1], min_weight, max_weight)
+            row = busy.weights[busy.teacher_index[teacher_id]]
+            columns = slots(day, start, duration)
+            row[columns] = np.maximum(row[columns], adjusted)
+        for teacher_id, day, start, duration in allocation_rows:
+            if teacher_id in busy.teacher_index:
+                busy.weights[busy.teacher_index[teacher_id], slots(day, start, duration)] = 1.0
+        return busy
+
+    def busy(self, weight=0):
+        """
+        Return the boolean teacher x timeslot array telling whether
+        teachers are busy with at least the given weight.
+        """
+        return (self.weights > 0) & (self.weights >= weight)
+
+    def busy_hours(self, teacher_id):
+        """
+        Return busy hours of the teacher in the format of
+        friprosveta.models.Teacher.busy_hours: day -> set of (hour, weight).
+        """
+        busy_hours = {day[0]: set() for day in WEEKDAYS}
+        if teacher_id in self.teacher_index:
+            row = self.weights[self.teacher_index[teacher_id]]
+            for s in np.flatnonzero(row):
+                day, hour = slot_time(s)
+                busy_hours[day].add((hour, float(row[s])))
+        return busy_hours
+
+    def free_hours(self, teacher_id, weight=0):
+        """
+        Return free hours of the teacher in the format of
+        friprosveta.models.Teacher.free_hours: day -> set of hours.
+        """
+        free = np.ones(SLOTS, dtype=bool)
+        if teacher_id in self.teacher_index:
+            free = ~self.busy(weight)[self.teacher_index[teacher_id]]
+        free_hours = {day[0]: set() for day in WEEKDAYS}
+        for s in np.flatnonzero(free):
+            day, hour = slot_time(s)
+            free_hours[day].add(hour)
+        return free_hours
+
+
+class StudentBusy(object):
+    """
+    Allocations attended by students (see friprosveta.models.StudentRealization)
+    in a timetable: a student x timeslot array counting them and the ids of
+    allocations of every student. It answers Student.busy_hours, is_available
+    and overlaps for many students at once (see Student.bulk_busy).
+    """
+
+    def __init__(self, timetable_id, version, student_ids):
+        self.timetable_id = timetable_id
+        self.version = version
+        self.student_ids = list(student_ids)
+        self.student_index = {s: i for i, s in enumerate(self.student_ids)}
+        self.counts = np.zeros((len(self.student_ids), SLOTS), dtype=np.int16)
+        self.allocations = dict()
+        self.student_allocations = dict()
+
+    @classmethod
+    def build(cls, tt, student_ids=None):
+        """
+        Compute allocations of the given students (all students attending
+        the timetable by default) in two queries.
+        """
+        allocations = tt.allocations.select_related('activityRealization__activity').distinct()
+        links = friprosveta.models.StudentRealization.objects.filter(
+            realization_id__in=tt.allocations.values('activityRealization_id'))
+        if student_ids is not None:
+            allocations = allocations.filter(activityRealization__student_links__student_id__in=student_ids)
+            links = links.filter(student_id__in=student_ids)
+        allocations = list(allocations)
+        links = list(links.values_list('student_id', 'realization_id'))
+        if student_ids is None:
+            student_ids = sorted(set(student_id for student_id, _ in links))
+        busy = cls(tt.id, tt.version, student_ids)
+
+        realization_allocations = defaultdict(list)
+        for position, a in enumerate(allocations):
+            busy.allocations[a.id] = (position, a)
+            realization_allocations[a.activityRealization_id].append(a.id)
+        student_allocations = defaultdict(list)
+        for student_id, realization_id in links:
+            if student_id in busy.student_index:
+                student_allocations[student_id].extend(realization_allocations[realization_id])
+        rows, columns = [], []
+        for student_id, allocation_ids in student_allocations.items():
+            allocation_ids.sort(key=lambda i: busy.allocations[i][0])
+            busy.student_allocations[student_id] = tuple(allocation_ids)
+            for i in allocation_ids:
+                a = busy.allocations[i][1]
+                covered = slots(a.day, a.start, a.duration)
+                rows.append(np.full(len(covered), busy.student_index[student_id], dtype=np.intp))
+                columns.append(covered)
+        if rows:
+            np.add.at(busy.counts, (np.concatenate(rows), np.concatenate(columns)), 1)
+        return busy
+
+    def busy_hours(self, student_id):
+        """
+        Return busy hours of the student in the format of
+        friprosveta.models.Student.busy_hours: (day, hour) -> [allocations].
+        """
+        busy = defaultdict(list)
+        for i in self.student_allocations.get(student_id, ()):
+            a = self.allocations[i][1]
+            for hour in a.hours:
+                busy[(a.day, hour)].append(a)
+        return busy
+
+    def is_available(self, student_id, allocation):
+        """
+        Return True if the student attends nothing during the allocation.
+        """
+        if student_id not in self.student_index:
+            return True
+        row = self.counts[self.student_index[student_id]]
+        return not row[slots(allocation.day, allocation.start, allocation.duration)].any()
+
+    def overlaps(self, student_id):
+        """
+        Return overlaps of the student in the format of
+        friprosveta.models.Student.overlaps: a set of (day, hour, allocations).
+        """
+        if student_id not in self.student_index or self.counts[self.student_index[student_id]].max() < 2:
+            return set()
+        return set((day, hour, tuple(allocations))
+                   for (day, hour), allocations in self.busy_hours(student_id).items()
+                   if len(allocations) > 1)
+
+    def overlapping_student_ids(self):
+        """
+        Return ids of students attending overlapping allocations.
+        """
+        return [self.student_ids[row] for row in np.flatnonzero((self.counts > 1).any(axis=1))]
+
+
+_student_busy = dict()
+
+
+def get_student_busy(tt):
+    """
+    Return allocations of all students attending the timetable.
+    The result is cached until the timetable gets a new version, the
+    version is read from the database (tt may be an outdated instance).
+    """
+    version = timetable.models.Timetable.objects.filter(id=tt.id).values_list('version', flat=True).first()
+    busy = _student_busy.get(tt.id)
+    if busy is None or busy.version != version:
+        busy = StudentBusy.build(tt)
+        busy.version = version
+        _student_busy[tt.id] = busy
+    return busy
@@ -0,0 +1,283 @@
+"""
+Quality measures of a timetable.
+
+A QualitySnapshot holds the data the measures need (the occupancy of the
+timetable, see friprosveta.occupancy, together with studies of students,
+capacities of classrooms and time preferences), read in a fixed number of
+queries. Measures only read the snapshot and are split into shards of
+students, teachers, classrooms and groups, so they can be computed in a
+pool of worker processes that never touch the database.
+"""
+import logging
+import multiprocessing
+from collections import defaultdict, Counter
+
+import numpy as np
+
+import friprosveta.models
+import timetable.models
+from friprosveta.occupancy import OccupancyIndex, SLOTS, N_HOURS, excess, mask_slots, slots
+from timetable.models import WEEKDAYS
+
+logger = logging.getLogger(__name__)
+
+PREFERENCE_LEVELS = ('CANT', 'HATE')
+
+
+class QualitySnapshot(object):
+    """
+    Read-only data of a timetable used by the quality measures.
+    """
+
+    def __init__(self, slug, occupancy, min_fill=0.5):
+        self.slug = slug
+        self.occupancy = occupancy
+        # A classroom is too big when less than min_fill of it is filled
+        self.min_fill = min_fill
+        # student row -> (study, classyear)
+        self.student_studies = dict()
+        self.teacher_names = dict()
+        self.classroom_names = dict()
+        self.classroom_capacities = dict()
+        self.group_names = dict()
+        # level -> teacher x timeslot mask
+        self.teacher_preferences = dict()
+        # group id -> level -> timeslot mask
+        self.group_preferences = defaultdict(dict)
+
+    @classmethod
+    def build(cls, tt, min_fill=0.5):
+        occupancy = OccupancyIndex.build(tt).occupancy
+        snapshot = cls(tt.slug, occupancy, min_fill)
+
+        studies = defaultdict(Counter)
+        classyears = defaultdict(Counter)
+        for student_id, study, classyear in friprosveta.models.StudentEnrollment.objects.filter(
+                groupset_id=tt.groupset_id, student_id__in=occupancy.student_index.keys()
+        ).values_list('student_id', 'study__short_name', 'classyear'):
+            studies[student_id][study] += 1
+            classyears[student_id][classyear] += 1
+        for student_id, row in occupancy.student_index.items():
+            # Same default as Student.study
+            study = studies[student_id].most_common(1)[0][0] if studies[student_id] else None
+            classyear = classyears[student_id].most_common(1)[0][0] if classyears[student_id] else 0
+            snapshot.student_studies[row] = (study or "BUN-RI", classyear)
+
+        snapshot.teacher_names = dict(timetable.models.Teacher.objects.filter(
+            id__in=occupancy.teacher_index.keys()).values_list('id', 'code'))
+        for classroom_id, name, capacity in timetable.models.Classroom.objects.filter(
+                id__in=occupancy.classroom_ids).values_list('id', 'short_name', 'capacity'):
+            snapshot.classroom_names[classroom_id] = name
+            snapshot.classroom_capacities[classroom_id] = capacity
+        group_ids = set(g for groups in occupancy.realization_groups.values() for g in groups)
+        snapshot.group_names = dict(timetable.models.Group.objects.filter(
+            id__in=group_ids).values_list('id', 'short_name'))
+
+        snapshot.teacher_preferences = {level: np.zeros((len(occupancy.teacher_ids), SLOTS), dtype=bool)
+                                        for level in PREFERENCE_LEVELS}
+        for teacher_id, level, day, start, duration in timetable.models.TeacherTimePreference.objects.filter(
+                preferenceset_id=tt.preferenceset_id, level__in=PREFERENCE_LEVELS,
+                teacher_id__in=occupancy.teacher_index.keys()
+        ).values_list('teacher_id', 'level', 'day', 'start', 'duration'):
+            snapshot.teacher_preferences[level][occupancy.teacher_index[teacher_id],
+                                                slots(day, start, duration)] = True
+        # Groups inherit time preferences of their ancestors, preferences are
+        # read from the preference set of the timetable (from all preference
+        # sets if it has none, like timetable.models.unavailable_masks)
+        for group_id, mask in timetable.models.unavailable_masks(tt.preferenceset_id).items():
+            if group_id in group_ids:
+                snapshot.group_preferences[group_id]['CANT'] = mask_slots(mask)
+        preferences = timetable.models.GroupTimePreference.objects.filter(level='HATE')
+        if tt.preferenceset_id is not None:
+            preferences = preferences.filter(preferenceset_id=tt.preferenceset_id)
+        hate = defaultdict(list)
+        for group_id, day, start, duration in preferences.values_list('group_id', 'day', 'start', 'duration'):
+            hate[group_id].append(slots(day, start, duration))
+        for ancestor_id, group_id in timetable.models.GroupClosure.objects.filter(
+                ancestor_id__in=list(hate.keys()), descendant_id__in=group_ids
+        ).values_list('ancestor_id', 'descendant_id'):
+            mask = snapshot.group_preferences[group_id].setdefault('HATE', np.zeros(SLOTS, dtype=bool))
+            for covered in hate[ancestor_id]:
+                mask[covered] = True
+        return snapshot
+
+    def shards(self, measure, n):
+        """
+        Split the rows the measure is computed for into (at most) n shards.
+        """
+        if measure == 'student_overlaps':
+            rows = range(len(self.occupancy.student_ids))
+        elif measure in ['teachers', 'teacher_preferences']:
+            rows = range(len(self.occupancy.teacher_ids))
+        elif measure == 'classrooms':
+            rows = self.occupancy.classroom_ids
+        else:
+            rows = sorted(self.group_names)
+        return [[int(row) for row in shard]
+                for shard in np.array_split(np.array(rows, dtype=np.intp), n) if len(shard)]
+
+
+def student_overlaps(snapshot, rows):
+    """
+    Return study, classyear -> [students, students with overlaps, overlapping hours].
+    """
+    counts = snapshot.occupancy.student_counts
+    result = defaultdict(lambda: [0, 0, 0])
+    for row in rows:
+        overlaps = excess(counts[row])
+        totals = result[snapshot.student_studies[row]]
+        totals[0] += 1
+        totals[1] += overlaps > 0
+        totals[2] += overlaps
+    return dict(result)
+
+
+def teachers(snapshot, rows):
+    """
+    Return hours, days, gaps (free hours between the first and the last
+    hour of a day) and double bookings of teachers.
+    """
+    result = []
+    for row in rows:
+        counts = snapshot.occupancy.teacher_counts[row]
+        busy = (counts > 0).reshape(len(WEEKDAYS), N_HOURS)
+        gaps = 0
+        for day in busy:
+            hours = np.flatnonzero(day)
+            if len(hours):
+                gaps += hours[-1] - hours[0] + 1 - len(hours)
+        teacher_id = snapshot.occupancy.teacher_ids[row]
+        result.append({'name': snapshot.teacher_names.get(teacher_id, str(teacher_id)),
+                       'hours': int(busy.sum()), 'days': int(busy.any(axis=1).sum()),
+                       'gaps': int(gaps), 'overlaps': excess(counts)})
+    return result
+
+
+def classrooms(snapshot, classroom_ids):
+    """
+    Return utilization of classrooms and the number of allocations
+    in too small (see Allocation.is_classroom_too_small) and too big
+    (see Allocation.is_classroom_too_big) classrooms.
+    """
+    occupancy = snapshot.occupancy
+    classroom_allocations = defaultdict(list)
+    for a in occupancy.allocations.values():
+        classroom_allocations[a.classroom_id].append(a)
+    result = []
+    for classroom_id in classroom_ids:
+        capacity = snapshot.classroom_capacities.get(classroom_id, 0)
+        counts = occupancy.classroom_counts[occupancy.classroom_index[classroom_id]]
+        sizes = [occupancy.realization_size(a.realization_id) for a in classroom_allocations[classroom_id]]
+        hours = int((counts > 0).sum())
+        result.append({'name': snapshot.classroom_names.get(classroom_id, str(classroom_id)),
+                       'capacity': capacity, 'allocations': len(sizes), 'hours': hours,
+                       'utilization': round(hours / SLOTS, 3),
+                       'too_small': sum(size > capacity for size in sizes),
+                       'too_big': sum(size < capacity * snapshot.min_fill for size in sizes),
+                       'double_bookings': excess(counts)})
+    return result
+
+
+def teacher_preferences(snapshot, rows):
+    """
+    Return the number of hours teachers teach against their time preferences.
+    """
+    result = []
+    for row in rows:
+        busy = snapshot.occupancy.teacher_counts[row] > 0
+        teacher_id = snapshot.occupancy.teacher_ids[row]
+        violations = {level: int((busy & snapshot.teacher_preferences[level][row]).sum())
+                      for level in PREFERENCE_LEVELS}
+        if any(violations.values()):
+            result.append(dict(name=snapshot.teacher_names.get(teacher_id, str(teacher_id)), **violations))
+    return result
+
+
+def group_preferences(snapshot, group_ids):
+    """
+    Return the number of hours groups attend against their time preferences.
+    """
+    occupancy = snapshot.occupancy
+    group_slots = defaultdict(list)
+    for a in occupancy.allocations.values():
+        for group_id in occupancy.realization_groups[a.realization_id]:
+            group_slots[group_id].append(a.slots)
+    result = []
+    for group_id in group_ids:
+        preferences = snapshot.group_preferences.get(group_id, {})
+        violations = {level: sum(int(preferences[level][s].sum()) for s in group_slots[group_id])
+                      if level in preferences else 0 for level in PREFERENCE_LEVELS}
+        if any(violations.values()):
+            result.append(dict(name=snapshot.group_names[group_id], **violations))
+    return result
+
+
+MEASURES = [
+    ('student_overlaps', student_overlaps),
+    ('teachers', teachers),
+    ('classrooms', classrooms),
+    ('teacher_preferences', teacher_preferences),
+    ('group_preferences', group_preferences),
+]
+
+# Snapshot of the worker process, see _init_worker
+_snapshot = None
+
+
+def _init_worker(snapshot):
+    global _snapshot
+    _snapshot = snapshot
+
+
+def _compute(task):
+    name, shard = task
+    return name, dict(MEASURES)[name](_snapshot, shard)
+
+
+def report(snapshot, jobs=1):
+    """
+    Compute all measures of the snapshot in the given number of processes.
+    Returns a dict with a summary and a list of rows for every measure.
+    """
+    shards_per_measure = jobs * 4 if jobs > 1 else 1
+    tasks = [(name, shard) for name, _ in MEASURES
+             for shard in snapshot.shards(name, shards_per_measure)]
+    if jobs > 1:
+        # Workers are forked, so they inherit the configured Django and
+        # get the snapshot once instead of with every task
+        with multiprocessing.get_context('fork').Pool(jobs, _init_worker, (snapshot,)) as pool:
+            results = pool.map(_compute, tasks)
+    else:
+        _init_worker(snapshot)
+        results = [_compute(task) for task in tasks]
+
+    result = {name: [] for name, _ in MEASURES}
+    overlaps = defaultdict(lambda: [0, 0, 0])
+    for name, rows in results:
+        if name == 'student_overlaps':
+            for key, totals in rows.items():
+                overlaps[key] = [a + b for a, b in zip(overlaps[key], totals)]
+        else:
+            result[name].extend(rows)
+    result['student_overlaps'] = [
+        {'name': "{} {}".format(study, classyear), 'students': students,
+         'students_with_overlaps': int(with_overlaps), 'overlaps': int(hours)}
+        for (study, classyear), (students, with_overlaps, hours) in sorted(overlaps.items(), key=str)]
+    for name, _ in MEASURES[1:]:
+        result[name].sort(key=lambda row: row['name'])
+
+    conflicts = snapshot.occupancy.conflicts()
+    result['summary'] = {
+        'student_overlaps': conflicts.students,
+        'teacher_overlaps': conflicts.teachers,
+        'classroom_double_bookings': conflicts.classrooms,
+        'teacher_gaps': sum(row['gaps'] for row in result['teachers']),
+        'too_small_classrooms': sum(row['too_small'] for row in result['classrooms']),
+        'too_big_classrooms': sum(row['too_big'] for row in result['classrooms']),
+    }
+    for level in PREFERENCE_LEVELS:
+        result['summary']['teacher_{}'.format(level.lower())] = sum(
+            row[level] for row in result['teacher_preferences'])
+        result['summary']['group_{}'.format(level.lower())] = sum(
+            row[level] for row in result['group_preferences'])
+    return result
@@ -0,0 +1,106 @@
+"""
+Response cache and conditional GET for timetable pages.
+
+Responses are keyed by the view, the timetable version (see timetable.signals),
+the normalized query, the language and the user flags that change the page,
+so stale pages are never served. Use a shared cache backend (see CACHES in
+settings) so all workers share cached pages.
+
+The same key is sent as the ETag and Timetable.modified as Last-Modified,
+so browsers and proxies can revalidate pages with If-None-Match and
+If-Modified-Since.
+"""
+import calendar
+import hashlib
+import json
+import logging
+from functools import wraps
+
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.utils import timezone, translation
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import quote_etag, http_date
+
+import timetable.models
+
+logger = logging.getLogger(__name__)
+
+RESPONSE_CACHE_TIMEOUT = 24 * 60 * 60
+
+
+def normalized_query(request):
+    """
+    Return the GET parameters as a sorted list of (name, sorted values).
+    """
+    return [(name, sorted(set(request.GET.getlist(name)))) for name in sorted(request.GET.keys())]
+
+
+def response_key(request, tt, *extra):
+    """
+    Return the hash identifying the response of a timetable page.
+    """
+    key = json.dumps([tt.id, tt.version, request.user.is_staff, translation.get_language(),
+                      normalized_query(request), extra], default=str)
+    return hashlib.md5(key.encode("utf-8")).hexdigest()
+
+
+def last_modified_timestamp(tt):
+    modified = tt.modified
+    if timezone.is_naive(modified):
+        modified = timezone.make_aware(modified)
+    return calendar.timegm(modified.utctimetuple())
+
+
+def _timetable_response(prefix, vary, store):
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, timetable_slug=None, *args, **kwargs):
+            tt = timetable.models.Timetable.objects.filter(slug=timetable_slug).first()
+            if request.method not in ['GET', 'HEAD'] or tt is None:
+                return view(request, timetable_slug, *args, **kwargs)
+            key = response_key(request, tt, prefix, args, sorted(kwargs.items()),
+                               vary(request) if vary is not None else None)
+            etag = quote_etag(key)
+            last_modified = last_modified_timestamp(tt)
+            response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+            if response is None:
+                cache_key = "{}_{}".format(prefix, key)
+                cached = cache.get(cache_key) if store else None
+                if cached is not None:
+                    content, content_type = cached
+                    response = HttpResponse(content, content_type=content_type)
+                else:
+                    response = view(request, timetable_slug, *args, **kwargs)
+                    if store and response.status_code == 200 and not response.streaming:
+                        cache.set(cache_key, (response.content, response['Content-Type']),
+                                  RESPONSE_CACHE_TIMEOUT)
+            if response.status_code in [200, 304]:
+                response.setdefault('ETag', etag)
+                response.setdefault('Last-Modified', http_date(last_modified))
+                # Proxies may keep the page, but must revalidate it
+                patch_cache_control(response, no_cache=True)
+            return response
+
+        return wrapper
+
+    return decorator
+
+
+def cache_timetable_response(prefix, vary=None):
+    """
+    Cache responses of a view taking the timetable_slug argument and answer
+    conditional requests for them.
+    Extra view arguments are part of the key, vary(request) can return
+    further parts of the key (for instance the user id on personalized pages).
+    Only successful non-streaming GET responses are cached.
+    """
+    return _timetable_response(prefix, vary, store=True)
+
+
+def conditional_timetable_response(prefix, vary=None):
+    """
+    Answer conditional requests for a view taking the timetable_slug argument
+    and add validators to its responses, without caching them.
+    """
+    return _timetable_response(prefix, vary, store=False)
@@ -0,0 +1,132 @@
+"""
+Keep the StudentRealization index up to date.
+
+The index depends on group membership of students, on realizations they
+follow and on groups of realizations.
+
+Changes of group membership, followed realizations and subjects give the
+affected timetables a new version (see timetable.signals).
+
+Occupancy indices in process memory (see friprosveta.occupancy) follow
+saved and deleted allocations.
+"""
+import logging
+
+from django.db.models.signals import pre_save, pre_delete, post_save, post_delete, m2m_changed
+from django.dispatch import receiver
+
+from friprosveta.models import Student, StudentRealization, Subject
+from friprosveta.occupancy import fresh_index_ids, update_indices
+from timetable.models import ActivityRealization, Allocation, Group, Timetable
+from timetable.signals import connect_model_signal, activity_timetable_ids, \
+    bump_timetable_versions
+
+logger = logging.getLogger(__name__)
+
+
+def group_student_ids(group_ids):
+    """
+    Return ids of students in the given groups.
+    """
+    return set(Student.groups.through.objects.filter(
+        group_id__in=group_ids).values_list('student_id', flat=True))
+
+
+def _source_field(instance):
+    return "{}_id".format(instance._meta.concrete_model._meta.model_name)
+
+
+def membership_timetable_ids(sender, target_ids):
+    """
+    Return ids of timetables showing the given groups (for Student.groups)
+    or realizations (for Student.follows).
+    """
+    if sender is Student.groups.through:
+        return set(Timetable.objects.filter(
+            groupset__groups__id__in=target_ids).values_list('id', flat=True))
+    activity_ids = list(ActivityRealization.objects.filter(
+        id__in=target_ids).values_list('activity_id', flat=True))
+    return activity_timetable_ids(activity_ids)
+
+
+@receiver(m2m_changed, sender=Student.groups.through)
+@receiver(m2m_changed, sender=Student.follows.through)
+def student_links_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Handle changes of groups and followed realizations of students (from both sides).
+    Membership is shown on timetable pages, so affected timetables get a new version.
+    """
+    target_field = 'group_id' if sender is Student.groups.through else 'activityrealization_id'
+    if action == 'pre_clear':
+        if reverse:
+            instance._cleared_ids = list(sender.objects.filter(
+                **{_source_field(instance): instance.pk}
+            ).values_list('student_id', flat=True))
+        else:
+            instance._cleared_ids = list(sender.objects.filter(
+                student_id=instance.pk).values_list(target_field, flat=True))
+        return
+    if action not in ['post_add', 'post_remove', 'post_clear']:
+        return
+    ids = getattr(instance, '_cleared_ids', []) if action == 'post_clear' else pk_set
+    if reverse:
+        student_ids, target_ids = ids, [instance.pk]
+    else:
+        student_ids, target_ids = [instance.pk], ids
+    StudentRealization.refresh(student_ids)
+    bump_timetable_versions(membership_timetable_ids(sender, target_ids))
+
+
+@receiver(m2m_changed, sender=ActivityRealization.groups.through)
+def realization_groups_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Refresh students of groups added to (or removed from) realizations.
+    """
+    if reverse:
+        group_ids = [instance.pk]
+    elif action == 'pre_clear':
+        instance._cleared_group_ids = list(instance.groups.values_list('id', flat=True))
+        return
+    elif action == 'post_clear':
+        group_ids = getattr(instance, '_cleared_group_ids', [])
+    else:
+        group_ids = pk_set
+    if action in ['post_add', 'post_remove', 'post_clear']:
+        StudentRealization.refresh(group_student_ids(group_ids))
+
+
+def remember_group_students(sender, instance, **kwargs):
+    instance._deleted_student_ids = group_student_ids([instance.pk])
+
+
+def group_deleted(sender, instance, **kwargs):
+    StudentRealization.refresh(getattr(instance, '_deleted_student_ids', []))
+
+
+connect_model_signal(pre_delete, remember_group_students, Group)
+connect_model_signal(post_delete, group_deleted, Group)
+
+
+@receiver(post_save, sender=Subject)
+def subject_changed(sender, instance, **kwargs):
+    bump_timetable_versions(activity_timetable_ids(
+        list(instance.activities.values_list('id', flat=True))))
+
+
+def remember_fresh_indices(sender, instance, **kwargs):
+    instance._fresh_index_ids = fresh_index_ids()
+
+
+def allocation_saved(sender, instance, **kwargs):
+    # Runs after timetable.signals (timetable is installed before friprosveta)
+    update_indices(instance, getattr(instance, '_fresh_index_ids', set()))
+
+
+def allocation_deleted(sender, instance, **kwargs):
+    update_indices(instance, getattr(instance, '_fresh_index_ids', set()), deleted=True)
+
+
+connect_model_signal(pre_save, remember_fresh_indices, Allocation)
+connect_model_signal(pre_delete, remember_fresh_indices, Allocation)
+connect_model_signal(post_save, allocation_saved, Allocation)
+connect_model_signal(post_delete, allocation_deleted, Allocation)
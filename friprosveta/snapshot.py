@@ -0,0 +1,199 @@
+"""
+Precompiled per-timetable allocation snapshots.
+
+A snapshot is a denormalized table of all allocations shown in a timetable
+(including allocations from respected timetables), together with everything
+the public allocation views display: activities, subjects, classrooms,
+teachers and groups (see friprosveta.viewmodels). It is built in a fixed
+number of queries and then filtered in Python, so serving the allocation
+views does not touch the allocation tables at all.
+
+Snapshots are keyed by Timetable.version, which is refreshed on every
+relevant change (see timetable.signals). They are kept in process memory and
+in the Django cache, so workers sharing the cache share snapshots as well.
+"""
+import logging
+from collections import defaultdict
+
+from django.core.cache import cache
+from django.db.models import Q
+
+import friprosveta.models
+import timetable.models
+from friprosveta.viewmodels import AllocationLoader
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_CACHE_TIMEOUT = 24 * 60 * 60
+
+
+def _ints(values):
+    ret = set()
+    for v in values:
+        try:
+            ret.add(int(v))
+        except (TypeError, ValueError):
+            pass
+    return ret
+
+
+class AllocationSnapshot(object):
+    """
+    Denormalized allocations of a single timetable.
+    """
+    # Filled on first use by display_names
+    _display_names = None
+
+    def __init__(self, timetable_id, version):
+        self.timetable_id = timetable_id
+        self.version = version
+        self.allocations = []
+        # id -> GroupEntry for all groups in the relevant groupsets
+        self.groups = dict()
+        self.group_children = defaultdict(list)
+        # id -> TimetableEntry
+        self.timetables = dict()
+
+    @classmethod
+    def build(cls, tt):
+        """
+        Build the snapshot for the given timetable in a fixed number of queries.
+        """
+        logger.info("Building allocation snapshot for {}".format(tt.slug))
+        snapshot = cls(tt.id, tt.version)
+        loader = AllocationLoader(timetable.models.Allocation.objects.filter(
+            Q(timetable__pk=tt.pk) | Q(timetable__respected_by__pk=tt.pk)))
+        snapshot.allocations = loader.load(groupset_timetable_ids=[tt.id])
+        snapshot.timetables = loader.timetables
+        snapshot.groups = loader.groups
+        for group in snapshot.groups.values():
+            if group.parent_id is not None:
+                snapshot.group_children[group.parent_id].append(group.id)
+        return snapshot
+
+    def group_family_ids(self, group_ids):
+        """
+        Return ids of the given groups, all their subgroups and all their parents.
+        Same as timetable.models.Group.family, but without queries.
+        """
+        family = set()
+        stack = [g for g in group_ids if g in self.groups]
+        while stack:
+            group_id = stack.pop()
+            if group_id in family:
+                continue
+            family.add(group_id)
+            stack.extend(self.group_children[group_id])
+        for group_id in group_ids:
+            parent_id = self.groups[group_id].parent_id if group_id in self.groups else None
+            while parent_id is not None and parent_id in self.groups:
+                family.add(parent_id)
+                parent_id = self.groups[parent_id].parent_id
+        return family
+
+    def display_names(self):
+        """
+        Return display names of the entities in the snapshot by the filter
+        parameter they are selected with, as a dictionary
+        parameter -> {key: name}. Keys are strings as in the query string,
+        timetable_slug maps to (id, name) pairs.
+        """
+        if self._display_names is None:
+            names = defaultdict(dict)
+            for t in self.timetables.values():
+                names['timetable_slug'][t.slug] = (t.id, t.name)
+            for g in self.groups.values():
+                names['group'][str(g.id)] = g.name
+            for a in self.allocations:
+                names['activity'][str(a.activity.id)] = a.activity.name
+                if a.subject is not None:
+                    names['subject'][a.subject.code] = a.subject.name
+                if a.classroom is not None:
+                    names['classroom'][str(a.classroom.id)] = a.classroom.name
+                for t in a.teachers:
+                    names['teacher'][str(t.id)] = str(t)
+            self._display_names = dict(names)
+        return self._display_names
+
+    def _timetable_matches(self, allocation, timetable_ids):
+        if allocation.timetable_id in timetable_ids:
+            return True
+        return not self.timetables[allocation.timetable_id].respects.isdisjoint(timetable_ids)
+
+    def filter(self, param_ids, is_staff=False):
+        """
+        Return the list of allocations matching the given filter parameters.
+        The semantics are the same as in friprosveta.views._allocation_set.
+        """
+        allparams = set(['teacher', 'classroom', 'group', 'activity',
+                         'type', 'student', 'realization', 'subject'])
+        # Do not allow unfiltered queries
+        if all(param not in param_ids for param in allparams):
+            return []
+        allocations = self.allocations
+        if 'timetable_slug' in param_ids:
+            slugs = set(param_ids['timetable_slug'])
+            timetable_ids = set(t.id for t in self.timetables.values() if t.slug in slugs)
+            allocations = [a for a in allocations if self._timetable_matches(a, timetable_ids)]
+        if 'timetable' in param_ids:
+            timetable_ids = _ints(param_ids['timetable'])
+            allocations = [a for a in allocations if self._timetable_matches(a, timetable_ids)]
+        if not is_staff:
+            allocations = [a for a in allocations if a.timetable_public]
+        if 'day' in param_ids:
+            days = set(param_ids['day'])
+            allocations = [a for a in allocations if a.day in days]
+        if 'classroom' in param_ids:
+            classroom_ids = _ints(param_ids['classroom'])
+            allocations = [a for a in allocations
+                           if a.classroom is not None and a.classroom.id in classroom_ids]
+        if 'teacher' in param_ids:
+            teacher_ids = _ints(param_ids['teacher'])
+            allocations = [a for a in allocations
+                           if not teacher_ids.isdisjoint(a.teacher_ids)]
+        if 'activity' in param_ids:
+            activity_ids = _ints(param_ids['activity'])
+            allocations = [a for a in allocations if a.activity.id in activity_ids]
+        if 'subject' in param_ids:
+            codes = set(param_ids['subject'])
+            allocations = [a for a in allocations
+                           if a.subject is not None and a.subject.code in codes]
+        if 'type' in param_ids:
+            types = set(param_ids['type'])
+            allocations = [a for a in allocations if a.activity.type in types]
+        if 'realization' in param_ids:
+            realization_ids = _ints(param_ids['realization'])
+            allocations = [a for a in allocations if a.realization_id in realization_ids]
+        if 'student' in param_ids:
+            realization_ids = friprosveta.models.StudentRealization.realization_ids(param_ids['student'])
+            allocations = [a for a in allocations if a.realization_id in realization_ids]
+        if 'group' in param_ids:
+            group_ids = self.group_family_ids(_ints(param_ids['group']))
+            allocations = [a for a in allocations
+                           if not group_ids.isdisjoint(a.group_ids)]
+        return allocations
+
+
+_snapshots = dict()
+
+
+def _cache_key(tt):
+    return "allocation_snapshot_{}_{}".format(tt.id, tt.version)
+
+
+def get_snapshot(tt):
+    """
+    Return the up to date snapshot for the given timetable.
+    Look into process memory first, then into the Django cache and
+    build (and store) it when it is not found.
+    """
+    snapshot = _snapshots.get(tt.id)
+    if snapshot is not None and snapshot.version == tt.version:
+        return snapshot
+    key = _cache_key(tt)
+    snapshot = cache.get(key)
+    if snapshot is None:
+        snapshot = AllocationSnapshot.build(tt)
+        cache.set(key, snapshot, SNAPSHOT_CACHE_TIMEOUT)
+    _snapshots[tt.id] = snapshot
+    return snapshot
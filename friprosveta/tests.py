@@ -1,9 +1,18 @@
 from datetime import datetime, timedelta
+from io import StringIO
+import json
+import os
+import re
+import tempfile
 
+from django.core.management import call_command
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.db import connection
 from django.contrib.sites.models import Site
 from django.test import Client
 from django.test.client import RequestFactory
+from django.contrib.auth.models import AnonymousUser
 
 from friprosveta.studis import Studij
 from friprosveta.management.commands.import_studis_students import get_parents
@@ -14,6 +23,14 @@ from timetable.models import default_timetable
 
 from model_mommy import mommy
 import friprosveta
+import friprosveta.export
+import friprosveta.snapshot
+import friprosveta.navigation
+import friprosveta.occupancy
+import friprosveta.quality
+import friprosveta.viewmodels
+import friprosveta.views
+import timetable.models
 import unittest
 
 
@@ -30,6 +47,14 @@ class MyTestCase(TestCase):
         """
         self.assertEqual(len(obj), length, msg)
 
+    def run_commit_hooks(self):
+        """
+        Run callbacks registered by transaction.on_commit (TestCase never commits).
+        """
+        callbacks, connection.run_on_commit = connection.run_on_commit, []
+        for _, callback in callbacks:
+            callback()
+
 # class Test(TestCase):
 #     def test_import_studis_students_get_parents(self):
 #         studij = Studij(2018)
@@ -98,6 +123,32 @@ class StudentOverlapsTest(MyTestCase):
         self.assertTrue(self.r1 in self.student.realizations(tt))
         self.assertTrue(self.r2 in self.student.realizations(tt))
 
+    def test_realizations_follows(self):
+        tt = self.tt
+        self.g1.students.add(self.student)
+        self.g2.students.add(self.student)
+        self.student.follows.add(self.r2)
+        self.assertEqual(list(self.student.realizations(tt)), [self.r2],
+                         "Followers attend only followed realizations")
+        self.assertEqual(friprosveta.models.StudentRealization.realization_ids([self.student.studentId]),
+                         {self.r2.id})
+        self.student.follows.clear()
+        self.assertLength(self.student.realizations(tt), 2)
+        self.r1.groups.remove(self.g1)
+        self.assertEqual(list(self.student.realizations(tt)), [self.r2])
+        self.g2.delete()
+        self.assertEmpty(self.student.realizations(tt))
+
+    def test_realization_index_rebuild(self):
+        self.g1.students.add(self.student)
+        self.student.follows.add(self.r2)
+        links = set(friprosveta.models.StudentRealization.objects.values_list(
+            'student_id', 'realization_id', 'groupset_id', 'followed'))
+        friprosveta.models.StudentRealization.rebuild()
+        self.assertEqual(set(friprosveta.models.StudentRealization.objects.values_list(
+            'student_id', 'realization_id', 'groupset_id', 'followed')), links)
+        self.assertEqual(links, {(self.student.id, self.r2.id, self.groupset.id, True)})
+
     def test_busy_hours(self):
         tt = self.tt
         self.assertEmpty(self.student.busy_hours(tt))
@@ -155,6 +206,34 @@ class StudentOverlapsTest(MyTestCase):
         self.alloc2.save()
         self.assertFalse(self.student.overlaps(self.tt), "No overlaps when activities do not overlap in time")
 
+    def test_bulk_busy(self):
+        students = [self.student] + mommy.make('friprosveta.Student', _quantity=2)
+        self.g1.students.add(students[0], students[1])
+        self.g2.students.add(students[0], students[2])
+        with CaptureQueriesContext(connection) as queries:
+            busy = friprosveta.models.Student.bulk_busy(self.tt, students)
+        self.assertLength(queries, 2)
+        with self.assertNumQueries(1):
+            self.student.busy_hours(self.tt)
+        for student in students:
+            self.assertEqual(busy.busy_hours(student.id), student.busy_hours(self.tt))
+            self.assertEqual(busy.overlaps(student.id), student.overlaps(self.tt))
+        self.assertEqual(busy.overlapping_student_ids(), [students[0].id])
+        self.assertEqual(list(friprosveta.models.Student.with_overlaps(self.tt)), [students[0]])
+        self.assertFalse(busy.is_available(students[1].id, self.alloc1))
+        self.assertFalse(busy.is_available(students[1].id, self.alloc2))
+        self.alloc2.start = '12:00'
+        self.alloc2.save()
+        self.assertEqual(friprosveta.models.Student.with_overlaps(self.tt).count(), 0)
+        self.g1.short_name = '1_BUN-RI_SEM_01'
+        self.g1.save()
+        self.assertEqual(friprosveta.models.Student.find_substitution(self.tt, self.alloc1, self.alloc2, 'LV'),
+                         set())
+        self.g1.short_name = '1_BUN-RI_LV_01'
+        self.g1.save()
+        self.assertEqual(friprosveta.models.Student.find_substitution(self.tt, self.alloc1, self.alloc2, 'LV'),
+                         {students[1]})
+
 
 class FillGroupsTest(TestCase):
     def setUp(self):
@@ -385,3 +464,951 @@ class GroupSizeHintTest(TestCase):
         self.assertEqual(val, expected,
                          "Strategy '{}' for {} and methods {} should return {}".format(strategy, self.g2, methods,
                                                                                        expected))
+
+
+class AllocationSnapshotTest(MyTestCase):
+    """
+    Test the precompiled allocation snapshot used by the allocation views.
+    """
+
+    def setUp(self):
+        super(AllocationSnapshotTest, self).setUp()
+        self.groupset = mommy.make('timetable.GroupSet')
+        self.activityset = mommy.make('timetable.ActivitySet')
+        self.tt = mommy.make('timetable.Timetable', groupset=self.groupset,
+                             activityset=self.activityset, public=True)
+        activities = mommy.make('timetable.Activity', _quantity=2, duration=2,
+                                activityset=self.activityset)
+        self.r1 = mommy.make('timetable.ActivityRealization', activity=activities[0])
+        self.r2 = mommy.make('timetable.ActivityRealization', activity=activities[1])
+        self.alloc1 = mommy.make('timetable.Allocation', timetable=self.tt,
+                                 activityRealization=self.r1, day='MON', start='08:00')
+        self.alloc2 = mommy.make('timetable.Allocation', timetable=self.tt,
+                                 activityRealization=self.r2, day='TUE', start='10:00')
+        self.parent = mommy.make('timetable.Group', short_name='1_BUN-RI', groupset=self.groupset)
+        self.g1 = mommy.make('timetable.Group', short_name='1_BUN-RI_LV_01',
+                             parent=self.parent, groupset=self.groupset)
+        self.r1.groups.add(self.parent)
+        self.r2.groups.add(self.g1)
+        self.teacher = mommy.make('timetable.Teacher')
+        self.r2.teachers.add(self.teacher)
+
+    def snapshot(self):
+        tt = friprosveta.models.Timetable.objects.get(id=self.tt.id)
+        return friprosveta.snapshot.get_snapshot(tt)
+
+    def test_filter(self):
+        snapshot = self.snapshot()
+        self.assertEmpty(snapshot.filter({}), "Unfiltered queries are not allowed")
+        teacher_allocations = snapshot.filter({'teacher': [str(self.teacher.id)]})
+        self.assertEqual([a.id for a in teacher_allocations], [self.alloc2.id])
+        # Group filter includes parents and subgroups
+        group_allocations = snapshot.filter({'group': [str(self.g1.id)]})
+        self.assertEqual(set(a.id for a in group_allocations), {self.alloc1.id, self.alloc2.id})
+        entry = teacher_allocations[0]
+        self.assertEqual((entry.day_index, entry.hour_index, entry.duration), (1, 3, 2))
+        self.assertEqual(entry.teacher_ids, [self.teacher.id])
+        self.assertEqual(entry.group_ids, [self.g1.id])
+
+    def test_public(self):
+        self.tt.public = False
+        self.tt.save()
+        snapshot = self.snapshot()
+        self.assertEmpty(snapshot.filter({'group': [self.g1.id]}))
+        self.assertLength(snapshot.filter({'group': [self.g1.id]}, is_staff=True), 2)
+
+    def test_invalidation(self):
+        version = self.snapshot().version
+        self.alloc1.day = 'WED'
+        self.alloc1.save()
+        snapshot = self.snapshot()
+        self.assertNotEqual(snapshot.version, version, "Moving an allocation changes the version")
+        self.assertEqual([a.day for a in snapshot.filter({'realization': [self.r1.id]})], ['WED'])
+        version = snapshot.version
+        self.r1.teachers.add(self.teacher)
+        snapshot = self.snapshot()
+        self.assertNotEqual(snapshot.version, version, "Changing teachers changes the version")
+        self.assertLength(snapshot.filter({'teacher': [self.teacher.id]}), 2)
+        self.alloc2.delete()
+        self.assertLength(self.snapshot().filter({'teacher': [self.teacher.id]}), 1)
+
+    def test_invalidation_proxy_models(self):
+        version = self.snapshot().version
+        friprosveta.models.ActivityRealization.objects.get(id=self.r1.id).save()
+        self.assertNotEqual(self.snapshot().version, version,
+                            "Saving through proxy models changes the version")
+
+    def test_titles(self):
+        snapshot = self.snapshot()
+        param_ids = {'timetable_slug': [self.tt.slug],
+                     'teacher': [self.teacher.id], 'group': [self.g1.id, self.parent.id]}
+        with CaptureQueriesContext(connection) as queries:
+            title, subtitles = friprosveta.views._titles(param_ids, snapshot.display_names())
+        self.assertLength(queries, 0, "Titles come from the snapshot")
+        self.assertEqual(title, self.tt.name)
+        self.assertEqual(subtitles, [str(self.teacher), "{}; {}".format(self.g1.name, self.parent.name)])
+        other = mommy.make('timetable.Teacher', code='other')
+        param_ids['teacher'].append(other.id)
+        self.assertEqual(friprosveta.views._titles(param_ids, snapshot.display_names())[1][0],
+                         "{}; {}".format(self.teacher, other))
+        with CaptureQueriesContext(connection) as queries:
+            friprosveta.views._titles(param_ids, snapshot.display_names())
+        self.assertLength(queries, 0, "Names missing from the snapshot are cached")
+
+
+class AllocationLoaderTest(MyTestCase):
+    """
+    Test the batched allocation view-model loader.
+    """
+
+    def setUp(self):
+        super(AllocationLoaderTest, self).setUp()
+        self.tt = mommy.make('timetable.Timetable')
+        self.subject = mommy.make('friprosveta.Subject', code='63001')
+        self.n_allocations = 0
+
+    def add_allocations(self, n):
+        for i in range(self.n_allocations, self.n_allocations + n):
+            activity = mommy.make('friprosveta.Activity', subject=self.subject, duration=1,
+                                  type='P' if i % 2 else 'LV')
+            realization = mommy.make('timetable.ActivityRealization', activity=activity)
+            realization.teachers.add(mommy.make('timetable.Teacher', code=str(i)))
+            realization.groups.add(mommy.make('timetable.Group'))
+            mommy.make('timetable.Allocation', timetable=self.tt, activityRealization=realization,
+                       day='MON', start='08:00')
+        self.n_allocations += n
+
+    def count_queries(self):
+        with CaptureQueriesContext(connection) as context:
+            loader = friprosveta.viewmodels.AllocationLoader(
+                timetable.models.Allocation.objects.filter(timetable=self.tt))
+            entries = loader.load()
+            friprosveta.viewmodels.allocation_view_models(entries)
+        return len(context.captured_queries), entries
+
+    def test_constant_queries(self):
+        self.add_allocations(2)
+        queries_few, entries = self.count_queries()
+        self.assertLength(entries, 2)
+        self.add_allocations(20)
+        queries_many, entries = self.count_queries()
+        self.assertLength(entries, 22)
+        self.assertEqual(queries_few, queries_many)
+
+    def test_view_models(self):
+        self.add_allocations(3)
+        entries = self.count_queries()[1]
+        vms, colors = friprosveta.viewmodels.allocation_view_models(entries)
+        self.assertEqual([vm.object.id for vm in vms], [a.id for a in entries])
+        self.assertEqual(set(colors.keys()), set(a.id for a in entries))
+        self.assertEqual(vms[0].subject.code, '63001')
+        self.assertEqual(len(entries[0].teachers), 1)
+        # Activities of the same subject share the hue
+        self.assertEqual(len(set(c.h for c in colors.values())), 1)
+
+
+class AllocationsIcalTest(MyTestCase):
+    """
+    Test the cached iCal feed.
+    """
+
+    def setUp(self):
+        super(AllocationsIcalTest, self).setUp()
+        self.request_factory = RequestFactory()
+        self.tt = mommy.make('timetable.Timetable', slug='ical', public=True)
+        activity = mommy.make('friprosveta.Activity', duration=2, type='P')
+        self.realization = mommy.make('timetable.ActivityRealization', activity=activity)
+        self.group = mommy.make('timetable.Group')
+        self.realization.groups.add(self.group)
+        self.allocation = mommy.make('timetable.Allocation', timetable=self.tt, activityRealization=self.realization,
+                                     classroom=mommy.make('timetable.Classroom'), day='MON', start='09:00')
+
+    def get(self, **headers):
+        request = self.request_factory.get("/", {'group': self.group.id}, **headers)
+        request.user = AnonymousUser()
+        return friprosveta.views.allocations_ical(request, 'ical')
+
+    def test_etag(self):
+        response = self.get()
+        self.assertEqual(response.status_code, 200)
+        body = b"".join(response.streaming_content)
+        self.assertIn("UID:urnikfri-{}".format(self.allocation.id).encode(), body)
+        etag = response["ETag"]
+        self.assertEqual(self.get(HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        # Served from cache
+        self.assertEqual(b"".join(self.get().streaming_content), body)
+        self.allocation.day = 'TUE'
+        self.allocation.save()
+        response = self.get(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b"BYDAY=TU", b"".join(response.streaming_content))
+
+
+class AllocationsJsonV2Test(MyTestCase):
+    """
+    Test the paginated compact allocations JSON.
+    """
+
+    def setUp(self):
+        super(AllocationsJsonV2Test, self).setUp()
+        self.request_factory = RequestFactory()
+        self.tt = mommy.make('timetable.Timetable', slug='json', public=True)
+        self.group = mommy.make('timetable.Group', short_name='1_BUN-RI')
+        self.allocations = []
+        for i, day in enumerate(['MON', 'TUE', 'WED']):
+            subject = mommy.make('friprosveta.Subject', code=str(i))
+            realization = mommy.make('timetable.ActivityRealization',
+                                     activity=mommy.make('friprosveta.Activity', subject=subject, duration=1))
+            realization.groups.add(self.group)
+            self.allocations.append(mommy.make('timetable.Allocation', timetable=self.tt,
+                                               activityRealization=realization, day=day, start='07:00'))
+
+    def get(self, **params):
+        params['group'] = self.group.id
+        request = self.request_factory.get("/", params)
+        request.user = AnonymousUser()
+        response = friprosveta.views.allocations_json_v2(request, 'json')
+        if response.status_code != 200:
+            return response.status_code, None
+        return response.status_code, json.loads(b"".join(response.streaming_content).decode("utf-8"))
+
+    def test_pagination(self):
+        pages = []
+        status, page = self.get(limit=2, fields='id,day_index,groups')
+        pages.append(page)
+        while page['next'] is not None:
+            status, page = self.get(limit=2, fields='id,day_index,groups', cursor=page['next'])
+            pages.append(page)
+        self.assertLength(pages, 2)
+        allocations = [a for page in pages for a in page['allocations']]
+        self.assertEqual(sorted(a['id'] for a in allocations), sorted(a.id for a in self.allocations))
+        self.assertEqual(allocations[0], {'id': allocations[0]['id'],
+                                          'day_index': allocations[0]['day_index'], 'groups': ['1_BUN-RI']})
+
+    def test_bad_request(self):
+        self.assertEqual(self.get(fields='id,nonexistent')[0], 400)
+        self.assertEqual(self.get(cursor='garbage')[0], 400)
+
+
+class GroupClosureTest(MyTestCase):
+    """
+    Test the group hierarchy closure table.
+    """
+
+    def setUp(self):
+        super(GroupClosureTest, self).setUp()
+        self.groupset = mommy.make('timetable.GroupSet')
+        self.year = mommy.make('timetable.Group', name='1', groupset=self.groupset)
+        self.study = mommy.make('timetable.Group', name='1 BUN', parent=self.year, groupset=self.groupset)
+        self.lab1 = mommy.make('timetable.Group', name='1 BUN LV1', parent=self.study, groupset=self.groupset)
+        self.lab2 = mommy.make('timetable.Group', name='1 BUN LV2', parent=self.study, groupset=self.groupset)
+        self.other = mommy.make('timetable.Group', name='2', groupset=self.groupset)
+
+    def test_family(self):
+        self.assertEqual(self.lab1.parents, [self.study, self.year])
+        self.assertEqual(self.year.children(), [self.study, self.lab1, self.lab2])
+        self.assertEqual(self.year.children(scope='one'), [self.study])
+        with self.assertNumQueries(1):
+            family = self.study.family()
+        self.assertEqual(family, [self.lab1, self.lab2, self.study, self.year])
+
+    def test_move(self):
+        self.study.parent = self.other
+        self.study.save()
+        self.assertEqual(self.lab2.parents, [self.study, self.other])
+        self.assertEmpty(self.year.children())
+        self.assertEqual(set(self.other.descendants()), {self.study, self.lab1, self.lab2})
+        self.lab1.delete()
+        self.assertEqual(list(self.other.descendants()), [self.study, self.lab2])
+
+    def test_rebuild(self):
+        links = set(timetable.models.GroupClosure.objects.values_list('ancestor_id', 'descendant_id', 'depth'))
+        timetable.models.GroupClosure.rebuild()
+        self.assertEqual(set(timetable.models.GroupClosure.objects.values_list(
+            'ancestor_id', 'descendant_id', 'depth')), links)
+        self.assertLength(links, 5 + 3 + 2)
+
+    def test_unavailable(self):
+        preferenceset = mommy.make('timetable.PreferenceSet')
+        tt = mommy.make('timetable.Timetable', groupset=self.groupset, preferenceset=preferenceset)
+        realization = mommy.make('timetable.ActivityRealization',
+                                 activity=mommy.make('timetable.Activity', duration=2))
+        realization.groups.add(self.lab1, self.other)
+        allocation = mommy.make('timetable.Allocation', timetable=tt, activityRealization=realization,
+                                day='MON', start='08:00')
+        preference = mommy.make('timetable.GroupTimePreference', group=self.study, preferenceset=preferenceset,
+                                level='CANT', day='MON', start='09:00', duration=1)
+        mommy.make('timetable.GroupTimePreference', group=self.other, level='CANT',
+                   day='MON', start='08:00', duration=1)
+        allocation = timetable.models.Allocation.objects.select_related(
+            'timetable', 'activityRealization__activity').prefetch_related(
+            'activityRealization__groups').get(id=allocation.id)
+        self.assertEqual(allocation.groups_not_available, [self.lab1])
+        with self.assertNumQueries(0):
+            self.assertFalse(allocation.are_groups_available)
+        self.assertFalse(self.lab1.is_available('MON', {'09:00'}))
+        self.assertTrue(self.lab1.is_available('MON', {'08:00', '10:00'}))
+        self.assertFalse(self.other.is_available('MON', {'08:00'}))
+        preference.delete()
+        self.assertTrue(allocation.are_groups_available)
+        self.assertTrue(self.lab1.is_available('MON', {'09:00'}))
+        self.lab1.parent = self.other
+        self.lab1.save()
+        self.assertFalse(self.lab1.is_available('MON', {'08:00'}))
+
+    def test_invalidation_on_commit(self):
+        preferenceset = mommy.make('timetable.PreferenceSet')
+        timetable.models.unavailable_masks(preferenceset.id)
+        mommy.make('timetable.GroupTimePreference', group=self.study, preferenceset=preferenceset,
+                   level='CANT', day='MON', start='09:00', duration=1)
+        # The transaction sees the change at once
+        masks = timetable.models.unavailable_masks(preferenceset.id)
+        self.assertEqual(set(masks), {self.study.id, self.lab1.id, self.lab2.id})
+        # Another process reads the new generation before the commit and caches masks without the change
+        generation = timetable.models._unavailable_masks[preferenceset.id][0]
+        timetable.models._unavailable_masks[preferenceset.id] = (generation, {})
+        self.assertEqual(timetable.models.unavailable_masks(preferenceset.id), {})
+        self.run_commit_hooks()
+        self.assertEqual(timetable.models.unavailable_masks(preferenceset.id), masks)
+
+
+class TeacherWeightSumsTest(MyTestCase):
+    """
+    Test normalized weights of teacher preferences.
+    """
+
+    def setUp(self):
+        super(TeacherWeightSumsTest, self).setUp()
+        self.preferenceset = mommy.make('timetable.PreferenceSet')
+        self.teacher = mommy.make('timetable.Teacher', code='t1')
+        self.preferences = [
+            mommy.make('timetable.TeacherTimePreference', teacher=self.teacher, preferenceset=self.preferenceset,
+                       level='HATE', day='MON', start=start, duration=duration, weight=weight)
+            for start, duration, weight in [('08:00', 2, 1.0), ('12:00', 1, 2.0)]]
+        self.value_preference = mommy.make('timetable.TeacherValuePreference', teacher=self.teacher,
+                                           preferenceset=self.preferenceset, level='HATE', value=1, weight=1.0)
+
+    def test_weights(self):
+        # Weights times durations sum to 4
+        self.assertAlmostEqual(self.preferences[0].adjustedWeight(), 0.4 + 0.25 * 0.59)
+        self.assertAlmostEqual(self.preferences[1].adjustedWeight(), 0.4 + 0.5 * 0.59)
+        # Weights of all preferences sum to 4
+        self.assertAlmostEqual(timetable.models.TeacherPreference.adjustedWeight(self.preferences[1]), 0.5)
+        with self.assertNumQueries(0):
+            self.preferences[0].adjustedWeight()
+        cant = mommy.make('timetable.TeacherTimePreference', teacher=self.teacher,
+                          preferenceset=self.preferenceset, level='CANT', day='TUE', start='08:00', duration=1)
+        self.assertEqual(cant.adjustedWeight(), 1.0)
+
+    def test_invalidation(self):
+        self.preferences[0].adjustedWeight()
+        self.preferences[1].weight = 6.0
+        self.preferences[1].save()
+        self.assertAlmostEqual(self.preferences[0].adjustedWeight(), 0.4 + 0.125 * 0.59)
+        self.preferences[1].delete()
+        self.assertAlmostEqual(self.preferences[0].adjustedWeight(), 0.4 + 0.5 * 0.59)
+        self.assertEqual(timetable.models.teacher_weight_sums(self.preferenceset.id),
+                         {(self.teacher.id, 'HATE'): (2.0, 2.0)})
+
+    def test_invalidation_on_commit(self):
+        sums = timetable.models.teacher_weight_sums(self.preferenceset.id)
+        self.preferences[1].weight = 6.0
+        self.preferences[1].save()
+        # Another process reads the new generation before the commit and caches the old sums
+        cached = timetable.models.teacher_weight_sums(self.preferenceset.id)
+        generation = timetable.models._teacher_weight_sums[self.preferenceset.id][0]
+        timetable.models._teacher_weight_sums[self.preferenceset.id] = (generation, sums)
+        self.run_commit_hooks()
+        self.assertEqual(timetable.models.teacher_weight_sums(self.preferenceset.id), cached)
+        self.assertAlmostEqual(self.preferences[0].adjustedWeight(), 0.4 + 0.125 * 0.59)
+
+    def test_stale(self):
+        self.preferences[0].adjustedWeight()
+        # QuerySet.update sends no signals, the cached sums miss the new teacher
+        teacher = mommy.make('timetable.Teacher', code='t2')
+        timetable.models.TeacherPreference.objects.filter(id=self.preferences[1].id).update(teacher=teacher)
+        preference = timetable.models.TeacherTimePreference.objects.get(id=self.preferences[1].id)
+        self.assertAlmostEqual(preference.adjustedWeight(), 0.99)
+        timetable.models.TeacherPreference.objects.filter(id=preference.id).update(weight=0)
+        timetable.models.invalidate_teacher_weight_sums(self.preferenceset.id)
+        preference.weight = 0
+        self.assertEqual(preference.adjustedWeight(), 0.4)
+
+
+class ResponseCacheTest(MyTestCase):
+    """
+    Test the version-keyed response cache of timetable pages.
+    """
+
+    def setUp(self):
+        super(ResponseCacheTest, self).setUp()
+        self.request_factory = RequestFactory()
+        self.groupset = mommy.make('timetable.GroupSet')
+        self.tt = mommy.make('timetable.Timetable', slug='cached', groupset=self.groupset, public=True)
+        self.group = mommy.make('timetable.Group', groupset=self.groupset)
+        realization = mommy.make('timetable.ActivityRealization',
+                                 activity=mommy.make('friprosveta.Activity', duration=1))
+        realization.groups.add(self.group)
+        self.allocation = mommy.make('timetable.Allocation', timetable=self.tt,
+                                     activityRealization=realization, day='MON', start='07:00')
+
+    def get_response(self, **headers):
+        request = self.request_factory.get("/", {'group': self.group.id}, **headers)
+        request.user = AnonymousUser()
+        return friprosveta.views.allocations_json(request, 'cached')
+
+    def get(self):
+        return json.loads(self.get_response().content.decode("utf-8"))
+
+    def test_cache(self):
+        self.assertEqual(self.get()[0]['fields']['day'], 'MON')
+        with self.assertNumQueries(1):
+            self.assertEqual(self.get()[0]['fields']['day'], 'MON')
+        self.allocation.day = 'FRI'
+        self.allocation.save()
+        self.assertEqual(self.get()[0]['fields']['day'], 'FRI')
+
+    def test_group_change(self):
+        version = timetable.models.Timetable.objects.get(id=self.tt.id).version
+        self.group.name = 'renamed'
+        self.group.save()
+        self.assertNotEqual(timetable.models.Timetable.objects.get(id=self.tt.id).version, version)
+
+    def test_conditional_get(self):
+        response = self.get_response()
+        self.assertEqual(self.get_response(HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+        self.assertEqual(self.get_response(HTTP_IF_MODIFIED_SINCE=response['Last-Modified']).status_code, 304)
+        student = mommy.make('friprosveta.Student')
+        self.group.students.add(student)
+        self.assertEqual(self.get_response(HTTP_IF_NONE_MATCH=response['ETag']).status_code, 200,
+                         "Group membership changes the version")
+
+
+class NavigationTest(MyTestCase):
+    """
+    Test the cached navigation bundle of the results page.
+    """
+
+    def setUp(self):
+        super(NavigationTest, self).setUp()
+        self.groupset = mommy.make('timetable.GroupSet')
+        self.activityset = mommy.make('timetable.ActivitySet')
+        self.tt = mommy.make('timetable.Timetable', groupset=self.groupset, activityset=self.activityset)
+        self.group = mommy.make('timetable.Group', groupset=self.groupset, visible_in_navigation=True)
+        mommy.make('timetable.Group', groupset=self.groupset, visible_in_navigation=False)
+        self.subject = mommy.make('friprosveta.Subject', code='63001')
+        self.activity = mommy.make('friprosveta.Activity', activityset=self.activityset, subject=self.subject)
+        user = mommy.make('auth.User', first_name='Ada', last_name='Lovelace')
+        self.teacher = mommy.make('timetable.Teacher', user=user)
+
+    def navigation(self):
+        tt = timetable.models.Timetable.objects.get(id=self.tt.id)
+        return friprosveta.navigation.get_navigation(tt)
+
+    def test_navigation(self):
+        navigation = self.navigation()
+        self.assertEqual([g['id'] for g in navigation['groups']], [self.group.id])
+        self.assertEqual([s['code'] for s in navigation['subjects']], ['63001'])
+        self.assertEmpty(navigation['teachers'])
+        self.assertEmpty(navigation['classrooms'])
+        self.activity.teachers.add(self.teacher)
+        self.assertEqual(self.navigation()['teachers'],
+                         [{'id': self.teacher.id, 'code': self.teacher.code, 'name': 'Lovelace, Ada'}])
+
+
+class OccupancyTest(MyTestCase):
+    """
+    Test the occupancy used for overlaps and conflicts of allocations.
+    """
+
+    def setUp(self):
+        super(OccupancyTest, self).setUp()
+        self.groupset = mommy.make('timetable.GroupSet')
+        self.tt = mommy.make('timetable.Timetable', groupset=self.groupset)
+        students = mommy.make('friprosveta.Student', _quantity=3)
+        self.g1 = mommy.make('timetable.Group', groupset=self.groupset, size=2)
+        self.g2 = mommy.make('timetable.Group', groupset=self.groupset, size=2)
+        self.g3 = mommy.make('timetable.Group', groupset=self.groupset, size=5)
+        self.g1.students.add(students[0], students[1])
+        self.g2.students.add(students[1], students[2])
+        mommy.make('timetable.GroupTimePreference', group=self.g3, level='CANT',
+                   day='MON', start='08:00', duration=1)
+        self.allocations = []
+        for groups, start in [([self.g1], '08:00'), ([self.g2], '09:00'), ([self.g1, self.g3], '08:00')]:
+            activity = mommy.make('timetable.Activity', duration=2)
+            realization = mommy.make('timetable.ActivityRealization', activity=activity)
+            realization.groups.add(*groups)
+            self.allocations.append(mommy.make('timetable.Allocation', timetable=self.tt, classroom=None,
+                                               activityRealization=realization, day='MON', start=start))
+
+    def test_overlaps(self):
+        allocations = timetable.models.Allocation.objects.filter(timetable=self.tt)
+        with CaptureQueriesContext(connection) as queries:
+            occupancy = friprosveta.occupancy.Occupancy.build(allocations)
+        self.assertLength(queries, 7)
+        overlaps = [occupancy.overlaps(a.id) for a in self.allocations]
+        self.assertEqual(overlaps[0], (2, 0, 2))
+        self.assertEqual(overlaps[1], (2, 0, 1))
+        self.assertEqual(overlaps[2], (7, 5, 2))
+        self.assertEqual(occupancy.student_counts.sum(), 2 * (2 + 2 + 2))
+
+    def test_view(self):
+        request = RequestFactory().get('/')
+        request.user = AnonymousUser()
+        response = friprosveta.views.problematic_allocations(request, self.tt.slug)
+        self.assertEqual(response.status_code, 200)
+
+    def test_busy_index(self):
+        tt = timetable.models.Timetable.objects.get(id=self.tt.id)
+        index = friprosveta.occupancy.get_occupancy_index(tt)
+        realization = self.allocations[2].activityRealization
+        busy = index.busy_counts(realization.id, [self.g1.id, self.g3.id])
+        self.assertEqual(busy[friprosveta.occupancy.slot('MON', '08:00')], 2)
+        self.assertEqual(busy[friprosveta.occupancy.slot('MON', '10:00')], 1)
+        self.assertEqual(busy.sum(), 2 + 2 + 1)
+        # Moving an allocation updates the index in place
+        self.allocations[1].day = 'TUE'
+        self.allocations[1].save()
+        tt = timetable.models.Timetable.objects.get(id=self.tt.id)
+        self.assertIs(friprosveta.occupancy.get_occupancy_index(tt), index)
+        busy = index.busy_counts(realization.id, [self.g1.id, self.g3.id])
+        self.assertEqual(busy[friprosveta.occupancy.slot('MON', '10:00')], 0)
+        self.assertEqual(busy[friprosveta.occupancy.slot('TUE', '10:00')], 1)
+        rebuilt = friprosveta.occupancy.OccupancyIndex.build(tt)
+        for groups, a in zip([[self.g1], [self.g2], [self.g1, self.g3]], self.allocations):
+            group_ids = [g.id for g in groups]
+            self.assertEqual(list(index.busy_counts(a.activityRealization_id, group_ids)),
+                             list(rebuilt.busy_counts(a.activityRealization_id, group_ids)))
+
+    def test_busy_index_concurrent_change(self):
+        tt = timetable.models.Timetable.objects.get(id=self.tt.id)
+        index = friprosveta.occupancy.get_occupancy_index(tt)
+        fresh_ids = friprosveta.occupancy.fresh_index_ids()
+        self.assertEqual(fresh_ids, {tt.id})
+        allocation = self.allocations[1]
+        allocation.day = 'TUE'
+        allocation.save()
+        # Another process changes the timetable between this save and the update of the index
+        timetable.models.Timetable.objects.filter(id=tt.id).update(version=timetable.models.new_version())
+        friprosveta.occupancy.update_indices(allocation, fresh_ids)
+        tt = timetable.models.Timetable.objects.get(id=self.tt.id)
+        self.assertIsNot(friprosveta.occupancy.get_occupancy_index(tt), index)
+
+    def test_busy_index_preferences(self):
+        tt = timetable.models.Timetable.objects.get(id=self.tt.id)
+        realization = self.allocations[1].activityRealization
+        friday = friprosveta.occupancy.slot('FRI', '12:00')
+        index = friprosveta.occupancy.get_occupancy_index(tt)
+        self.assertEqual(index.busy_counts(realization.id, [self.g2.id])[friday], 0)
+        preference = mommy.make('timetable.GroupTimePreference', group=self.g2, level='CANT',
+                                day='FRI', start='12:00', duration=1)
+        tt = timetable.models.Timetable.objects.get(id=self.tt.id)
+        index = friprosveta.occupancy.get_occupancy_index(tt)
+        self.assertEqual(index.busy_counts(realization.id, [self.g2.id])[friday], 2)
+        preference.delete()
+        tt = timetable.models.Timetable.objects.get(id=self.tt.id)
+        index = friprosveta.occupancy.get_occupancy_index(tt)
+        self.assertEqual(index.busy_counts(realization.id, [self.g2.id])[friday], 0)
+
+    def test_placement_grid(self):
+        user = mommy.make('auth.User', is_staff=True)
+        teacher = mommy.make('timetable.Teacher', code='t1')
+        realization = self.allocations[2].activityRealization
+        realization.teachers.add(teacher)
+        self.allocations[1].activityRealization.teachers.add(teacher)
+        request = RequestFactory().get('/', {'day': 'MON', 'hour': ['08:00', '10:00']})
+        request.user = user
+        response = friprosveta.views.busy_students_admin_json(request, self.tt.slug, realization.id)
+        cells = json.loads(response.content.decode())['cells']
+        self.assertEqual([(c['day'], c['hour']) for c in cells], [('MON', '08:00'), ('MON', '10:00')])
+        self.assertEqual(cells[0]['groups'], {str(self.g1.id): 2})
+        self.assertEqual(cells[0]['group_preferences'], [self.g3.id])
+        self.assertEqual(cells[1]['groups'], {str(self.g1.id): 1})
+        self.assertEqual([(a['id'], a['students']) for a in cells[1]['activities']],
+                         [(self.allocations[1].id, 1)])
+        self.assertEqual([a['id'] for a in cells[1]['busy_teachers'][str(teacher.id)]],
+                         [self.allocations[1].id])
+        request = RequestFactory().get('/')
+        request.user = user
+        response = friprosveta.views.busy_students_admin(request, self.tt.slug, realization.id)
+        self.assertEqual(response.status_code, 200)
+
+    def test_conflicts(self):
+        teacher = mommy.make('timetable.Teacher', code='t1')
+        classroom = mommy.make('timetable.Classroom')
+        for a in self.allocations[:2]:
+            a.activityRealization.teachers.add(teacher)
+            a.classroom = classroom
+            a.save()
+        tt = timetable.models.Timetable.objects.get(id=self.tt.id)
+        occupancy = friprosveta.occupancy.get_occupancy_index(tt).occupancy
+        self.assertEqual(occupancy.conflicts(), (5, 1, 1))
+        move = self.allocations[1]
+        self.assertEqual(occupancy.move_conflicts(move.id, 'TUE', '09:00', classroom.id), (-1, -1, -1))
+        self.assertEqual(occupancy.move_conflicts(move.id, 'MON', '08:00', None), (1, 1, -1))
+        move.day = 'TUE'
+        move.save()
+        tt = timetable.models.Timetable.objects.get(id=self.tt.id)
+        self.assertIs(friprosveta.occupancy.get_occupancy_index(tt).occupancy, occupancy)
+        self.assertEqual(occupancy.conflicts(), (4, 0, 0))
+        self.assertEqual(friprosveta.occupancy.OccupancyIndex.build(tt).occupancy.conflicts(), (4, 0, 0))
+        request = RequestFactory().get('/', {'day': 'MON', 'start': '08:00'})
+        request.user = mommy.make('auth.User', is_staff=True)
+        response = friprosveta.views.move_conflicts_json(request, self.tt.slug, str(move.id))
+        data = json.loads(response.content.decode())
+        self.assertEqual(data['conflicts'], {'students': 4, 'teachers': 0, 'classrooms': 0})
+        self.assertEqual(data['moves'], [{'day': 'MON', 'start': '08:00',
+                                          'students': 2, 'teachers': 2, 'classrooms': 2}])
+        # Classrooms outside the classroom set of the timetable are refused
+        other = mommy.make('timetable.Classroom')
+        request = RequestFactory().get('/', {'day': 'MON', 'start': '08:00', 'classroom': other.id})
+        request.user = mommy.make('auth.User', is_staff=True)
+        response = friprosveta.views.move_conflicts_json(request, self.tt.slug, str(move.id))
+        self.assertEqual(response.status_code, 400)
+        classroomset = mommy.make('timetable.ClassroomSet')
+        classroomset.classrooms.add(other)
+        timetable.models.Timetable.objects.filter(id=self.tt.id).update(classroomset=classroomset)
+        response = friprosveta.views.move_conflicts_json(request, self.tt.slug, str(move.id))
+        self.assertEqual(json.loads(response.content.decode())['classroom'], other.id)
+        # Questions about other classrooms do not change the index
+        self.assertEqual(occupancy.move_conflicts(move.id, 'MON', '08:00', other.id), (2, 2, 0))
+        self.assertEqual(occupancy.classroom_ids, [classroom.id])
+
+    def test_free_classrooms(self):
+        c, d = mommy.make('timetable.Classroom', _quantity=2)
+        self.allocations[0].classroom = c
+        self.allocations[0].save()
+        other = mommy.make('timetable.Timetable', groupset=self.groupset)
+        mommy.make('timetable.Allocation', timetable=other, classroom=d, day='MON', start='12:00',
+                   activityRealization=self.allocations[1].activityRealization)
+        self.tt.respects.add(other)
+        tt = timetable.models.Timetable.objects.get(id=self.tt.id)
+        occupancy = friprosveta.occupancy.get_occupancy_index(tt).occupancy
+        rooms = [c.id, d.id]
+        self.assertEqual(occupancy.free_classrooms(rooms, 'MON', '07:00', 1), rooms)
+        self.assertEqual(occupancy.free_classrooms(rooms, 'MON', '07:00', 2), [d.id])
+        self.assertEqual(occupancy.free_classrooms(rooms, 'MON', '08:00', 2,
+                                                   self.allocations[0].activityRealization_id), rooms)
+        self.assertEqual(occupancy.free_classrooms(rooms, 'MON', '11:00', 2), [c.id])
+        self.assertEqual(occupancy.free_classrooms(rooms, 'MON', '21:00', 3), rooms)
+
+    def test_teacher_busy(self):
+        self.tt.preferenceset = mommy.make('timetable.PreferenceSet')
+        self.tt.save()
+        teachers = [mommy.make('friprosveta.Teacher', code=code) for code in ['t1', 't2']]
+        self.allocations[0].activityRealization.teachers.add(teachers[0])
+        for teacher, level, day, start, duration, weight in [
+                (teachers[0], 'HATE', 'MON', '10:00', 2, 1), (teachers[0], 'HATE', 'TUE', '08:00', 1, 2),
+                (teachers[0], 'HATE', 'MON', '08:00', 1, 2), (teachers[1], 'CANT', 'WED', '07:00', 1, 1),
+                (teachers[1], 'WANT', 'WED', '08:00', 1, 1)]:
+            mommy.make('timetable.TeacherTimePreference', preferenceset=self.tt.preferenceset,
+                       teacher=teacher, level=level, day=day, start=start, duration=duration, weight=weight)
+        with CaptureQueriesContext(connection) as queries:
+            busy = friprosveta.models.Teacher.bulk_busy(self.tt)
+        # Allocations, preferences and sums of preference weights
+        self.assertLength(queries, 3)
+        self.assertEqual(set(busy.teacher_ids), {t.id for t in teachers})
+        expected = {}
+        for p in timetable.models.TeacherTimePreference.objects.filter(teacher=teachers[0]):
+            expected[(p.day, p.start)] = p.adjustedWeight()
+        busy_hours = busy.busy_hours(teachers[0].id)
+        self.assertEqual(busy_hours['MON'], {('08:00', 1.0), ('09:00', 1.0),
+                                             ('10:00', expected[('MON', '10:00')]),
+                                             ('11:00', expected[('MON', '10:00')])})
+        self.assertEqual(busy_hours['TUE'], {('08:00', expected[('TUE', '08:00')])})
+        self.assertEqual(busy.busy_hours(teachers[1].id)['WED'], {('07:00', 1.0)})
+        free = teachers[0].free_hours(self.tt, 0.5)
+        self.assertEqual(free, busy.free_hours(teachers[0].id, 0.5))
+        self.assertNotIn('08:00', free['MON'])
+        self.assertIn('10:00', free['MON'])
+        self.assertNotIn('08:00', free['TUE'])
+        self.assertEqual(len(teachers[0].free_hours(self.tt)['MON']), 15 - 4)
+
+    def test_quality(self):
+        teacher = mommy.make('friprosveta.Teacher', code='t1')
+        for a in self.allocations[:2]:
+            a.activityRealization.teachers.add(teacher)
+        self.allocations[2].classroom = mommy.make('timetable.Classroom', short_name='P1', capacity=3)
+        self.allocations[2].save()
+        out = StringIO()
+        call_command('timetable_quality', self.tt.slug, '--jobs', '2', stdout=out)
+        report = json.loads(out.getvalue())[self.tt.slug]
+        snapshot = friprosveta.quality.QualitySnapshot.build(self.tt)
+        self.assertEqual(report, json.loads(json.dumps(friprosveta.quality.report(snapshot))))
+        self.assertEqual(report['student_overlaps'], [
+            {'name': 'BUN-RI 0', 'students': 3, 'students_with_overlaps': 2, 'overlaps': 5}])
+        self.assertEqual(report['teachers'], [
+            {'name': 't1', 'hours': 3, 'days': 1, 'gaps': 0, 'overlaps': 1}])
+        self.assertEqual(report['classrooms'][0]['too_small'], 1)
+        self.assertEqual(report['group_preferences'], [
+            {'name': self.g3.short_name, 'CANT': 1, 'HATE': 0}])
+        self.assertEqual(report['summary']['student_overlaps'], 5)
+        out = StringIO()
+        call_command('timetable_quality', self.tt.slug, '--jobs', '1', '--format', 'csv', stdout=out)
+        self.assertIn('{},teachers,t1,gaps,0'.format(self.tt.slug), out.getvalue())
+
+    def test_preference_set(self):
+        self.tt.preferenceset = mommy.make('timetable.PreferenceSet')
+        self.tt.save()
+        allocation = self.allocations[2]
+        # g3 is unavailable in another preference set
+        tt = timetable.models.Timetable.objects.get(id=self.tt.id)
+        self.assertEqual(friprosveta.occupancy.get_occupancy_index(tt).occupancy.unavailable_groups(allocation.id), [])
+        self.assertTrue(timetable.models.Allocation.objects.get(id=allocation.id).are_groups_available)
+        mommy.make('timetable.GroupTimePreference', group=self.g3, preferenceset=self.tt.preferenceset,
+                   level='CANT', day='MON', start='09:00', duration=1)
+        tt = timetable.models.Timetable.objects.get(id=self.tt.id)
+        self.assertEqual(friprosveta.occupancy.get_occupancy_index(tt).occupancy.unavailable_groups(allocation.id),
+                         [self.g3.id])
+        self.assertFalse(timetable.models.Allocation.objects.get(id=allocation.id).are_groups_available)
+
+    def test_quality_preference_sets(self):
+        self.tt.preferenceset = self.g3.time_preferences.get().preferenceset
+        self.tt.save()
+        other = mommy.make('timetable.PreferenceSet')
+        for level in ['CANT', 'HATE']:
+            mommy.make('timetable.GroupTimePreference', group=self.g1, preferenceset=other, level=level,
+                       day='MON', start='08:00', duration=2)
+        # Preferences of ancestors count
+        self.g1.parent = mommy.make('timetable.Group', groupset=self.groupset)
+        self.g1.save()
+        mommy.make('timetable.GroupTimePreference', group=self.g1.parent, preferenceset=self.tt.preferenceset,
+                   level='HATE', day='MON', start='09:00', duration=1)
+        snapshot = friprosveta.quality.QualitySnapshot.build(self.tt)
+        report = friprosveta.quality.group_preferences(snapshot, sorted(snapshot.group_names))
+        self.assertEqual(sorted(report, key=lambda r: r['name']), sorted([
+            {'name': self.g1.short_name, 'CANT': 0, 'HATE': 2},
+            {'name': self.g3.short_name, 'CANT': 1, 'HATE': 0}], key=lambda r: r['name']))
+
+
+class CrossectionsTest(MyTestCase):
+    """
+    Test constraints for realizations sharing students.
+    """
+
+    def setUp(self):
+        super(CrossectionsTest, self).setUp()
+        self.groupset = mommy.make('timetable.GroupSet')
+        activityset = mommy.make('timetable.ActivitySet')
+        self.tt = mommy.make('timetable.Timetable', activityset=activityset, groupset=self.groupset)
+        students = mommy.make('friprosveta.Student', _quantity=4)
+        groups = [mommy.make('timetable.Group', groupset=self.groupset, short_name=name)
+                  for name in ['1_BUN-RI_LV_01', '1_BUN-RI_LV_02', '1_IZ_LV_01']]
+        groups[0].students.add(*students[:3])
+        groups[1].students.add(*students[1:])
+        groups[2].students.add(*students)
+        self.realizations = []
+        for code, (activity_type, realization_groups) in enumerate([('P', groups[:2]), ('LV', groups[:1]),
+                                                                   ('LV', groups[1:2]), ('P', groups[2:])]):
+            activity = mommy.make('friprosveta.Activity', activityset=activityset, type=activity_type,
+                                  subject=mommy.make('friprosveta.Subject', code=str(code)))
+            realization = mommy.make('timetable.ActivityRealization', activity=activity)
+            realization.groups.add(*realization_groups)
+            self.realizations.append(realization)
+
+    def pairs(self, **kwargs):
+        from friprosveta.management.commands.crossections import realizations_must_not_overlap_database
+        constraints = realizations_must_not_overlap_database(self.tt, **kwargs)
+        return [(int(c[2][2][1]), int(c[2][3][1])) for c in constraints]
+
+    def test_not_overlapping(self):
+        r = [realization.id for realization in self.realizations]
+        # IZ groups are ignored
+        self.assertEqual(self.pairs(razor=0), [(r[0], r[1]), (r[0], r[2]), (r[1], r[2])])
+        self.assertEqual(self.pairs(razor=2), [(r[0], r[1]), (r[0], r[2])])
+        self.assertEqual(self.pairs(razor=2, razor_dict={('LV', 'P'): 3}), [])
+        self.assertEqual(self.pairs(razor=0, skip_pairs=[('LV', 'P')]), [(r[1], r[2])])
+
+
+class ExportContextTest(MyTestCase):
+    """
+    Test the preloaded data of FET exports.
+    """
+
+    def setUp(self):
+        super(ExportContextTest, self).setUp()
+        location = mommy.make('timetable.Location')
+        classroomset = mommy.make('timetable.ClassroomSet')
+        classroomset.classrooms.add(mommy.make('timetable.Classroom', location=location, short_name='P01'))
+        self.tt = mommy.make('friprosveta.Timetable', classroomset=classroomset,
+                             activityset=mommy.make('timetable.ActivitySet'),
+                             groupset=mommy.make('timetable.GroupSet'),
+                             preferenceset=mommy.make('timetable.PreferenceSet'))
+        self.year = mommy.make('timetable.Group', groupset=self.tt.groupset, short_name='1_BUN-RI', size=10)
+        self.tag = mommy.make('timetable.Tag', name='Predavanja')
+        self.location = location
+        self.n_realizations = 0
+
+    def add_realizations(self, n):
+        for i in range(self.n_realizations, self.n_realizations + n):
+            activity = mommy.make('friprosveta.Activity', activityset=self.tt.activityset, duration=2,
+                                  subject=mommy.make('friprosveta.Subject', code=str(i)))
+            activity.locations.add(self.location)
+            activity.tags.add(self.tag)
+            group = mommy.make('timetable.Group', groupset=self.tt.groupset, parent=self.year, size=5)
+            teacher = mommy.make('friprosveta.Teacher', code=str(i))
+            realization = mommy.make('timetable.ActivityRealization', activity=activity)
+            realization.groups.add(group)
+            realization.teachers.add(teacher)
+            mommy.make('timetable.TeacherTimePreference', teacher=teacher, preferenceset=self.tt.preferenceset,
+                       level='HATE', day='MON', start='08:00', duration=2, weight=1)
+            mommy.make('timetable.Allocation', timetable=self.tt, activityRealization=realization,
+                       classroom=self.tt.classrooms.get(), day='TUE', start='09:00')
+        self.n_realizations += n
+
+    def export(self, jobs=1, timings=None, cache=None):
+        from friprosveta.management.commands.django2fet import FetWriter, generate_fet
+        out = StringIO()
+        with CaptureQueriesContext(connection) as context:
+            ctx = friprosveta.export.ExportContext.build(
+                self.tt, allocation_weights={(('activityRealization__activity__short_name__regex', '.*'),): (1.0, 1.0)})
+            generate_fet(FetWriter(out.write), ctx, razor=0, razor_dict={}, jobs=jobs, timings=timings,
+                         cache=cache)
+        return len(context.captured_queries), ctx, out.getvalue()
+
+    def test_constant_queries(self):
+        self.add_realizations(2)
+        queries_few, ctx, _ = self.export()
+        self.assertLength(ctx.realization_ids, 2)
+        self.add_realizations(10)
+        queries_many, ctx, _ = self.export()
+        self.assertLength(ctx.realization_ids, 12)
+        self.assertEqual(queries_few, queries_many)
+
+    def test_context(self):
+        self.add_realizations(2)
+        _, ctx, fet = self.export()
+        realization = ctx.realizations[ctx.realization_ids[0]]
+        self.assertEqual(ctx.realization_size(realization.id), 5)
+        self.assertEqual(ctx.realization_tag_ids(realization.id), {self.tag.id})
+        self.assertEqual(ctx.tagged_realization_ids(self.tag.id), ctx.realization_ids)
+        self.assertEqual([c.short_name for c in ctx.preferred_rooms(realization.id, 5)], ['P01'])
+        self.assertEqual(ctx.groups[realization.group_ids[0]].parent_id, self.year.id)
+        for p in timetable.models.TeacherTimePreference.objects.all():
+            self.assertAlmostEqual(ctx.teacher_time_preferences[p.teacher_id][0].adjusted_weight, p.adjustedWeight())
+        self.assertEqual(fet.count('<ConstraintTeacherNotAvailableTimes>'), 2)
+        self.assertEqual(fet.count('<ConstraintActivityPreferredStartingTime>'), 2)
+
+    def test_parallel(self):
+        from friprosveta.management.commands.django2fet import fet_sections
+        self.add_realizations(3)
+        timings = dict()
+        fet = self.export(jobs=2, timings=timings)[2]
+        self.assertEqual(fet, self.export()[2])
+        self.assertEqual(list(timings), [name for _, generators in fet_sections(0, {}, [], [])
+                                         for name, _ in generators])
+
+    def test_streamed(self):
+        from friprosveta.management.commands.django2fet import FetWriter, write_generated
+
+        def pid(ctx):
+            yield ['Pid', str(os.getpid())]
+
+        out = StringIO()
+        writer = FetWriter(out.write)
+        writer.start('Pids')
+        write_generated(writer, None, [('realizations_not_overlapping', pid), ('a', pid), ('b', pid)], jobs=2)
+        writer.end()
+        pids = re.findall(r'<Pid>(\d+)</Pid>', out.getvalue())
+        self.assertLength(pids, 3)
+        # The largest generator is written by this process, the others by workers
+        self.assertEqual(pids[0], str(os.getpid()))
+        self.assertNotIn(str(os.getpid()), pids[1:])
+
+    def test_cache(self):
+        self.add_realizations(2)
+        fet = self.export()[2]
+        with tempfile.TemporaryDirectory() as directory:
+            cache = friprosveta.export.FragmentCache(directory)
+            self.assertEqual(self.export(jobs=2, cache=cache)[2], fet)
+            self.assertEmpty(cache.cached)
+            cache = friprosveta.export.FragmentCache(directory)
+            self.assertEqual(self.export(cache=cache)[2], fet)
+            self.assertEmpty(cache.regenerated)
+            mommy.make('timetable.TeacherTimePreference', teacher=timetable.models.Teacher.objects.first(),
+                       preferenceset=self.tt.preferenceset, level='CANT', day='FRI', start='08:00', duration=1)
+            cache = friprosveta.export.FragmentCache(directory)
+            fet = self.export(cache=cache)[2]
+            self.assertEqual(fet, self.export()[2])
+            self.assertEqual(cache.regenerated, ['teacher_not_available_preferences',
+                                                 'teacher_time_preferences_to_preferred_times'])
+            files = len(os.listdir(directory))
+            self.assertEqual(cache.prune(), 2, "Fragments of the old teacher preferences are removed")
+            self.assertEqual(len(os.listdir(directory)), files - 2)
+            self.assertEqual(len(os.listdir(directory)), len(cache.used))
+
+
+    def test_generator_inputs(self):
+        from friprosveta.management.commands.django2fet import GENERATOR_INPUTS, FetWriter, fet_sections
+
+        class RecordingContext(object):
+            """
+            Delegate to the ExportContext ctx and record the names of its
+            attributes read, also from within its methods.
+            """
+
+            def __init__(self, ctx):
+                self.ctx = ctx
+                self.reads = set()
+
+            def __getattr__(self, name):
+                if name in vars(self.ctx):
+                    self.reads.add(name)
+                    return getattr(self.ctx, name)
+                return getattr(type(self.ctx), name).__get__(self)
+
+        self.add_realizations(2)
+        preferenceset = self.tt.preferenceset
+        group = timetable.models.Group.objects.filter(parent=self.year).first()
+        teacher = timetable.models.Teacher.objects.first()
+        for typename, _ in timetable.models.PREFERENCETYPES:
+            mommy.make('timetable.TagDescriptivePreference', tag=self.tag, preferenceset=preferenceset,
+                       level='WANT', typename=typename, weight=1)
+        for name in ['SHRINKGROUPS', 'TAGMAXHOURSDAILY', 'MAXROOMSREALIZATIONS', 'MINACTIVITYGAP']:
+            mommy.make('timetable.TagValuePreference', tag=self.tag, preferenceset=preferenceset,
+                       level='WANT', name=name, value=2, weight=1)
+        mommy.make('timetable.TagTimePreference', tag=self.tag, preferenceset=preferenceset,
+                   level='CANT', day='WED', start='08:00', duration=1, weight=1)
+        mommy.make('timetable.GroupTimePreference', group=group, preferenceset=preferenceset,
+                   level='CANT', day='WED', start='08:00', duration=1, weight=1)
+        mommy.make('timetable.GroupValuePreference', group=group, preferenceset=preferenceset,
+                   level='WANT', name='MAXDAYSWEEK', value=4, weight=1)
+        mommy.make('timetable.TeacherValuePreference', teacher=teacher, preferenceset=preferenceset,
+                   level='WANT', name='MAXDAYSWEEK', value=4, weight=1)
+        ctx = self.export()[1]
+        for _, generators in fet_sections(0, {}, [], []):
+            for name, generator in generators:
+                with self.subTest(generator=name):
+                    recording = RecordingContext(ctx)
+                    FetWriter(StringIO().write).elements(generator(recording))
+                    self.assertLessEqual(recording.reads, set(GENERATOR_INPUTS[name]))
+
+
+class FetWriterTest(unittest.TestCase):
+    def write(self, pretty):
+        from friprosveta.management.commands.django2fet import FetWriter
+        out = StringIO()
+        writer = FetWriter(out.write, pretty=pretty, buffer_size=8)
+        writer.start('fet', version="5.11.0")
+        writer.element(['Name', 'R&D <1>'])
+        writer.element(['Empty_List', None, iter([])])
+        writer.element(['List', None, (['Item', None, [['Id', str(i)], ['Comments', '']]] for i in range(2))])
+        writer.end()
+        return out.getvalue()
+
+    def test_pretty(self):
+        self.assertEqual(self.write(True),
+                         '<fet version="5.11.0">\n'
+                         '  <Name>R&amp;D &lt;1&gt;</Name>\n'
+                         '  <Empty_List />\n'
+                         '  <List>\n'
+                         '    <Item>\n      <Id>0</Id>\n      <Comments />\n    </Item>\n'
+                         '    <Item>\n      <Id>1</Id>\n      <Comments />\n    </Item>\n'
+                         '  </List>\n'
+                         '</fet>\n')
+
+    def test_compact(self):
+        self.assertEqual(self.write(False),
+                         '<fet version="5.11.0"><Name>R&amp;D &lt;1&gt;</Name><Empty_List />'
+                         '<List><Item><Id>0</Id><Comments /></Item><Item><Id>1</Id><Comments /></Item></List>'
+                         '</fet>')
@@ -9,16 +9,20 @@ from . import views
 urlpatterns = [
     url(r'^$', views.default_timetable_redirect, name='default_timetable'),
     url(r'^timetable/(?P<timetable_slug>[\w-]+)/allocations.json', views.allocations_json, name='allocations_json'),
+    url(r'^timetable/(?P<timetable_slug>[\w-]+)/allocations_v2\.json', views.allocations_json_v2, name='allocations_json_v2'),
+    url(r'^timetable/(?P<timetable_slug>[\w-]+)/navigation\.json', views.navigation_json, name='navigation_json'),
     url(r'^timetable/(?P<timetable_slug>[\w-]+)/realizations.json', views.realizations_json, name='realizations_json'),
     url(r'^timetable/(?P<timetable_slug>[\w-]+)/allocations_edit', views.allocations_edit, name='allocations_edit'),
     url(r'^timetable/(?P<timetable_slug>[\w-]+)/allocations/?$', views.allocations, name='allocations'),
     url(r'^timetable/(?P<timetable_slug>[\w-]+)/allocations_ical', views.allocations_ical, name='allocations_ical'),
     url(r'^timetable/(?P<timetable_slug>[\w-]+)/authenticated_allocations', views.authenticated_allocations, {}, name='authenticated_allocations'),
     url(r'^timetable/(?P<timetable_slug>[\w-]+)/problematic_allocations', views.problematic_allocations, {}, name='problematic_allocations'),
+    url(r'^timetable/(?P<timetable_slug>[\w-]+)/allocation/(?P<allocation_id>[0-9]+)/move_conflicts\.json$', views.move_conflicts_json, {}, name='move_conflicts_json'),
     url(r'^timetable/(?P<timetable_slug>[\w-]+)/realization/$', views.UnplacedRealizationsList.as_view(), {}, name='unplaced_realizations'),
     url(r'^timetable/(?P<timetable_slug>[\w-]+)/realization/(?P<realization_id>[0-9]+)/$', views.busy_students, {}, name='busy_students'),
     url(r'^timetable/(?P<timetable_slug>[\w-]+)/realization/(?P<realization_id>[0-9]+)/students_list$', views.students_list, {}, name='students_list'),
     url(r'^timetable/(?P<timetable_slug>[\w-]+)/realization/(?P<realization_id>[0-9]+)/students_list\.json$', views.students_list_json, {}, name='students_list_json'),
+    url(r'^timetable/(?P<timetable_slug>[\w-]+)/realization/(?P<realization_id>[0-9]+)/busy_students_admin\.json$', views.busy_students_admin_json, {}, name='busy_students_admin_json'),
     url(r'^timetable/(?P<timetable_slug>[\w-]+)/realization/(?P<realization_id>[0-9]+)/busy_students_admin', views.busy_students_admin, {}, name='busy_students_admin'),
     url(r'^timetable/(?P<timetable_slug>[\w-]+)/realization/(?P<realization_id>[0-9]+)/place', views.place_realization, {}, name='place_realization'),
     url(r'^timetable/(?P<timetable_slug>[\w-]+)/?', views.results, {}, name='results'),
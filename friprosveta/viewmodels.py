@@ -0,0 +1,296 @@
+"""
+View models for allocation views.
+
+AllocationLoader resolves everything the allocation views display
+(activities, subjects, types, classrooms, teachers and groups) for a whole
+allocation queryset in a fixed number of queries and returns denormalized
+AllocationEntry tuples. allocation_view_models turns entries into the
+AllocationVM tuples used by the allocations template, together with their
+colors. ALLOCATION_FIELDS describe the compact representation of entries
+used by the JSON API. DisplayNames caches display names of filter entities
+shown in page titles.
+"""
+import colorsys
+import logging
+import threading
+import time
+from collections import namedtuple, defaultdict, OrderedDict
+
+import palettable
+from django.db.models import Q
+
+import friprosveta.models
+import timetable.models
+from timetable.models import WEEKDAYS, WORKHOURS, AFTERHOURS
+
+logger = logging.getLogger(__name__)
+
+WEEKDAY_INDEX = {wd[0]: i for i, wd in enumerate(WEEKDAYS)}
+WEEKDAY_NAMES = dict(WEEKDAYS)
+HOUR_INDEX = {wh[0]: i for i, wh in enumerate(WORKHOURS)}
+
+SubjectEntry = namedtuple('SubjectEntry', ['id', 'code', 'name', 'short_name'])
+ActivityEntry = namedtuple('ActivityEntry', ['id', 'name', 'short_name', 'type', 'duration', 'subject'])
+ClassroomEntry = namedtuple('ClassroomEntry', ['id', 'name', 'short_name', 'capacity'])
+GroupEntry = namedtuple('GroupEntry', ['id', 'name', 'short_name', 'parent_id'])
+TimetableEntry = namedtuple('TimetableEntry', ['id', 'slug', 'name', 'public', 'respects'])
+
+
+class TeacherEntry(namedtuple('TeacherEntry', ['id', 'code', 'first_name', 'last_name'])):
+    __slots__ = ()
+
+    def __str__(self):
+        # Same as timetable.models.Teacher.__str__
+        if self.first_name is None and self.last_name is None:
+            return "Ambrož Zasekamožević"
+        return "{0}, {1}".format(self.last_name, self.first_name)
+
+
+class AllocationEntry(namedtuple('AllocationEntry', [
+        'id', 'timetable_id', 'timetable_public', 'realization_id',
+        'activity', 'classroom', 'day', 'start', 'teachers', 'groups'])):
+    """
+    A single denormalized allocation.
+    """
+    __slots__ = ()
+
+    @property
+    def day_index(self):
+        return WEEKDAY_INDEX[self.day]
+
+    @property
+    def hour_index(self):
+        return HOUR_INDEX[self.start]
+
+    @property
+    def duration(self):
+        return self.activity.duration
+
+    @property
+    def end(self):
+        endi = self.hour_index + self.duration
+        if endi >= len(WORKHOURS):
+            return AFTERHOURS[0]
+        return WORKHOURS[endi][0]
+
+    @property
+    def hours(self):
+        i = self.hour_index
+        return [hour[0] for hour in WORKHOURS[i:min(len(WORKHOURS), i + self.duration)]]
+
+    @property
+    def day_display(self):
+        return WEEKDAY_NAMES[self.day]
+
+    @property
+    def subject(self):
+        return self.activity.subject
+
+    @property
+    def teacher_ids(self):
+        return [t.id for t in self.teachers]
+
+    @property
+    def group_ids(self):
+        return [g.id for g in self.groups]
+
+
+ColorVM = namedtuple('ColorVM', ['h', 's', 'l'])
+AllocationVM = namedtuple('AllocationVM', ['object', 'subject', 'day_index', 'hour_index', 'duration', 'color'])
+
+
+class AllocationLoader(object):
+    """
+    Load allocation entries for an allocation queryset in a fixed number of queries.
+    After load the loader also holds the involved timetables and groups.
+    """
+
+    def __init__(self, allocations):
+        self.allocations = allocations
+        # id -> TimetableEntry
+        self.timetables = dict()
+        # id -> GroupEntry
+        self.groups = dict()
+
+    def load(self, groupset_timetable_ids=()):
+        """
+        Return the list of AllocationEntry objects, ordered by activity.
+        Groups from the groupsets of timetables with given ids are loaded
+        into self.groups together with the groups on allocations.
+        """
+        rows = list(self.allocations.distinct().values_list(
+            'id', 'timetable_id', 'activityRealization_id',
+            'activityRealization__activity_id', 'classroom_id', 'day', 'start'))
+
+        timetable_ids = set(r[1] for r in rows) | set(groupset_timetable_ids)
+        respects = defaultdict(set)
+        for from_id, to_id in timetable.models.Timetable.respects.through.objects.filter(
+                from_timetable_id__in=timetable_ids).values_list('from_timetable_id', 'to_timetable_id'):
+            respects[from_id].add(to_id)
+        for tt_id, slug, name, public in timetable.models.Timetable.objects.filter(
+                id__in=timetable_ids).values_list('id', 'slug', 'name', 'public'):
+            self.timetables[tt_id] = TimetableEntry(tt_id, slug, name, public, respects[tt_id])
+
+        realization_ids = set(r[2] for r in rows)
+        activity_rows = list(timetable.models.Activity.objects.filter(
+            id__in=set(r[3] for r in rows)
+        ).values_list('id', 'name', 'short_name', 'type', 'duration', 'activity__subject_id'))
+        subjects = {s[0]: SubjectEntry(*s) for s in friprosveta.models.Subject.objects.filter(
+            id__in=set(a[5] for a in activity_rows if a[5] is not None)
+        ).values_list('id', 'code', 'name', 'short_name')}
+        activities = {a[0]: ActivityEntry(*a[:5], subject=subjects.get(a[5]))
+                      for a in activity_rows}
+        classrooms = {c[0]: ClassroomEntry(*c) for c in timetable.models.Classroom.objects.filter(
+            id__in=set(r[4] for r in rows)
+        ).values_list('id', 'name', 'short_name', 'capacity')}
+
+        realization_teachers = defaultdict(list)
+        for realization_id, teacher_id in timetable.models.ActivityRealization.teachers.through.objects.filter(
+                activityrealization_id__in=realization_ids).values_list('activityrealization_id', 'teacher_id'):
+            realization_teachers[realization_id].append(teacher_id)
+        teachers = {t[0]: TeacherEntry(*t) for t in timetable.models.Teacher.objects.filter(
+            id__in=set(t for l in realization_teachers.values() for t in l)
+        ).values_list('id', 'code', 'user__first_name', 'user__last_name')}
+
+        realization_groups = defaultdict(list)
+        for realization_id, group_id in timetable.models.ActivityRealization.groups.through.objects.filter(
+                activityrealization_id__in=realization_ids).values_list('activityrealization_id', 'group_id'):
+            realization_groups[realization_id].append(group_id)
+        for g in timetable.models.Group.objects.filter(
+                Q(groupset__timetables__id__in=groupset_timetable_ids) |
+                Q(id__in=set(g for l in realization_groups.values() for g in l))
+        ).distinct().values_list('id', 'name', 'short_name', 'parent_id'):
+            self.groups[g[0]] = GroupEntry(*g)
+
+        entries = [AllocationEntry(
+            id=allocation_id,
+            timetable_id=tt_id,
+            timetable_public=self.timetables[tt_id].public,
+            realization_id=realization_id,
+            activity=activities[activity_id],
+            classroom=classrooms.get(classroom_id),
+            day=day,
+            start=start,
+            teachers=tuple(sorted((teachers[t] for t in realization_teachers[realization_id]),
+                                  key=lambda t: t.id)),
+            groups=tuple(sorted((self.groups[g] for g in realization_groups[realization_id]),
+                                key=lambda g: g.name)),
+        ) for allocation_id, tt_id, realization_id, activity_id, classroom_id, day, start in rows]
+        entries.sort(key=lambda a: (a.activity.id, a.id))
+        return entries
+
+
+def allocation_view_models(allocations):
+    """
+    Return the list of AllocationVM tuples for the given allocation entries
+    and the color map (allocation id -> ColorVM) in one pass.
+    Each subject (or activity without subject) gets its own color,
+    colors repeat if there are too many subjects.
+    """
+    color_palette = palettable.colorbrewer.get_map("Set3", "qualitative", 12)
+    allocation_colors = dict()
+    subject_colors = dict()
+    activity_colors = dict()
+    allocation_vms = []
+    colors_used = 0
+    for a in allocations:
+        activity_id = a.activity.id
+        subject = a.subject
+        color = activity_colors.get(activity_id, None)
+        if color is None and subject is not None:
+            color = subject_colors.get(subject.id, None)
+        if color is None:
+            color = color_palette.colors[colors_used % color_palette.number]
+            activity_colors[activity_id] = color
+            if subject is not None:
+                subject_colors[subject.id] = color
+            colors_used += 1
+        # colors are in HSL for easier manipulation
+        hls_color = colorsys.rgb_to_hls(*(c / 256.0 for c in color))
+        final_color = ColorVM(h=hls_color[0] * 360,
+                              l="{:.2f}%".format(100 * hls_color[1]),
+                              # emphasise lectures and slightly de-emphasise labs for more clarity
+                              s="{:.2f}%".format(
+                                  100 * hls_color[2] * (0.8 if a.activity.type != "P" else 1.4)))
+        allocation_colors[a.id] = final_color
+        allocation_vms.append(AllocationVM(
+            object=a,
+            subject=subject,
+            day_index=a.day_index,
+            hour_index=a.hour_index,
+            duration=a.duration,
+            color=final_color,
+        ))
+    return allocation_vms, allocation_colors
+
+
+# Fields of the compact (flat) allocation representation
+ALLOCATION_FIELDS = OrderedDict([
+    ('id', lambda a: a.id),
+    ('realization', lambda a: a.realization_id),
+    ('day', lambda a: a.day),
+    ('day_index', lambda a: a.day_index),
+    ('start', lambda a: a.start),
+    ('hour_index', lambda a: a.hour_index),
+    ('duration', lambda a: a.duration),
+    ('classroom', lambda a: a.classroom.name if a.classroom is not None else None),
+    ('subject_code', lambda a: a.subject.code if a.subject is not None else None),
+    ('subject_name', lambda a: a.subject.name if a.subject is not None else None),
+    ('type', lambda a: a.activity.type),
+    ('teachers', lambda a: ["{} {}".format(t.first_name, t.last_name) for t in a.teachers]),
+    ('groups', lambda a: [g.short_name for g in a.groups]),
+])
+
+
+def compact_allocation(allocation, fields=ALLOCATION_FIELDS.keys()):
+    """
+    Return the compact representation of the allocation entry with the given fields.
+    """
+    return OrderedDict((field, ALLOCATION_FIELDS[field](allocation)) for field in fields)
+
+
+class DisplayNames(object):
+    """
+    A small LRU cache of display names of entities (teachers, groups, ...)
+    keyed by the entity kind and key (id, code). Names expire after timeout
+    seconds, so renamed entities show up with their new names eventually.
+    """
+
+    def __init__(self, maxsize=4096, timeout=10 * 60):
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self._names = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_many(self, kind, keys, load):
+        """
+        Return the dictionary key -> display name for the given keys of the kind.
+        Names not in the cache are loaded with a single call of load(keys),
+        which returns (key, name) pairs. Keys are compared as strings,
+        keys that are not found are left out.
+        """
+        names = dict()
+        missing = []
+        now = time.time()
+        with self._lock:
+            for key in set(str(k) for k in keys):
+                cached = self._names.get((kind, key))
+                if cached is None or cached[1] < now:
+                    missing.append(key)
+                else:
+                    self._names.move_to_end((kind, key))
+                    names[key] = cached[0]
+        if missing:
+            loaded = [(str(key), name) for key, name in load(missing)]
+            with self._lock:
+                for key, name in loaded:
+                    names[key] = name
+                    self._names[(kind, key)] = (name, now + self.timeout)
+                    self._names.move_to_end((kind, key))
+                while len(self._names) > self.maxsize:
+                    self._names.popitem(last=False)
+        return names
+
+    def clear(self):
+        with self._lock:
+            self._names.clear()
@@ -1,7 +1,8 @@
-from bisect import bisect_left
-import colorsys
+from bisect import bisect_left, bisect_right
+import base64
 import datetime
 import itertools
+import json
 import logging
 from bisect import bisect_left
 from collections import OrderedDict, defaultdict
@@ -9,20 +10,23 @@ from collections import namedtuple
 
 import django.forms
 import icalendar
-import palettable
+import numpy as np
 import pytz
 # from django.contrib.admin.widgets import FilteredSelectMultiple
 from django.contrib.auth.decorators import login_required
 from django.core import serializers
+from django.core.cache import cache
 from django.core.exceptions import PermissionDenied, ObjectDoesNotExist
 from django.db import transaction
 from django.db.models import Q, Sum
-from django.http import Http404, HttpResponse, HttpResponseRedirect, HttpResponseForbidden, JsonResponse
+from django.http import Http404, HttpResponse, HttpResponseRedirect, HttpResponseForbidden, JsonResponse, \
+    StreamingHttpResponse, HttpResponseBadRequest
 from django.shortcuts import get_object_or_404, render_to_response, redirect, render
 from django.urls import reverse
 from django.utils.decorators import method_decorator
 from django.utils.html import escape
 from django.utils.translation import ugettext as _
+from django.views.decorators.gzip import gzip_page
 from django.views.generic.detail import DetailView
 from django.views.generic.edit import CreateView, UpdateView, DeleteView
 from django.views.generic.list import ListView
@@ -30,9 +34,15 @@ from django.views.generic.list import ListView
 import frinajave
 import friprosveta.forms
 import friprosveta.models
+import friprosveta.navigation
+import friprosveta.occupancy
+import friprosveta.response_cache
+import friprosveta.snapshot
+import friprosveta.viewmodels
 import timetable.forms
 import timetable.views
 from friprosveta.forms import AssignmentForm, NajavePercentageForm
+from friprosveta.response_cache import cache_timetable_response, conditional_timetable_response
 from timetable.models import Timetable, Group, ActivityRealization, \
     Allocation, Activity, WORKHOURS, WEEKDAYS, \
     Tag, default_timetable
@@ -160,21 +170,14 @@ def default_timetable_redirect(request):
     return redirect("/timetable/{}/".format(slug), permanent=False)
 
 
-# @cache_page(60 * 15)
+@cache_timetable_response('results', vary=lambda request: request.user.id)
 def results(request, timetable_slug):
     class StudentForm(django.forms.Form):
         student = django.forms.CharField(label='vpisna', max_length=8)
 
     selected_timetable = get_object_or_404(timetable.models.Timetable,
                                            slug=timetable_slug)
-    try:
-        groups = selected_timetable.groupset.groups.filter(visible_in_navigation=True)
-    except:
-        groups = timetable.models.Group.objects.none()
-    teachers = friprosveta.models.Teacher.objects.filter(
-        activities__activityset=selected_timetable.activityset).distinct()
-    subjects = friprosveta.models.Subject.objects.filter(
-        activities__activityset=selected_timetable.activityset).distinct()
+    navigation = friprosveta.navigation.get_navigation(selected_timetable)
     if __is_teacher_or_staff(request.user):
         allocations_view = reverse('authenticated_allocations',
                                    kwargs={'timetable_slug': timetable_slug})
@@ -187,6 +190,9 @@ def results(request, timetable_slug):
             accessing_student = friprosveta.models.Student.from_user(request.user)
         except friprosveta.models.Student.DoesNotExist:
             accessing_student = None
+        except IOError:
+            logger.exception("Error mapping user {} to student".format(request.user))
+            accessing_student = None
         accessing_teacher = request.user.teacher if hasattr(request.user, "teacher") else None
     else:
         accessing_student = None
@@ -196,17 +202,25 @@ def results(request, timetable_slug):
         'allocations_view': allocations_view,
         'student_form': StudentForm,
         'timetable_slug': timetable_slug,
-        'teachers': teachers.order_by('user__last_name', 'user__first_name'),
-        'classrooms': selected_timetable.classroomset.classrooms.order_by(
-            "name"),
-        'studyGroups': groups,
-        'subjects': subjects.order_by("name"),
+        'teachers': navigation['teachers'],
+        'classrooms': navigation['classrooms'],
+        'studyGroups': navigation['groups'],
+        'subjects': navigation['subjects'],
         'accessing_student': accessing_student,
         'accessing_teacher': accessing_teacher
     }
     return render(request, 'friprosveta/results.html', params)
 
 
+@cache_timetable_response('navigation_json')
+def navigation_json(request, timetable_slug):
+    """
+    Teachers, classrooms, groups and subjects shown on the results page.
+    """
+    tt = get_object_or_404(timetable.models.Timetable, slug=timetable_slug)
+    return JsonResponse(friprosveta.navigation.get_navigation(tt))
+
+
 ParamTuple = namedtuple(
     'ParamTuple',
     [
@@ -307,29 +321,11 @@ def _activity_set(param_ids, filtered_activities):
             groups_listed_ids += [i.id for i in g.family()]
         filtered_activities = filtered_activities.filter(
             groups__id__in=groups_listed_ids)
-    realizations = set()
     if 'realization' in param_ids:
-        realizations += set(param_ids['realization'])
+        filtered_activities = filtered_activities.filter(realizations__id__in=param_ids['realization'])
     if 'student' in param_ids:
-        logger.debug("Student in param_ids")
-        sl = friprosveta.models.Student.objects.filter(studentId__in=param_ids['student'])
-        logger.debug("Students: {}".format(sl))
-        if len(sl) < 1:
-            filtered_activities = Activity.objects.none()
-        for s in sl:
-            if len(s.follows.all()):
-                logger.debug("Follows")
-                realizations.add([ar.id for ar in s.follows.all()])
-            else:
-                logger.debug("Processing student groups")
-                for g in s.groups.all():
-                    logger.debug("Processing {}".format(g))
-                    for r in g.realizations.all():
-                        logger.debug("Processing realization {}".format(r))
-                        realizations.add(r.id)
-                logger.debug("Realizations: {}".format(realizations))
-    if len(realizations):
-        filtered_activities = filtered_activities.filter(realizations__id__in=realizations)
+        filtered_activities = filtered_activities.filter(
+            realizations__student_links__student__studentId__in=param_ids['student'])
     return filtered_activities
 
 
@@ -369,24 +365,12 @@ def _realization_set(param_ids, filtered_realizations, allow_unfiltered=False):
     if 'type' in param_ids:
         filtered_realizations = filtered_realizations.filter(
             activity__type__in=param_ids['type'])
-    realization_ids = set()
     if 'realization' in param_ids:
-        realization_ids += set(param_ids['realization'])
+        filtered_realizations = filtered_realizations.filter(
+            id__in=param_ids['realization'])
     if 'student' in param_ids:
-        sl = friprosveta.models.Student.objects.filter(
-            studentId__in=param_ids['student'])
-        if len(sl) < 1:
-            filtered_realizations = ActivityRealization.objects.none()
-        for s in sl:
-            if len(s.follows.all()):
-                realization_ids.add([ar.id for ar in s.follows.all()])
-            else:
-                for g in s.groups.all():
-                    for r in g.realizations.all():
-                        realization_ids.add(r.id)
-    if len(realization_ids):
         filtered_realizations = filtered_realizations.filter(
-            id__in=realization_ids)
+            student_links__student__studentId__in=param_ids['student'])
     if 'group' in param_ids:
         # contextlink += "&group=" + "&group=".join(l)
         groups_listed_ids = []
@@ -426,65 +410,159 @@ def _allocation_set(param_ids, filtered_allocations, is_staff=False):
     return filtered_allocations.distinct()
 
 
-def _titles(param_ids):
-    if 'timetable' in param_ids or 'timetable_slug' in param_ids:
-        tts = Timetable.objects.all()
-    else:
-        tts = Timetable.objects.none()
-    if 'timetable' in param_ids:
-        tts = tts.filter(id__in=param_ids['timetable'])
+# Display names of filter entities by parameter: queryset, key field and display function
+TITLE_ENTITIES = {
+    'timetable_slug': (timetable.models.Timetable.objects.all(), 'slug',
+                       lambda x: (x.id, x.name)),
+    'student': (friprosveta.models.Student.objects.all(), 'studentId',
+                lambda x: x.studentId),
+    'teacher': (timetable.models.Teacher.objects.select_related('user'), 'id',
+                lambda x: str(x)),
+    'group': (timetable.models.Group.objects.all(), 'id',
+              lambda x: x.name),
+    'subject': (friprosveta.models.Subject.objects.all(), 'code',
+                lambda x: x.name),
+    'activity': (friprosveta.models.Activity.objects.all(), 'id',
+                 lambda x: x.name),
+    'classroom': (timetable.models.Classroom.objects.all(), 'id',
+                  lambda x: x.name),
+}
+SUBTITLE_PARAMS = ['student', 'teacher', 'group', 'subject', 'activity', 'classroom']
+
+_display_names = friprosveta.viewmodels.DisplayNames()
+
+
+def _entity_names(param, keys, known_names):
+    """
+    Return the dictionary key -> display name for the entities selected by
+    the filter parameter. Names in known_names (for instance from the
+    allocation snapshot) are used as they are, the rest is loaded in bulk
+    through the display names cache.
+    """
+    known = known_names.get(param, {})
+    keys = [str(k) for k in keys]
+    names = {k: known[k] for k in keys if k in known}
+    missing = [k for k in keys if k not in names]
+    if missing:
+        queryset, key_field, disp_fn = TITLE_ENTITIES[param]
+
+        def load(missing_keys):
+            for entity in queryset.filter(**{key_field + '__in': missing_keys}):
+                yield getattr(entity, key_field), disp_fn(entity)
+
+        names.update(_display_names.get_many(param, missing, load))
+    return names
+
+
+def _titles(param_ids, known_names=None):
+    """
+    Return the title (names of timetables) and subtitles (names of the
+    selected entities, one per filter parameter) of an allocation page.
+    """
+    known_names = known_names or {}
+    title = ""
     if 'timetable_slug' in param_ids:
-        tts = tts.filter(slug__in=param_ids['timetable_slug'])
-    title = "; ".join([i.name for i in tts])
-    subtitle_map = {
-        'student': (friprosveta.models.Student,
-                    lambda x: x.studentId,
-                    lambda l: Q(studentId__in=l)),
-        'teacher': (timetable.models.Teacher,
-                    lambda x: str(x),
-                    lambda l: Q(id__in=l)),
-        'group': (timetable.models.Group,
-                  lambda x: x.name,
-                  lambda l: Q(id__in=l)),
-        'subject': (friprosveta.models.Subject,
-                    lambda x: x.name,
-                    lambda l: Q(code__in=l)),
-        'activity': (friprosveta.models.Activity,
-                     lambda x: x.name,
-                     lambda l: Q(id__in=l)),
-        'classroom': (timetable.models.Classroom,
-                      lambda x: x.name,
-                      lambda l: Q(id__in=l)),
-    }
+        timetables = _entity_names('timetable_slug', param_ids['timetable_slug'], known_names)
+        tt_ids = set(param_ids.get('timetable', [tt_id for tt_id, _ in timetables.values()]))
+        title = "; ".join(sorted(set(name for tt_id, name in timetables.values() if tt_id in tt_ids)))
+    elif 'timetable' in param_ids:
+        title = "; ".join(sorted(set(
+            Timetable.objects.filter(id__in=param_ids['timetable']).values_list('name', flat=True))))
     subtitles = []
     for k, v in param_ids.items():
-        if k in subtitle_map:
-            c, disp_fn, filter_fn = subtitle_map[k]
-            l = c.objects.filter(filter_fn(v))
-            subtitles.append("; ".join([disp_fn(i) for i in l]))
+        if k in SUBTITLE_PARAMS:
+            names = _entity_names(k, v, known_names)
+            subtitles.append("; ".join(names[key] for key in OrderedDict.fromkeys(str(i) for i in v)
+                                       if key in names))
     return title, subtitles
 
 
+@cache_timetable_response('allocations_json')
 def allocations_json(request, timetable_slug=None):
-    # logger.info("Entering allocations_json")
     tt = get_object_or_404(timetable.models.Timetable, slug=timetable_slug)
     param_ids = _allocation_context_links(request)[1]
-    # param_ids['timetable_slug'] = [timetable_slug]
-    # This fetches all the allocations before filtering.
-    # Why would you increase the server load on each request
-    # just in case you need to debug something?
-    # logger.debug("Got filtered allocations")
-    # logger.debug("{}".format(filtered_allocations))
-    filtered_allocations = _allocation_set(param_ids,
-                                           tt.allocations,
-                                           request.user.is_staff)
-    # logger.debug("Filtered allocations after _allocation_set")
-    # logger.debug("{}".format(filtered_allocations))
-    json_data = serializers.serialize("json", filtered_allocations)
-    # logger.debug("Returning json data")
-    # logger.debug("{}".format(json_data))
-    # logger.info("Exiting allocations_json")
-    return HttpResponse(json_data)
+    filtered_allocations = friprosveta.snapshot.get_snapshot(tt).filter(
+        param_ids, request.user.is_staff)
+    # Same format as serializers.serialize("json", ...) on Allocation objects
+    data = [{
+        'model': 'timetable.allocation',
+        'pk': a.id,
+        'fields': {
+            'timetable': a.timetable_id,
+            'activityRealization': a.realization_id,
+            'classroom': a.classroom.id if a.classroom is not None else None,
+            'day': a.day,
+            'start': a.start,
+        }
+    } for a in filtered_allocations]
+    return HttpResponse(json.dumps(data))
+
+
+ALLOCATIONS_PAGE_SIZE = 500
+ALLOCATIONS_MAX_PAGE_SIZE = 5000
+
+
+def _encode_cursor(allocation):
+    key = "{}:{}".format(allocation.activity.id, allocation.id)
+    return base64.urlsafe_b64encode(key.encode("ascii")).decode("ascii")
+
+
+def _decode_cursor(cursor):
+    """
+    Return the (activity id, allocation id) key encoded in the cursor.
+    Raise ValueError (binascii.Error and UnicodeError are subclasses) on invalid cursors.
+    """
+    key = base64.urlsafe_b64decode(cursor.encode("ascii")).decode("ascii")
+    activity_id, allocation_id = key.split(":")
+    return int(activity_id), int(allocation_id)
+
+
+def _allocations_json_chunks(header, allocations, fields, footer):
+    """
+    Encode the page of allocations into JSON one allocation at a time.
+    """
+    yield json.dumps(header)[:-1] + ', "allocations": ['
+    for i, a in enumerate(allocations):
+        yield ("," if i else "") + json.dumps(friprosveta.viewmodels.compact_allocation(a, fields))
+    yield "], " + json.dumps(footer)[1:]
+
+
+@gzip_page
+def allocations_json_v2(request, timetable_slug=None):
+    """
+    Compact, denormalized allocations for the filter parameters of
+    _allocation_context_links. Optional parameters:
+    fields: comma separated list of fields (see viewmodels.ALLOCATION_FIELDS),
+    limit: the page size,
+    cursor: the value of "next" from the previous page.
+    """
+    tt = get_object_or_404(timetable.models.Timetable, slug=timetable_slug)
+    fields = list(friprosveta.viewmodels.ALLOCATION_FIELDS.keys())
+    if request.GET.get('fields'):
+        fields = request.GET['fields'].split(',')
+        unknown = [f for f in fields if f not in friprosveta.viewmodels.ALLOCATION_FIELDS]
+        if unknown:
+            return HttpResponseBadRequest("Unknown fields: {}".format(", ".join(unknown)))
+    try:
+        limit = int(request.GET.get('limit', ALLOCATIONS_PAGE_SIZE))
+        cursor = _decode_cursor(request.GET['cursor']) if 'cursor' in request.GET else None
+    except ValueError:
+        return HttpResponseBadRequest("Invalid limit or cursor")
+    limit = min(max(limit, 1), ALLOCATIONS_MAX_PAGE_SIZE)
+
+    param_ids = _allocation_context_links(request)[1]
+    # snapshot allocations are ordered by (activity id, id), which is the cursor
+    filtered_allocations = friprosveta.snapshot.get_snapshot(tt).filter(
+        param_ids, request.user.is_staff)
+    start = 0
+    if cursor is not None:
+        start = bisect_right([(a.activity.id, a.id) for a in filtered_allocations], cursor)
+    page = filtered_allocations[start:start + limit]
+    has_next = start + limit < len(filtered_allocations)
+    header = OrderedDict([('timetable', tt.slug), ('version', tt.version), ('fields', fields)])
+    footer = OrderedDict([('next', _encode_cursor(page[-1]) if has_next else None)])
+    return StreamingHttpResponse(_allocations_json_chunks(header, page, fields, footer),
+                                 content_type="application/json")
 
 
 def authenticated_allocations(request, timetable_slug=None):
@@ -495,43 +573,26 @@ def authenticated_allocations(request, timetable_slug=None):
 def problematic_allocations(request, timetable_slug=None):
     object_list = []
     is_teacher = __is_teacher_or_staff(request.user)
-    allocations = Allocation.objects.filter(timetable__slug=timetable_slug)
+    allocations = Allocation.objects.filter(timetable__slug=timetable_slug).select_related(
+        'activityRealization__activity', 'classroom')
+    preferenceset_id = Timetable.objects.filter(slug=timetable_slug).values_list(
+        'preferenceset_id', flat=True).first()
+    occupancy = friprosveta.occupancy.Occupancy.build(allocations, preferenceset_id=preferenceset_id)
     for a in allocations:
-        realization = a.activityRealization
-        if realization.size > 0:
-            classroom_utilization = 1.0 * realization.size / a.classroom.capacity
+        overlaps = occupancy.overlaps(a.id)
+        if overlaps.size > 0 and a.classroom is not None:
+            classroom_utilization = 1.0 * overlaps.size / a.classroom.capacity
         else:
             classroom_utilization = 0
         if classroom_utilization < 0.5 or classroom_utilization > 1.0:
             css_class = "cycles_todo"
         else:
             css_class = "cycles_ok"
-        # this is sloooow
-        students = friprosveta.models.Student.objects.filter(groups__realizations=realization).distinct()
-        group_overlaps = 0
-        for g in a.groups.all():
-            for tp in g.time_preferences.filter(day=a.day, level='CANT'):
-                if len(set(a.hours).intersection(tp.hours())) > 0:
-                    group_overlaps += g.size
-                    students = students.exclude(groups=g)
-        individual_overlaps = 0
-        for s in students:
-            busy = False
-            possible_conflicts = timetable.models.Allocation.objects.filter(
-                timetable=a.timetable,
-                day=a.day,
-                activityRealization__groups__students=s).exclude(id=a.id).distinct()
-            for i in possible_conflicts:
-                if len(set(a.hours).intersection(i.hours)) > 0:
-                    busy = True
-                    break
-            if busy:
-                individual_overlaps += 1
         object_list.append({"allocation": a,
-                            "n_students": realization.size,
-                            "total_overlaps": group_overlaps + individual_overlaps,
-                            "group_overlaps": group_overlaps,
-                            "individual_overlaps": individual_overlaps,
+                            "n_students": overlaps.size,
+                            "total_overlaps": overlaps.group_overlaps + overlaps.individual_overlaps,
+                            "group_overlaps": overlaps.group_overlaps,
+                            "individual_overlaps": overlaps.individual_overlaps,
                             "classroom_utilization": classroom_utilization,
                             "css_class": css_class})
     return render_to_response('friprosveta/problematic_allocations.html', locals())
@@ -541,71 +602,28 @@ def allocations(request, timetable_slug=None):
     return _allocations(request, timetable_slug, is_teacher=False)
 
 
+def _is_internet_explorer(request):
+    return "trident" in request.META.get("HTTP_USER_AGENT", "").lower()
+
+
+@cache_timetable_response('allocations', vary=_is_internet_explorer)
 def _allocations(request, timetable_slug=None, is_teacher=False):
     context_links, param_ids = _allocation_context_links(request)
     tt = get_object_or_404(timetable.models.Timetable, slug=timetable_slug)
-    param_ids = _allocation_context_links(request)[1]
-    filtered_allocations = _allocation_set(param_ids,
-                                           tt.allocations,
-                                           request.user.is_staff)
+    # not necessarily needed, but this helps make labs of the same subject be closer when looking at a huge timetable
+    # (snapshot allocations are ordered by activity)
+    snapshot = friprosveta.snapshot.get_snapshot(tt)
+    filtered_allocations = snapshot.filter(param_ids, request.user.is_staff)
 
-    groups_listed = sorted(set(g for a in filtered_allocations for g in a.activityRealization.groups.all()),
+    groups_listed = sorted(set(g for a in filtered_allocations for g in a.groups),
                            key=lambda g: g.short_name)
     param_ids['timetable_slug'] = [timetable_slug]
-    title, subtitles = _titles(param_ids)
-    is_internet_explorer = "trident" in request.META["HTTP_USER_AGENT"].lower()
+    title, subtitles = _titles(param_ids, snapshot.display_names())
+    is_internet_explorer = _is_internet_explorer(request)
     get_args = "?" + "&".join("{}={}".format(escape(k), escape(v)) for k, v in request.GET.items()) if request.GET else ""
 
-    # not necessarily needed, but this helps make labs of the same subject be closer when looking at a huge timetable
-    filtered_allocations = filtered_allocations.order_by('activityRealization__activity')
-    allocation_subjects = dict()
-    for a in filtered_allocations:
-        try:
-            subject = friprosveta.models.Activity.from_timetable_activity(a.activityRealization.activity).subject
-        except:
-            subject = None
-        allocation_subjects[a] = subject
-
     # generate nice colors for each subject, then allocation
-    # colors repeat if there are too many subjects
-    color_palette = palettable.colorbrewer.get_map("Set3", "qualitative", 12)
-    ColorVM = namedtuple('ColorVM', ['h', 's', 'l'])
-    allocation_colors = dict()
-    subject_colors = dict()
-    activity_colors = dict()
-    colors_used = 0
-    for a in filtered_allocations:
-        activity_id = a.activityRealization.activity.id
-        color = activity_colors.get(activity_id, None)
-        if color is None:
-            subject = allocation_subjects[a]
-            if subject is not None:
-                color = subject_colors.get(subject.id, None)
-        if color is None:
-            color = color_palette.colors[colors_used % color_palette.number]
-            activity_colors[activity_id] = color
-            if subject is not None:
-                subject_colors[subject.id] = color
-            colors_used += 1
-        # colors are in HSL for easier manipulation
-        hls_color = colorsys.rgb_to_hls(*(c / 256.0 for c in color))
-        final_color = ColorVM(h=hls_color[0] * 360,
-                              l="{:.2f}%".format(100 * hls_color[1]),
-                              # emphasise lectures and slightly de-emphasise labs for more clarity
-                              s="{:.2f}%".format(
-                                  100 * hls_color[2] * (0.8 if a.activityRealization.activity.type != "P" else 1.4)))
-        allocation_colors[a] = final_color
-    AllocationVM = namedtuple('AllocationVM', ['object', 'subject', 'day_index', 'hour_index', 'duration', 'color'])
-    weekday_mapping = {wd[0]: i for i, wd in enumerate(WEEKDAYS)}
-    hour_mapping = {wh[0]: i for i, wh in enumerate(WORKHOURS)}
-    allocation_vms = [AllocationVM(
-        object=a,
-        subject=allocation_subjects[a],
-        day_index=weekday_mapping[a.day],
-        hour_index=hour_mapping[a.start],
-        duration=a.duration,
-        color=allocation_colors[a],
-    ) for a in filtered_allocations]
+    allocation_vms = friprosveta.viewmodels.allocation_view_models(filtered_allocations)[0]
     # sorting required for groupby
     allocation_vms = sorted(allocation_vms, key=lambda avm: avm.day_index)
     allocations_by_day = [(d, list(avm_grouper))
@@ -633,24 +651,31 @@ def _allocations(request, timetable_slug=None, is_teacher=False):
     return response
 
 
-def allocations_ical(request, timetable_slug):
-    tt = get_object_or_404(timetable.models.Timetable, slug=timetable_slug)
-    param_ids = _allocation_context_links(request)[1]
-    filtered_allocations = _allocation_set(param_ids, tt.allocations, request.user.is_staff)
+ICAL_CACHE_TIMEOUT = 24 * 60 * 60
+
+
+def _ical_text(component):
+    return component.to_ical().decode("UTF-8").replace("\\r\\n", "\n")
+
 
+def _allocations_ical_chunks(tt, filtered_allocations):
+    """
+    Generate the iCal feed for the given allocations one event at a time.
+    """
     calendar = icalendar.Calendar()
     calendar.add("prodid", "-//Urnik FRI//urnik.fri.uni-lj.si//")
     calendar.add("version", "2.0")
+    header, footer = _ical_text(calendar).rsplit("END:VCALENDAR", 1)
+    yield header
 
+    # the feed is cached, so the stamp stays the same until the timetable changes
+    dtstamp = datetime.datetime.utcnow()
     for a in filtered_allocations:
-        try:
-            subject = friprosveta.models.Activity.from_timetable_activity(a.activityRealization.activity).subject
-        except:
-            subject = None
+        subject = a.subject
 
         # the first event starts on the first occurrence of the day-hour after the timetable start
         timetable_start_day = tt.start.weekday()
-        allocation_day = next(i for i, d in enumerate(WEEKDAYS) if d[0] == a.day)
+        allocation_day = a.day_index
         days_in_the_future = (allocation_day - timetable_start_day) % 7
         first_event_day = tt.start + datetime.timedelta(days=days_in_the_future)
 
@@ -660,21 +685,20 @@ def allocations_ical(request, timetable_slug):
         first_event_end = first_event_start + datetime.timedelta(hours=a.duration)
 
         event = icalendar.Event()
-        calendar.add_component(event)
         event.add("summary", "{} - {}".format(
-            subject.short_name if subject else "unknown subject", a.activityRealization.activity.type
+            subject.short_name if subject else "unknown subject", a.activity.type
         ))
         event.add("description", "{} {} @ {}\n{}".format(
             subject.name if subject else "unknown subject",
-            a.activityRealization.activity.type,
+            a.activity.type,
             a.classroom.name,
-            ", ".join("{} {}".format(t.user.first_name, t.user.last_name) for t in a.activityRealization.teachers.all())
+            ", ".join("{} {}".format(t.first_name, t.last_name) for t in a.teachers)
         ))
         event.add("location", a.classroom.name)
         event.add("uid", "urnikfri-{}".format(a.id))
         event.add("dtstart", first_event_start)
         event.add("dtend", first_event_end)
-        event.add("dtstamp", datetime.datetime.utcnow())
+        event.add("dtstamp", dtstamp)
 
         rep = icalendar.vRecur()
         event.add("rrule", rep)
@@ -683,9 +707,35 @@ def allocations_ical(request, timetable_slug):
             "byday": a.day[:2],
             "until": datetime.datetime.combine(tt.end, datetime.time.max)
         })
+        yield _ical_text(event)
+
+    yield "END:VCALENDAR" + footer
+
+
+def _cached_chunks(key, chunks, timeout):
+    """
+    Pass the chunks through and store them in the cache under the given key
+    once all of them are generated.
+    """
+    rendered = []
+    for chunk in chunks:
+        rendered.append(chunk)
+        yield chunk
+    cache.set(key, rendered, timeout)
+
 
-    result_text = calendar.to_ical().decode("UTF-8").replace("\\r\\n", "\n")
-    response = HttpResponse(result_text, content_type="text/calendar")
+@conditional_timetable_response('allocations_ical')
+def allocations_ical(request, timetable_slug):
+    tt = get_object_or_404(timetable.models.Timetable, slug=timetable_slug)
+    cache_key = "allocations_ical_{}".format(friprosveta.response_cache.response_key(request, tt))
+    chunks = cache.get(cache_key)
+    if chunks is None:
+        param_ids = _allocation_context_links(request)[1]
+        filtered_allocations = friprosveta.snapshot.get_snapshot(tt).filter(
+            param_ids, request.user.is_staff)
+        chunks = _cached_chunks(cache_key, _allocations_ical_chunks(tt, filtered_allocations),
+                                ICAL_CACHE_TIMEOUT)
+    response = StreamingHttpResponse(chunks, content_type="text/calendar")
     response["Content-Disposition"] = "attachment; filename=urnik.ical"
     return response
 
@@ -802,6 +852,7 @@ def students_list(request, timetable_slug, realization_id):
 
 
 @login_required
+@conditional_timetable_response('students_list_json', vary=lambda request: request.user.id)
 def students_list_json(request, timetable_slug, realization_id):
     user = request.user
     data = _students_list_helper(user, timetable_slug, realization_id)
@@ -826,95 +877,125 @@ def students_list_json(request, timetable_slug, realization_id):
     return JsonResponse(json_data)
 
 
+def _is_bad_study(group):
+    try:
+        study = group.short_name.split('_')[1]
+    except IndexError:
+        study = ''
+    return study == 'PAD' or study == '8' or study == '4'
+
+
+def _placement_cells(tt, realization, rooms):
+    """
+    Return the dictionary (day, hour) -> cell of the placement grid of the
+    realization (see busy_students_admin): students, groups, activities,
+    teachers and classrooms busy at that time.
+    Everything comes from the student busy index of the timetable and a
+    constant number of queries.
+    """
+    occupancy = friprosveta.occupancy.get_occupancy_index(tt).occupancy
+    own = occupancy.realization_slot_counts(realization.id)
+    groups = list(realization.groups.all())
+    teachers = list(realization.teachers.select_related('user'))
+    rooms = OrderedDict((c.id, c) for c in rooms)
+
+    # Busy students by group and timeslot, allocations of the realization not counted
+    busy_groups = dict()
+    # Students of realization groups, counted once for every group they are in
+    weights = np.zeros(len(occupancy.student_ids), dtype=np.int32)
+    for g in groups:
+        students = occupancy.group_students.get(g.id, friprosveta.occupancy.NO_ROWS)
+        weights[students] += 1
+        busy_groups[g] = (occupancy.student_counts[students] - own).sum(axis=0)
+    realization_students = dict()
+    busy_activities = defaultdict(dict)
+    # Allocations in rooms by timeslot
+    busy_classrooms = defaultdict(lambda: defaultdict(list))
+    for a in occupancy.allocations.values():
+        if a.realization_id == realization.id:
+            continue
+        if a.realization_id not in realization_students:
+            realization_students[a.realization_id] = int(
+                weights[occupancy.students(a.realization_id)].sum())
+        for slot in a.slots:
+            if realization_students[a.realization_id] > 0:
+                busy_activities[slot][a.id] = realization_students[a.realization_id]
+            if a.classroom_id in rooms:
+                busy_classrooms[slot][a.classroom_id].append(a.id)
+
+    teacher_realizations = defaultdict(list)
+    for realization_id, teacher_id in ActivityRealization.teachers.through.objects.filter(
+            teacher_id__in=[t.id for t in teachers]
+    ).exclude(activityrealization_id=realization.id).values_list('activityrealization_id', 'teacher_id'):
+        teacher_realizations[teacher_id].append(realization_id)
+    busy_teachers = defaultdict(lambda: defaultdict(list))
+    for t in teachers:
+        for realization_id in teacher_realizations[t.id]:
+            for allocation_id in occupancy.realization_allocations.get(realization_id, ()):
+                for slot in occupancy.allocations[allocation_id].slots:
+                    busy_teachers[slot][t].append(allocation_id)
+    teacher_preferences = defaultdict(lambda: defaultdict(set))
+    teachers_by_id = {t.id: t for t in teachers}
+    for teacher_id, level, day, start, duration in timetable.models.TeacherTimePreference.objects.filter(
+            teacher_id__in=teachers_by_id.keys(), preferenceset_id=tt.preferenceset_id
+    ).values_list('teacher_id', 'level', 'day', 'start', 'duration'):
+        for slot in friprosveta.occupancy.slots(day, start, duration):
+            teacher_preferences[slot][level].add(teachers_by_id[teacher_id])
+
+    allocation_ids = set(i for d in busy_activities.values() for i in d)
+    allocation_ids.update(i for d in busy_classrooms.values() for l in d.values() for i in l)
+    allocation_ids.update(i for d in busy_teachers.values() for l in d.values() for i in l)
+    allocations = Allocation.objects.select_related(
+        'classroom', 'activityRealization__activity__activity__subject').in_bulk(allocation_ids)
+
+    room_list = list(rooms.values())
+    room_ids = list(rooms.keys())
+    # Rooms free at the timeslot and for the whole realization from the timeslot on
+    free_now = occupancy.free_classrooms_grid(room_ids, 1, realization.id)
+    free = occupancy.free_classrooms_grid(room_ids, realization.activity.duration, realization.id)
+    cells = dict()
+    for slot in range(friprosveta.occupancy.SLOTS):
+        day, hour = friprosveta.occupancy.slot_time(slot)
+        g_dict = {g: int(busy[slot]) for g, busy in busy_groups.items() if busy[slot] > 0}
+        c_dict = {rooms[c]: [allocations[i] for i in l] for c, l in busy_classrooms[slot].items()}
+        c_free = set(c for c, is_free in zip(room_list, free[:, slot]) if is_free)
+        c_semifree = set(c for c, is_free, is_free_now in zip(room_list, free[:, slot], free_now[:, slot])
+                         if is_free_now and not is_free)
+        total_overlap = sum(g_dict.values())
+        bad_students_overlap = sum(v for g, v in g_dict.items() if _is_bad_study(g))
+        cells[(day, hour)] = {
+            'total_overlap': total_overlap,
+            'good_students_overlap': total_overlap - bad_students_overlap,
+            'bad_students_overlap': bad_students_overlap,
+            'classrooms_busy': c_dict,
+            'classrooms_semifree': c_semifree,
+            'classrooms_free': c_free,
+            'groups': g_dict,
+            'activities': {allocations[i]: n for i, n in busy_activities[slot].items()},
+            'group_preference_dict': set(g for g in groups if g.id in occupancy.group_cant and
+                                         occupancy.group_cant[g.id][slot]),
+            'busy_teachers': {t: [allocations[i] for i in l] for t, l in busy_teachers[slot].items()},
+            'teacher_preferences': dict(teacher_preferences[slot]),
+        }
+    return cells
+
+
+def _placement_rooms(request, tt, realization):
+    if request.GET.get('all_rooms', False):
+        return tt.classrooms.all()
+    return realization.preferred_rooms(tt)
+
+
 @login_required
 def busy_students_admin(request, timetable_slug, realization_id):
     tt = get_object_or_404(Timetable, slug=timetable_slug)
     realization = get_object_or_404(ActivityRealization, id=realization_id)
     days = [_(i[1]) for i in WEEKDAYS]
     hours = [i[0] for i in WORKHOURS]
-    if request.GET.get('all_rooms', False):
-        rooms = tt.classrooms.all()
-    else:
-        rooms = realization.preferred_rooms(tt)
+    rooms = _placement_rooms(request, tt, realization)
     allow_bad_place = request.GET.get('allow_bad_place', False)
-    busy_group_dict = defaultdict(lambda: defaultdict(int))
-    busy_activity_dict = defaultdict(lambda: defaultdict(int))
-    busy_group_preference_dict = defaultdict(set)
-    for g in realization.groups.all():
-        for s in g.students.all():
-            allocations = tt.allocations.filter(
-                activityRealization__groups__students=s
-            ).exclude(
-                activityRealization_id=realization_id).distinct()
-            for a in allocations:
-                for h in a.hours:
-                    busy_activity_dict[(a.day, h)][a] += 1
-                    busy_group_dict[(a.day, h)][g] += 1
-        for tp in g.time_preferences.filter(level='CANT').distinct():
-            for h in tp.hours():
-                busy_group_preference_dict[(tp.day, h)].add(g)
-    busy_teachers_dict = defaultdict(lambda: defaultdict(list))
-    teachers_preference_dict = defaultdict(lambda: defaultdict(set))
-    for t in realization.teachers.all():
-        allocations = tt.allocations.filter(
-            activityRealization__teachers=t
-        ).exclude(
-            activityRealization_id=realization_id).distinct()
-        for a in allocations:
-            for h in a.hours:
-                busy_teachers_dict[(a.day, h)][t].append(a)
-        for tp in timetable.models.TeacherTimePreference.objects.filter(
-                teacher=t, preferenceset=tt.preferenceset).distinct():
-            for h in tp.hours():
-                teachers_preference_dict[(tp.day, h)][tp.level].add(t)
-    classrooms_busy = defaultdict(lambda: defaultdict(list))
-    for c in rooms:
-        allocations = tt.allocations.filter(classroom=c).exclude(
-            activityRealization_id=realization_id)
-        for a in allocations:
-            for h in a.hours:
-                classrooms_busy[(a.day, h)][a.classroom].append(a)
-    busy = list()
-    for h_n, h in enumerate(hours):
-        l = []
-        for d in [i[0] for i in WEEKDAYS]:
-            c_dict = dict(classrooms_busy[(d, h)])
-            c_free = set([c for c in rooms if c not in c_dict])
-            c_semifree = set()
-            for h1 in hours[h_n + 1:h_n + realization.activity.duration]:
-                for c_busy in dict(classrooms_busy[(d, h1)]):
-                    if c_busy in c_free:
-                        c_semifree.add(c_busy)
-                    c_free.discard(c_busy)
-            a_dict = dict(busy_activity_dict[(d, h)])
-            g_dict = dict(busy_group_dict[(d, h)])
-            total_overlap = 0
-            bad_students_overlap = 0
-            good_students_overlap = 0
-            for k, v in g_dict.items():
-                total_overlap += v
-                try:
-                    study = k.short_name.split('_')[1]
-                except:
-                    study = ''
-                if study == 'PAD' or study == '8' or study == '4':
-                    bad_students_overlap += v
-                else:
-                    good_students_overlap += v
-            l.append((d, {
-                'total_overlap': total_overlap,
-                'good_students_overlap': good_students_overlap,
-                'bad_students_overlap': bad_students_overlap,
-                'classrooms_busy': c_dict,
-                'classrooms_semifree': c_semifree,
-                'classrooms_free': c_free,
-                'groups': g_dict,
-                'activities': a_dict,
-                'group_preference_dict': busy_group_preference_dict[(d, h)],
-                'busy_teachers': dict(busy_teachers_dict[(d, h)]),
-                'teacher_preferences': dict(teachers_preference_dict[(d, h)])
-            }))
-        busy.append((h, l))
+    cells = _placement_cells(tt, realization, rooms)
+    busy = [(h, [(d[0], cells[(d[0], h)]) for d in WEEKDAYS]) for h in hours]
     return render(request, 'friprosveta/busy_students_admin.html', {
         'days': days, 'hours': hours, 'busy': busy,
         'rooms': rooms,
@@ -924,6 +1005,59 @@ def busy_students_admin(request, timetable_slug, realization_id):
         'timetable_slug': timetable_slug})
 
 
+def _allocation_json(a):
+    return {'id': a.id,
+            'activity': a.activityRealization.activity_id,
+            'short_name': a.activityRealization.activity.short_name}
+
+
+@login_required
+def busy_students_admin_json(request, timetable_slug, realization_id):
+    """
+    The placement grid of busy_students_admin as JSON, so single cells can be
+    refreshed after a realization is moved. Cells can be limited with day
+    and hour parameters.
+    """
+    tt = get_object_or_404(Timetable, slug=timetable_slug)
+    realization = get_object_or_404(ActivityRealization, id=realization_id)
+    rooms = _placement_rooms(request, tt, realization)
+    days = request.GET.getlist('day') or [d[0] for d in WEEKDAYS]
+    hours = request.GET.getlist('hour') or [h[0] for h in WORKHOURS]
+    if not set(days) <= set(d[0] for d in WEEKDAYS) or not set(hours) <= set(h[0] for h in WORKHOURS):
+        return HttpResponseBadRequest("Invalid day or hour")
+    cells = _placement_cells(tt, realization, rooms)
+    json_cells = []
+    for day in days:
+        for hour in hours:
+            cell = cells[(day, hour)]
+            json_cells.append({
+                'day': day,
+                'hour': hour,
+                'total_overlap': cell['total_overlap'],
+                'good_students_overlap': cell['good_students_overlap'],
+                'bad_students_overlap': cell['bad_students_overlap'],
+                'classrooms_free': sorted(c.id for c in cell['classrooms_free']),
+                'classrooms_semifree': sorted(c.id for c in cell['classrooms_semifree']),
+                'classrooms_busy': {c.id: [_allocation_json(a) for a in l]
+                                    for c, l in cell['classrooms_busy'].items()},
+                'groups': {g.id: n for g, n in cell['groups'].items()},
+                'activities': [dict(_allocation_json(a), students=n) for a, n in cell['activities'].items()],
+                'group_preferences': sorted(g.id for g in cell['group_preference_dict']),
+                'busy_teachers': {t.id: [_allocation_json(a) for a in l]
+                                  for t, l in cell['busy_teachers'].items()},
+                'teacher_preferences': {level: sorted(t.id for t in l)
+                                        for level, l in cell['teacher_preferences'].items()},
+            })
+    return JsonResponse({
+        'realization': realization.id,
+        'classrooms': [{'id': c.id, 'short_name': c.short_name} for c in rooms],
+        'groups': [{'id': g.id, 'short_name': g.short_name, 'size': g.size}
+                   for g in realization.groups.all()],
+        'teachers': [{'id': t.id, 'name': str(t)} for t in realization.teachers.select_related('user')],
+        'cells': json_cells,
+    })
+
+
 class UnplacedRealizationsList(ListView):
     def get_queryset(self):
         return timetable.models.ActivityRealization.objects.filter(
@@ -948,52 +1082,21 @@ def busy_students(request, timetable_slug, realization_id):
     days = [_(i[1]) for i in WEEKDAYS]
     hours = [i[0] for i in WORKHOURS]
     tt = get_object_or_404(timetable.models.Timetable, slug=timetable_slug)
-    groupset = tt.groupset
     realization = get_object_or_404(timetable.models.ActivityRealization, id=realization_id)
-    preferred_rooms = realization.preferred_rooms(tt)
+    preferred_rooms = list(realization.preferred_rooms(tt))
     students = friprosveta.models.Student.objects.filter(groups__realizations=realization).distinct()
-    busy_dict = dict()
-    for s in students:
-        allocations = tt.allocations.filter(
-            activityRealization__groups__students=s
-        ).exclude(
-            activityRealization_id=realization.id
-        ).distinct()
-        # Some students might have overlapping allocations.
-        # Count each time a student is busy exactly once.
-        busy_set = set()
-        for a in allocations:
-            for h in a.hours:
-                busy_set.add((a.day, h))
-        for g in s.groups.filter(groupset=groupset):
-            for tp in g.time_preferences.filter(level='CANT'):
-                for h in tp.hours():
-                    busy_set.add((tp.day, h))
-        for (day, h) in busy_set:
-            h_dict = busy_dict.get(h, dict())
-            d = h_dict.get(day, 0)
-            h_dict[day] = d + 1
-            busy_dict[h] = h_dict
-    classrooms_free = dict()
-    for hour in WORKHOURS:
-        classrooms_free[hour[0]] = dict()
-        for day in WEEKDAYS:
-            classrooms_free[hour[0]][day[0]] = set(preferred_rooms)
-    for c in preferred_rooms:
-        allocations = tt.allocations.filter(
-            classroom=c)
-        for a in allocations:
-            for h in a.hours:
-                try:
-                    classrooms_free[h][a.day].remove(c)
-                except KeyError:
-                    pass  # survive double-booking which causes multiple removes.
+    index = friprosveta.occupancy.get_occupancy_index(tt)
+    # Number of students busy in each timeslot
+    busy_counts = index.busy_counts(
+        realization.id, realization.groups.values_list('id', flat=True))
+    classrooms_free = index.occupancy.free_classrooms_grid([c.id for c in preferred_rooms], 1)
     busy = list()
     for h in hours:
         l = []
         for d in WEEKDAYS:
-            busy_s = busy_dict.get(h, dict()).get(d[0], 0)
-            classrooms = classrooms_free[h][d[0]]
+            slot = friprosveta.occupancy.slot(d[0], h)
+            busy_s = int(busy_counts[slot])
+            classrooms = set(c for c, free in zip(preferred_rooms, classrooms_free[:, slot]) if free)
             l.append({'busy': busy_s, 'classrooms_free': classrooms})
         busy.append((h, l))
     return render(request, 'friprosveta/busy_students.html',
@@ -1676,6 +1779,42 @@ def teacher_hours_table(request, timetable_set_slug):
                    })
 
 
+@login_required
+def move_conflicts_json(request, timetable_slug, allocation_id):
+    """
+    Return the current numbers of student, teacher and classroom conflicts
+    in the timetable and their change if the allocation was moved to each
+    of the given days and starts (all timeslots by default) and classroom
+    (the current one by default).
+    """
+    if not request.user.is_staff:
+        return HttpResponseForbidden()
+    tt = get_object_or_404(Timetable, slug=timetable_slug)
+    occupancy = friprosveta.occupancy.get_occupancy_index(tt).occupancy
+    allocation = occupancy.allocations.get(int(allocation_id))
+    if allocation is None:
+        raise Http404
+    days = request.GET.getlist('day') or [d[0] for d in WEEKDAYS]
+    starts = request.GET.getlist('start') or [h[0] for h in WORKHOURS]
+    if not set(days) <= set(d[0] for d in WEEKDAYS) or not set(starts) <= set(h[0] for h in WORKHOURS):
+        return HttpResponseBadRequest("Invalid day or start")
+    try:
+        classroom_id = int(request.GET['classroom']) if 'classroom' in request.GET else allocation.classroom_id
+    except ValueError:
+        return HttpResponseBadRequest("Invalid classroom")
+    if classroom_id != allocation.classroom_id and not timetable.models.Classroom.objects.filter(
+            id=classroom_id, classroomset__timetables=tt).exists():
+        return HttpResponseBadRequest("Invalid classroom")
+    return JsonResponse({
+        'allocation': allocation.id,
+        'classroom': classroom_id,
+        'conflicts': occupancy.conflicts()._asdict(),
+        'moves': [dict(occupancy.move_conflicts(allocation.id, day, start, classroom_id)._asdict(),
+                       day=day, start=start)
+                  for day in days for start in starts],
+    })
+
+
 @login_required
 def place_realization(request, timetable_slug, realization_id):
     if not request.user.is_staff:
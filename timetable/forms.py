@@ -14,7 +14,7 @@ from timetable.models import TeacherValuePreference, \
     Activity, ActivityRealization, \
     TagTimePreference, Tag, \
     Preference, WEEKDAYS, WORKHOURS, PreferenceSet, Teacher, \
-    PREFERENCELEVELS
+    PREFERENCELEVELS, invalidate_unavailable_masks
 
 
 class SimplePreferenceForm(forms.ModelForm):
@@ -461,6 +461,7 @@ class GroupPreferenceForm(forms.Form):
             for f in self.subforms:
                 if f.is_valid():
                     f.save(commit=True)
+            invalidate_unavailable_masks(self.preferenceset().id)
         return canSave
 
 
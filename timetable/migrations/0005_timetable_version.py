@@ -0,0 +1,18 @@
+from django.db import migrations, models
+
+import timetable.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('timetable', '0004_group_visible_in_navigation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='timetable',
+            name='version',
+            field=models.CharField(default=timetable.models.new_version, editable=False, max_length=32),
+        ),
+    ]
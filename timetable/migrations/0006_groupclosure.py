@@ -0,0 +1,52 @@
+# Generated by Django 2.1.1
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def closure_rows(parents):
+    """
+    Copy of timetable.models.closure_rows at the time of the migration.
+    """
+    rows = []
+    for group_id in parents:
+        ancestor_id, depth = group_id, 0
+        seen = set()
+        while ancestor_id is not None and ancestor_id not in seen:
+            rows.append((ancestor_id, group_id, depth))
+            seen.add(ancestor_id)
+            ancestor_id = parents.get(ancestor_id)
+            depth += 1
+    return rows
+
+
+def fill_group_closure(apps, schema_editor):
+    Group = apps.get_model('timetable', 'Group')
+    GroupClosure = apps.get_model('timetable', 'GroupClosure')
+    parents = dict(Group.objects.values_list('id', 'parent_id'))
+    GroupClosure.objects.bulk_create([GroupClosure(ancestor_id=a, descendant_id=d, depth=depth)
+                                      for a, d, depth in closure_rows(parents)])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('timetable', '0005_timetable_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GroupClosure',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('depth', models.PositiveIntegerField()),
+                ('ancestor', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='descendant_links', to='timetable.Group')),
+                ('descendant', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='ancestor_links', to='timetable.Group')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='groupclosure',
+            unique_together={('ancestor', 'descendant')},
+        ),
+        migrations.RunPython(fill_group_closure, migrations.RunPython.noop),
+    ]
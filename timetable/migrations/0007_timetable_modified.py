@@ -0,0 +1,19 @@
+# Generated by Django 2.1.1
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('timetable', '0006_groupclosure'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='timetable',
+            name='modified',
+            field=models.DateTimeField(default=django.utils.timezone.now, editable=False),
+        ),
+    ]
@@ -1,11 +1,14 @@
 import datetime
+import uuid
 from _collections import defaultdict
 
 from django.contrib.auth.models import User
-from django.db import models
+from django.db import models, transaction
 from django.db.models import Count, Q
 from django.contrib.sites.models import Site
 from django.contrib.sites.shortcuts import get_current_site
+from django.core.cache import cache
+from django.utils import timezone
 from django.utils.translation import ugettext as _
 
 
@@ -227,12 +230,21 @@ class Group(models.Model):
         First parent is the first element in the list,
         its parent second...
         """
-        parent = self.parent
-        parents = []
-        while parent is not None:
-            parents.append(parent)
-            parent = parent.parent
-        return parents
+        return list(self.ancestors())
+
+    def ancestors(self):
+        """
+        Return the queryset of all parents, ordered from the closest one up.
+        """
+        return Group.objects.filter(descendant_links__descendant=self,
+                                    descendant_links__depth__gt=0).order_by('descendant_links__depth')
+
+    def descendants(self):
+        """
+        Return the queryset of all children, their children...
+        """
+        return Group.objects.filter(ancestor_links__ancestor=self,
+                                    ancestor_links__depth__gt=0)
 
     @property
     def subjectname(self):
@@ -245,16 +257,26 @@ class Group(models.Model):
         """
         Scope = sub for all children (default), one for single level.
         """
-        children = []
-        for group in Group.objects.filter(parent=self):
-            children.append(group)
-            if scope == 'sub':
-                children += group.children()
+        if scope == 'sub':
+            children = list(self.descendants())
+        else:
+            children = list(Group.objects.filter(parent=self))
         children.sort(key=lambda x: x.name)
         return children
 
     def family(self):
-        return self.children() + [self] + self.parents
+        """
+        Return the list of all children, the group itself and all parents
+        (same order as children() + [self] + parents) in a single query.
+        """
+        links = GroupClosure.objects.filter(
+            Q(ancestor=self) | Q(descendant=self), depth__gt=0
+        ).select_related('ancestor', 'descendant')
+        children = sorted((l.descendant for l in links if l.ancestor_id == self.id),
+                          key=lambda x: x.name)
+        parents = [l.ancestor for l in sorted(links, key=lambda l: l.depth)
+                   if l.descendant_id == self.id]
+        return children + [self] + parents
 
     @property
     def time_preferences(self):
@@ -275,7 +297,15 @@ class Group(models.Model):
         Available means that group has no GroupTimePreferences that
         would make it unavailable in the given timeslot.
         The timeslot is a set of WORKHOURS.
+        A group is not tied to a timetable, so preferences of all preference
+        sets count (use Allocation.groups_not_available for the preference
+        set of a timetable).
         '''
+        if list(non_available_levels) == ['CANT']:
+            mask = 0
+            for hour in timeslot:
+                mask |= timeslot_mask(day, hour, 1)
+            return not unavailable_masks(None).get(self.id, 0) & mask
         time_preferences = self.all_time_preferences.filter(
             level__in=non_available_levels)
         non_available_hours = defaultdict(set)
@@ -293,6 +323,164 @@ class Group(models.Model):
         ordering = ['name']
 
 
+def closure_rows(parents):
+    """
+    Return the list of (ancestor id, descendant id, depth) triples for the
+    group hierarchy given by the dictionary group id -> parent id.
+    Every group is its own ancestor with depth 0.
+    """
+    rows = []
+    for group_id in parents:
+        ancestor_id, depth = group_id, 0
+        seen = set()
+        while ancestor_id is not None and ancestor_id not in seen:
+            rows.append((ancestor_id, group_id, depth))
+            seen.add(ancestor_id)
+            ancestor_id = parents.get(ancestor_id)
+            depth += 1
+    return rows
+
+
+class GroupClosure(models.Model):
+    """
+    Transitive closure of the Group.parent relation: one row for every
+    group and each of its ancestors (including itself with depth 0).
+    Kept up to date by timetable.signals.
+    """
+    def __str__(self):
+        return "{0} -> {1} ({2})".format(self.ancestor_id, self.descendant_id, self.depth)
+
+    ancestor = models.ForeignKey('Group', related_name='descendant_links', on_delete=models.CASCADE)
+    descendant = models.ForeignKey('Group', related_name='ancestor_links', on_delete=models.CASCADE)
+    depth = models.PositiveIntegerField()
+
+    @classmethod
+    def link(cls, group):
+        """
+        Attach the group (with its whole subtree) under its current parent.
+        Used when the group is created or its parent changes.
+        """
+        subtree = list(cls.objects.filter(ancestor_id=group.id).values_list('descendant_id', 'depth'))
+        if not subtree:
+            subtree = [(group.id, 0)]
+            cls.objects.create(ancestor_id=group.id, descendant_id=group.id, depth=0)
+        subtree_ids = [descendant_id for descendant_id, _ in subtree]
+        cls.objects.filter(descendant_id__in=subtree_ids).exclude(ancestor_id__in=subtree_ids).delete()
+        if group.parent_id is None:
+            return
+        ancestors = cls.objects.filter(descendant_id=group.parent_id).values_list('ancestor_id', 'depth')
+        cls.objects.bulk_create([
+            cls(ancestor_id=ancestor_id, descendant_id=descendant_id, depth=ancestor_depth + descendant_depth + 1)
+            for ancestor_id, ancestor_depth in ancestors
+            for descendant_id, descendant_depth in subtree])
+
+    @classmethod
+    def rebuild(cls):
+        """
+        Recompute the whole table from Group.parent, for instance after
+        groups were changed with queryset.update.
+        """
+        cls.objects.all().delete()
+        parents = dict(Group.objects.values_list('id', 'parent_id'))
+        cls.objects.bulk_create([cls(ancestor_id=a, descendant_id=d, depth=depth)
+                                 for a, d, depth in closure_rows(parents)])
+        invalidate_unavailable_masks()
+
+    class Meta:
+        unique_together = (("ancestor", "descendant"),)
+
+
+WEEKDAY_INDEX = {day: i for i, (day, _) in enumerate(WEEKDAYS)}
+WORKHOUR_INDEX = {hour: i for i, (hour, _) in enumerate(WORKHOURS)}
+
+
+def timeslot_mask(day, start, duration):
+    """
+    Return the bitmask of hours lasting duration hours from start on day.
+    Bit i * len(WORKHOURS) + j stands for the j-th work hour of the i-th weekday.
+    """
+    first = WORKHOUR_INDEX[start]
+    last = min(len(WORKHOURS), first + duration)
+    return ((1 << (last - first)) - 1) << (WEEKDAY_INDEX[day] * len(WORKHOURS) + first)
+
+
+def cache_generation(keys):
+    """
+    Return the tuple of generations stored under the keys in the shared
+    cache. Missing generations are created. Data kept in process memory
+    is valid as long as the generation it was computed in is current.
+    """
+    generations = cache.get_many(keys)
+    for key in keys:
+        if key not in generations:
+            generations[key] = new_version()
+            cache.set(key, generations[key], None)
+    return tuple(generations[key] for key in keys)
+
+
+def invalidate_generations(keys):
+    """
+    Store new generations under the keys (see cache_generation). They are
+    stored at once, so the current transaction recomputes the data it
+    changed, and again when the transaction is committed, since other
+    processes may recompute the data from the state before the commit in
+    the meantime.
+    """
+    def invalidate():
+        cache.set_many({key: new_version() for key in keys}, None)
+    invalidate()
+    transaction.on_commit(invalidate)
+
+
+# preferenceset id -> (generation, group id -> bitmask), see unavailable_masks
+_unavailable_masks = dict()
+HIERARCHY_GENERATION_KEY = "group_unavailability_hierarchy"
+
+
+def _generation_key(preferenceset_id):
+    return "group_unavailability_{}".format(preferenceset_id)
+
+
+def unavailable_masks(preferenceset_id):
+    """
+    Return the dictionary group id -> bitmask (see timeslot_mask) of hours
+    the group is unavailable in: CANT time preferences of the group and all
+    its ancestors in the preference set (in all preference sets if
+    preferenceset_id is None). Groups without such preferences are missing.
+    Masks are kept in process memory until they are invalidated in any
+    process (generations are kept in the shared cache).
+    """
+    generation = cache_generation([_generation_key(preferenceset_id), HIERARCHY_GENERATION_KEY])
+    cached = _unavailable_masks.get(preferenceset_id)
+    if cached is not None and cached[0] == generation:
+        return cached[1]
+
+    preferences = GroupTimePreference.objects.filter(level='CANT')
+    if preferenceset_id is not None:
+        preferences = preferences.filter(preferenceset_id=preferenceset_id)
+    own = defaultdict(int)
+    for group_id, day, start, duration in preferences.values_list('group_id', 'day', 'start', 'duration'):
+        own[group_id] |= timeslot_mask(day, start, duration)
+    masks = dict()
+    for ancestor_id, descendant_id in GroupClosure.objects.filter(
+            ancestor_id__in=preferences.values('group_id')).values_list('ancestor_id', 'descendant_id'):
+        masks[descendant_id] = masks.get(descendant_id, 0) | own[ancestor_id]
+    _unavailable_masks[preferenceset_id] = (generation, masks)
+    return masks
+
+
+def invalidate_unavailable_masks(preferenceset_id=None):
+    """
+    Drop unavailable_masks of the preference set (and of all preference
+    sets together) in all processes. Without a preference set (for instance
+    when the group hierarchy changes) masks of all preference sets are dropped.
+    """
+    if preferenceset_id is None:
+        invalidate_generations([HIERARCHY_GENERATION_KEY])
+    else:
+        invalidate_generations([_generation_key(preferenceset_id), _generation_key(None)])
+
+
 class Activity(models.Model):
     def __str__(self):
         groups = self.groups.all()
@@ -541,6 +729,13 @@ class TimetableSite(models.Model):
         return desc
 
 
+def new_version():
+    """
+    Return a fresh, unique timetable version token.
+    """
+    return uuid.uuid4().hex
+
+
 class Timetable(models.Model):
     def __str__(self):
         return self.name
@@ -581,6 +776,10 @@ class Timetable(models.Model):
     start = models.DateField(default=datetime.date.today)
     end = models.DateField(default=datetime.date.today)
     preference_deadline = models.DateField(default=datetime.date.today)
+    # Changed every time the data shown in this timetable changes.
+    # See timetable.signals for details.
+    version = models.CharField(max_length=32, default=new_version, editable=False)
+    modified = models.DateTimeField(default=timezone.now, editable=False)
 
     @property
     def activities(self):
@@ -673,10 +872,12 @@ class Allocation(models.Model):
     @property
     def groups_not_available(self):
         """
-        Return the list of not-available groups in the allocation timeslot.
+        Return the list of not-available groups in the allocation timeslot
+        according to the preference set of the timetable (see unavailable_masks).
         """
-        return [group for group in self.groups
-                if not group.is_available(self.day, set(self.hours))]
+        masks = unavailable_masks(self.timetable.preferenceset_id)
+        mask = timeslot_mask(self.day, self.start, self.duration)
+        return [group for group in self.groups if masks.get(group.id, 0) & mask]
 
     @property
     def start_within_working_hours(self):
@@ -778,6 +979,65 @@ class GroupValuePreference(GroupPreference):
         return GroupPreference.adjustedWeight(self, 0.5)
 
 
+# preferenceset id -> (generation, (teacher id, level) -> sums), see teacher_weight_sums
+_teacher_weight_sums = dict()
+
+
+def _teacher_weights_key(preferenceset_id):
+    return "teacher_weight_sums_{}".format(preferenceset_id)
+
+
+def teacher_weight_sums(preferenceset_id, keys=()):
+    """
+    Return the dictionary (teacher id, level) -> (sum of weights of teacher
+    preferences, sum of weights times durations of teacher time preferences)
+    of the preference set, read in one grouped query. Adjusted weights of
+    teacher preferences are normalized by these sums. Sums are kept in
+    process memory until they are invalidated in any process (see
+    invalidate_teacher_weight_sums). Cached sums missing one of the given
+    (teacher id, level) keys are stale (preferences were changed without
+    signals, for instance by QuerySet.update), so they are invalidated and
+    read again.
+    """
+    generation = cache_generation([_teacher_weights_key(preferenceset_id)])
+    cached = _teacher_weight_sums.get(preferenceset_id)
+    if cached is not None and cached[0] == generation:
+        if all(key in cached[1] for key in keys):
+            return cached[1]
+        invalidate_teacher_weight_sums(preferenceset_id)
+        generation = cache_generation([_teacher_weights_key(preferenceset_id)])
+    sums = dict()
+    for teacher_id, level, weights, time_weights in TeacherPreference.objects.filter(
+            preferenceset_id=preferenceset_id).order_by().values('teacher_id', 'level').annotate(
+            weights=models.Sum('weight'),
+            time_weights=models.Sum(models.F('weight') * models.F('teachertimepreference__duration'),
+                                    output_field=models.FloatField())
+    ).values_list('teacher_id', 'level', 'weights', 'time_weights'):
+        sums[(teacher_id, level)] = (weights, time_weights or 0)
+    _teacher_weight_sums[preferenceset_id] = (generation, sums)
+    return sums
+
+
+def invalidate_teacher_weight_sums(preferenceset_id):
+    """
+    Drop teacher_weight_sums of the preference set in all processes
+    (again when the transaction is committed, see invalidate_generations).
+    """
+    invalidate_generations([_teacher_weights_key(preferenceset_id)])
+
+
+def normalized_weight(level, weight, weight_sum, min_weight, max_weight):
+    """
+    Return the weight of a teacher preference normalized by the sum of
+    weights of the teacher on the level (see teacher_weight_sums) into
+    the range [min_weight, max_weight]. CANT preferences weigh 1,
+    preferences with a zero sum weigh min_weight.
+    """
+    if level == 'CANT':
+        return 1.0
+    return min_weight + (weight / weight_sum if weight_sum else 0) * (max_weight - min_weight)
+
+
 class TeacherPreference(Preference):
     def __str__(self):
         return str(self.teacher) + ' ' + str(self.level)
@@ -785,17 +1045,12 @@ class TeacherPreference(Preference):
     teacher = models.ForeignKey('Teacher', related_name='teacher_preferences', on_delete=models.CASCADE)
 
     def adjustedWeight(self, optional_adjustment=1, min_weight=0, max_weight=1):
-        if self.level == 'CANT':
-            return 1.0
-        else:
-            # Preferencea dolžine 2 ima weight 1
-            # Dve preferenci dolžine 2 pa 2
-            # Zato ta formula (čeprav lepa in hitra) ni čisto dobra za TeacherTimePreference.
-            preferences = TeacherPreference.objects.filter(teacher=self.teacher, level=self.level,
-                                                           preferenceset=self.preferenceset)
-            wsum = preferences.aggregate(s=models.Sum('weight'))
-            original_weight = optional_adjustment * self.weight / wsum['s']
-            return min_weight + original_weight * (max_weight - min_weight)
+        # Preferencea dolžine 2 ima weight 1
+        # Dve preferenci dolžine 2 pa 2
+        # Zato ta formula (čeprav lepa in hitra) ni čisto dobra za TeacherTimePreference.
+        key = (self.teacher_id, self.level)
+        wsum = teacher_weight_sums(self.preferenceset_id, [key]).get(key, (0, 0))[0]
+        return normalized_weight(self.level, optional_adjustment * self.weight, wsum, min_weight, max_weight)
 
 
 class TeacherValuePreference(TeacherPreference):
@@ -822,17 +1077,9 @@ class TeacherTimePreference(TeacherPreference):
     duration = models.IntegerField(default=1)
 
     def adjustedWeight(self, min_weight=0.4, max_weight=0.99):
-        if self.level == 'CANT':
-            return 1.0
-        else:
-            wsum = 0
-            preferences = TeacherTimePreference.objects.filter(teacher=self.teacher,
-                                                               level=self.level,
-                                                               preferenceset=self.preferenceset)
-            for preference in preferences:
-                wsum += preference.weight * preference.duration
-            original_weight = self.weight / wsum
-            return min_weight + original_weight * (max_weight - min_weight)
+        key = (self.teacher_id, self.level)
+        wsum = teacher_weight_sums(self.preferenceset_id, [key]).get(key, (0, 0))[1]
+        return normalized_weight(self.level, self.weight, wsum, min_weight, max_weight)
 
     def hours(self):
         index = WORKHOURS.index((self.start, self.start))
@@ -0,0 +1,273 @@
+"""
+Keep derived data up to date.
+
+Every change that alters what the pages of a timetable show (allocations,
+realizations, activities, groups, teachers, classrooms) gives the affected
+timetables a fresh version and modification time. Data derived from a
+timetable (for instance friprosveta.snapshot and friprosveta.response_cache)
+is keyed by this version, so it is never served stale.
+
+GroupClosure follows changes of the group hierarchy. Changes of the hierarchy
+and of group time preferences invalidate cached unavailable hours of groups
+(see timetable.models.unavailable_masks), the latter also give affected
+timetables a new version. Changes of teacher preferences invalidate cached
+sums their weights are normalized by (see timetable.models.teacher_weight_sums).
+"""
+import logging
+
+from django.apps import apps
+from django.db import transaction
+from django.db.models import Q
+from django.db.models.signals import post_init, post_save, post_delete, m2m_changed
+from django.dispatch import receiver
+from django.utils import timezone
+
+from timetable.models import Timetable, Allocation, Activity, \
+    ActivityRealization, Group, GroupClosure, GroupTimePreference, Classroom, Teacher, TeacherPreference, \
+    new_version, invalidate_unavailable_masks, invalidate_teacher_weight_sums
+
+logger = logging.getLogger(__name__)
+
+
+def connect_model_signal(signal, handler, model):
+    """
+    Connect the handler to the signal for the model and all its subclasses.
+    Model signals are sent with the class of the saved instance, so handlers
+    connected only to the base model miss saves of proxy and child models
+    (for instance friprosveta.models.ActivityRealization).
+    """
+    for m in apps.get_models():
+        if issubclass(m, model):
+            signal.connect(handler, sender=m)
+
+
+def affected_timetable_ids(timetable_ids):
+    """
+    Return the set of given timetable ids together with the ids of
+    all timetables that respect them (and thus show their allocations).
+    """
+    ids = set(i for i in timetable_ids if i is not None)
+    if ids:
+        ids.update(Timetable.objects.filter(
+            respects__id__in=ids).values_list('id', flat=True))
+    return ids
+
+
+def touch(timetables):
+    """
+    Give a new version and modification time to timetables in the queryset.
+    Update is used so no signals are sent (and the version is not overwritten).
+    Return the new version.
+    """
+    version = new_version()
+    timetables.update(version=version, modified=timezone.now())
+    return version
+
+
+def bump_timetable_versions(timetable_ids):
+    """
+    Give a new version to the given timetables and all timetables respecting them.
+    Return the new version (None if there are no such timetables).
+    """
+    ids = affected_timetable_ids(timetable_ids)
+    if ids:
+        logger.debug("Bumping versions of timetables {}".format(ids))
+        return touch(Timetable.objects.filter(id__in=ids))
+    return None
+
+
+def realization_timetable_ids(realization_ids):
+    """
+    Return ids of timetables with allocations of the given realizations.
+    """
+    if not realization_ids:
+        return set()
+    return set(Allocation.objects.filter(
+        activityRealization_id__in=realization_ids
+    ).values_list('timetable_id', flat=True).distinct())
+
+
+def activity_timetable_ids(activity_ids):
+    """
+    Return ids of timetables containing the given activities
+    or allocations of their realizations.
+    """
+    if not activity_ids:
+        return set()
+    timetable_ids = set(Timetable.objects.filter(
+        activityset__activities__id__in=activity_ids).values_list('id', flat=True))
+    return timetable_ids | realization_timetable_ids(list(ActivityRealization.objects.filter(
+        activity_id__in=activity_ids).values_list('id', flat=True)))
+
+
+def remember_allocation_timetable(sender, instance, **kwargs):
+    instance._original_timetable_id = instance.timetable_id
+
+
+def allocation_changed(sender, instance, **kwargs):
+    # Occupancy indices updated in place take this version (see friprosveta.occupancy.update_indices)
+    instance._timetable_version = bump_timetable_versions([instance.timetable_id,
+                                                           getattr(instance, '_original_timetable_id', None)])
+    instance._original_timetable_id = instance.timetable_id
+
+
+def realization_changed(sender, instance, **kwargs):
+    bump_timetable_versions(realization_timetable_ids([instance.id]))
+
+
+def activity_changed(sender, instance, **kwargs):
+    bump_timetable_versions(activity_timetable_ids([instance.id]))
+
+
+def group_saved_or_deleted(sender, instance, **kwargs):
+    bump_timetable_versions(Timetable.objects.filter(
+        groupset_id=instance.groupset_id).values_list('id', flat=True))
+
+
+def classroom_changed(sender, instance, **kwargs):
+    bump_timetable_versions(Timetable.objects.filter(
+        classroomset__classrooms=instance).values_list('id', flat=True))
+
+
+def teacher_changed(sender, instance, **kwargs):
+    realization_ids = list(instance.activity_realizations.values_list('id', flat=True))
+    activity_ids = list(instance.activities.values_list('id', flat=True))
+    bump_timetable_versions(realization_timetable_ids(realization_ids) |
+                            activity_timetable_ids(activity_ids))
+
+
+connect_model_signal(post_init, remember_allocation_timetable, Allocation)
+connect_model_signal(post_save, allocation_changed, Allocation)
+connect_model_signal(post_delete, allocation_changed, Allocation)
+connect_model_signal(post_save, realization_changed, ActivityRealization)
+connect_model_signal(post_save, activity_changed, Activity)
+connect_model_signal(post_save, group_saved_or_deleted, Group)
+connect_model_signal(post_delete, group_saved_or_deleted, Group)
+connect_model_signal(post_save, classroom_changed, Classroom)
+connect_model_signal(post_save, teacher_changed, Teacher)
+
+
+def realization_m2m_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Handle changes of groups and teachers on realizations (from both sides).
+    """
+    if reverse:
+        if action == 'pre_clear':
+            source_field = "{}_id".format(instance._meta.model_name)
+            instance._cleared_realization_ids = list(sender.objects.filter(
+                **{source_field: instance.pk}
+            ).values_list('activityrealization_id', flat=True))
+            return
+        if action == 'post_clear':
+            realization_ids = getattr(instance, '_cleared_realization_ids', [])
+        else:
+            realization_ids = pk_set
+    else:
+        realization_ids = [instance.pk]
+    if action in ['post_add', 'post_remove', 'post_clear']:
+        bump_timetable_versions(realization_timetable_ids(realization_ids))
+
+
+m2m_changed.connect(realization_m2m_changed,
+                    sender=ActivityRealization.groups.through)
+m2m_changed.connect(realization_m2m_changed,
+                    sender=ActivityRealization.teachers.through)
+
+
+@receiver(m2m_changed, sender=Activity.teachers.through)
+def activity_teachers_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+    Handle changes of teachers on activities (from both sides).
+    """
+    if reverse:
+        if action == 'pre_clear':
+            instance._cleared_activity_ids = list(instance.activities.values_list('id', flat=True))
+            return
+        if action == 'post_clear':
+            activity_ids = getattr(instance, '_cleared_activity_ids', [])
+        else:
+            activity_ids = pk_set
+    else:
+        activity_ids = [instance.pk]
+    if action in ['post_add', 'post_remove', 'post_clear']:
+        bump_timetable_versions(activity_timetable_ids(activity_ids))
+
+
+@receiver(m2m_changed, sender=Timetable.respects.through)
+def respects_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if reverse and action == 'pre_clear':
+        instance._cleared_respecting_ids = list(
+            instance.respected_by.values_list('id', flat=True))
+        return
+    if action not in ['post_add', 'post_remove', 'post_clear']:
+        return
+    if reverse:
+        # instance is the respected timetable
+        if action == 'post_clear':
+            timetable_ids = getattr(instance, '_cleared_respecting_ids', [])
+        else:
+            timetable_ids = pk_set
+        touch(Timetable.objects.filter(id__in=timetable_ids))
+    else:
+        touch(Timetable.objects.filter(id=instance.id))
+
+
+def timetable_changed(sender, instance, **kwargs):
+    """
+    Saving the timetable could overwrite the version with a stale value
+    (and change its public flag), so always issue a new one.
+    """
+    bump_timetable_versions([instance.id])
+
+
+connect_model_signal(post_save, timetable_changed, Timetable)
+
+
+def remember_group_parent(sender, instance, **kwargs):
+    instance._original_parent_id = instance.parent_id
+
+
+def group_changed(sender, instance, created, **kwargs):
+    """
+    Link new groups and groups with a new parent into the closure table.
+    Deleted groups are removed from it by the cascade.
+    """
+    if created or instance.parent_id != getattr(instance, '_original_parent_id', None):
+        with transaction.atomic():
+            GroupClosure.link(instance)
+            if created:
+                # loaddata can save children before their parents
+                for child in Group.objects.filter(parent_id=instance.id):
+                    GroupClosure.link(child)
+        # Groups inherit unavailable hours of their ancestors
+        invalidate_unavailable_masks()
+    instance._original_parent_id = instance.parent_id
+
+
+connect_model_signal(post_init, remember_group_parent, Group)
+connect_model_signal(post_save, group_changed, Group)
+
+
+def group_preference_changed(sender, instance, **kwargs):
+    """
+    Unavailable hours of the group and its descendants are shown by (and
+    kept in derived data of) timetables of their groupsets and timetables
+    using the preference set.
+    """
+    invalidate_unavailable_masks(instance.preferenceset_id)
+    bump_timetable_versions(Timetable.objects.filter(
+        Q(preferenceset_id=instance.preferenceset_id) |
+        Q(groupset__groups__ancestor_links__ancestor_id=instance.group_id)
+    ).values_list('id', flat=True).distinct())
+
+
+connect_model_signal(post_save, group_preference_changed, GroupTimePreference)
+connect_model_signal(post_delete, group_preference_changed, GroupTimePreference)
+
+
+def teacher_preference_changed(sender, instance, **kwargs):
+    invalidate_teacher_weight_sums(instance.preferenceset_id)
+
+
+connect_model_signal(post_save, teacher_preference_changed, TeacherPreference)
+connect_model_signal(post_delete, teacher_preference_changed, TeacherPreference)
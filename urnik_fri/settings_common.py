@@ -1,3 +1,6 @@
+import os
+import tempfile
+
 from django.utils.translation import ugettext_lazy as _
 
 DEBUG = False
@@ -138,7 +141,20 @@ INSTALLED_APPS = [
     # 'django_celery_results',
 ]
 
-CACHE_BACKEND = 'locmem://'
+# Shared by all workers: the allocation snapshots and the response cache
+# (friprosveta.snapshot, friprosveta.response_cache) are stored here.
+# The directory is given by the CACHE_DIR environment variable (or override
+# CACHES in local settings).
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.environ.get('CACHE_DIR', os.path.join(tempfile.gettempdir(), 'urnik_cache')),
+        'TIMEOUT': 24 * 60 * 60,
+        'OPTIONS': {
+            'MAX_ENTRIES': 10000,
+        },
+    }
+}
 
 REST_FRAMEWORK = {
     'DEFAULT_RENDERER_CLASSES': (